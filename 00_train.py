@@ -13,6 +13,9 @@ import glob
 import sys
 import gc
 import time
+import csv
+import queue
+import multiprocessing
 ########################################################################
 
 
@@ -25,7 +28,11 @@ from tqdm import tqdm
 # original lib
 import common as com
 import pytorch_model
-from Dataset import MelDataLoader
+from feature_cache import open_feature_cache
+from feature_store import build_feature_store
+from dataset_index import indexed_files
+from checkpoint import atomic_save, save_checkpoint, load_checkpoint, set_rng_state
+from Dataset import MelDataset, BatchLoader
 import random
 from torch.utils.tensorboard import SummaryWriter
 import torch.optim.lr_scheduler as lr_sched
@@ -49,7 +56,7 @@ class visualizer(object):
         self.fig = self.plt.figure(figsize=(30, 10))
         self.plt.subplots_adjust(wspace=0.3, hspace=0.3)
 
-    def loss_plot(self, loss, val_loss):
+    def loss_plot(self, loss, val_loss, val_epochs=None):
         """
         Plot loss curve.
 
@@ -57,13 +64,18 @@ class visualizer(object):
             training loss time series.
         val_loss : list [ float ]
             validation loss time series.
+        val_epochs : list [ int ] ( default = None )
+            1-based epochs of val_loss when the validation did not run every epoch.
 
         return   : None
         """
         ax = self.fig.add_subplot(1, 1, 1)
         ax.cla()
         ax.plot(loss)
-        ax.plot(val_loss)
+        if val_epochs is None:
+            ax.plot(val_loss)
+        else:
+            ax.plot(np.asarray(val_epochs) - 1, val_loss, marker="o")
         ax.set_title("Model loss")
         ax.set_xlabel("Epoch")
         ax.set_ylabel("Loss")
@@ -92,7 +104,12 @@ def list_to_vector_array(file_list,
                         frames=5,
                         n_fft=1024,
                         hop_length=512,
-                        power=2.0):
+                        power=2.0,
+                        cache=None,
+                        n_jobs=1,
+                        chunksize=16,
+                        out=None,
+                        rng=None):
     """
     convert the file_list to a vector array.
     file_to_vector_array() is iterated, and the output vector array is concatenated.
@@ -107,12 +124,24 @@ def list_to_vector_array(file_list,
                 cls_label of pump00 is 0, pump02 is 1, pump04 is 2, pump06 is 3
     cls_num : how many different ids of certain type of machine are used
               ex. cls_num of the example above is 4
+    cache : FeatureCache ( default = None )
+        on-disk log mel cache passed to file_to_vector_array()
+    n_jobs : int ( default = 1 )
+        number of feature extraction processes, see com.iter_vector_arrays()
+    chunksize : int ( default = 16 )
+        number of files submitted to an extraction process at once
+    out : numpy.array( float32 ) ( default = None )
+        preallocated feature matrix (or numpy.memmap) the vectors are written to,
+        a new array is allocated when it is None
+    rng : numpy.random.RandomState ( default = None )
+        generator of the non match labels, the global numpy generator when it is None
 
     During open-set training, we need match label and non match label, which non match label is 
     random choose from labels other than the match label
 
-    return : a list of data frames, each data frame contains feature, match label, and randomly picked non match label
-             feature, match label, and non match label are numpy.array, label and non match label are one hot labels
+    return : features, labels, nm_labels
+             features is the feature matrix (a view of out), labels and nm_labels are the
+             match and randomly picked non match class index of every row
 
     """
     # calculate the number of dimensions
@@ -121,43 +150,185 @@ def list_to_vector_array(file_list,
     '''
     create feature vectors from audio files
     '''
-    for idx in tqdm(range(len(file_list)), desc=msg):
-    #for idx in range(len(file_list)):
-        vector_array = com.file_to_vector_array(file_list[idx],
-                                                n_mels=n_mels,
-                                                frames=frames,
-                                                n_fft=n_fft,
-                                                hop_length=hop_length,
-                                                power=power)
-
-        if idx == 0:
+    vector_arrays = com.iter_vector_arrays(file_list,
+                                           n_jobs=n_jobs,
+                                           chunksize=chunksize,
+                                           n_mels=n_mels,
+                                           frames=frames,
+                                           n_fft=n_fft,
+                                           hop_length=hop_length,
+                                           power=power,
+                                           cache=cache)
+    features = out
+    n_rows = 0
+    for file_name, vector_array in tqdm(zip(file_list, vector_arrays), total=len(file_list), desc=msg):
+        if vector_array is None:
+            continue
+        if features is None:
             features = np.zeros((vector_array.shape[0] * len(file_list), dims), dtype=np.float32)
-        features[vector_array.shape[0] * idx: vector_array.shape[0] * (idx + 1), :] = vector_array
-        del vector_array
-        gc.collect()
+        if n_rows + vector_array.shape[0] > len(features):
+            raise ValueError("{} has {} vectors, only {} rows of the preallocated feature matrix are left".format(
+                file_name, vector_array.shape[0], len(features) - n_rows))
+        features[n_rows: n_rows + vector_array.shape[0], :] = vector_array
+        n_rows += vector_array.shape[0]
+    if features is None:
+        features = np.zeros((0, dims), dtype=np.float32)
+    features = features[:n_rows]
 
     '''
     create match and non match label
     '''
-    m_label = np.zeros((features.shape[0], cls_num), dtype=np.float32)
-    nm_label = np.zeros((features.shape[0], cls_num), dtype=np.float32)
-
-    for i in range(len(m_label)):
-        nm_indices = []
-        for j in range(cls_num):
-            if j == cls_label:
-                m_label[i][j] = 1
-            else:
-                nm_indices.append(j)
-
-        nm_idx = random.choice(nm_indices)
-        nm_label[i][nm_idx] = 1
+    labels = np.full(n_rows, cls_label, dtype=np.int16)
+    nm_labels = sample_nm_labels(labels, cls_num, rng=rng)
 
     #from reconstruct_img import reconstruct_spectrogram
     #reconstruct_spectrogram([features[0], features[1], features[2]], ["features0", "features1", "features2"])
 
-    dataset = [[features[i], m_label[i], nm_label[i]] for i in range(len(m_label))]
-    return dataset
+    return features, labels, nm_labels
+
+
+def file_vector_rows(file_name, frames=5, hop_length=512):
+    """
+    number of vectors com.file_to_vector_array() makes of a file, from its wav header.
+
+    return : int or None
+        None when the header cannot be read
+    """
+    try:
+        header = com.wav_header(file_name)
+    except (OSError, ValueError):
+        return None
+    # centered STFT frames, then one vector per window of frames frames
+    return max(0, header["n_samples"] // hop_length + 1 - frames + 1)
+
+
+def sample_nm_labels(labels, cls_num, rng=None):
+    """
+    pick a non match label for every row uniformly from the classes other than its match label.
+
+    labels : numpy.array( int )
+        match class index of every row
+    cls_num : int
+        number of classes
+    rng : numpy.random.RandomState ( default = None )
+        random generator, the global numpy generator when it is None
+
+    return : numpy.array( int )
+        non match class index of every row
+    """
+    if rng is None:
+        rng = np.random
+    # a shift of 1 .. cls_num-1 never lands on the match label and reaches every other class
+    shift = rng.randint(1, cls_num, size=len(labels))
+    return ((labels + shift) % cls_num).astype(labels.dtype)
+
+
+def generate_dataset(target_dir,
+                     machine_id_list,
+                     cache=None,
+                     memmap_path=None,
+                     nm_sampling="dataset",
+                     seed=None,
+                     store_directory=None,
+                     shard_rows=16384,
+                     max_files=0):
+    """
+    extract the training data of every machine ID into one columnar dataset.
+
+    target_dir : str
+        base directory path of the dev_data or eval_data
+    machine_id_list : list [ str ]
+        machine IDs, the position in the list is the class index
+    cache : FeatureCache ( default = None )
+        on-disk log mel cache
+    memmap_path : str ( default = None )
+        when given, the feature matrix is a numpy.memmap backed by this file
+    nm_sampling : str ( default = "dataset" )
+        "dataset" draws the non match labels once for the whole dataset,
+        "batch" draws them for every batch when it is served
+    seed : int ( default = None )
+        seed of the file order and of the non match label generator,
+        with a seed the rows of the dataset are the same in every run
+    store_directory : str ( default = None )
+        when given, the features are written once to a sharded FeatureStore in this
+        directory (or read from it when it is up to date), memmap_path is then ignored
+    shard_rows : int ( default = 16384 )
+        number of rows per shard of the FeatureStore
+    max_files : int ( default = 0 )
+        maximum number of training files per machine ID, 0 uses all of them
+
+    return : MelDataset
+    """
+    feature_param = param["feature"]["idcae"]
+    dims = feature_param["n_mels"] * feature_param["frames"]
+    file_rng = random.Random(seed)
+    file_lists = [file_list_generator(target_dir, machine_id, rng=file_rng, max_files=max_files)
+                  for machine_id in machine_id_list]
+    rng = np.random.RandomState(seed)
+
+    if store_directory:
+        store = build_feature_store(store_directory,
+                                    file_lists,
+                                    shard_rows=shard_rows,
+                                    cache=cache,
+                                    n_jobs=param["extraction"]["n_jobs"],
+                                    chunksize=param["extraction"]["chunksize"],
+                                    n_mels=feature_param["n_mels"],
+                                    frames=feature_param["frames"],
+                                    n_fft=feature_param["n_fft"],
+                                    hop_length=feature_param["hop_length"],
+                                    power=feature_param["power"])
+        labels = store.labels()
+        if nm_sampling == "dataset":
+            return MelDataset(store, labels, sample_nm_labels(labels, len(machine_id_list), rng=rng))
+        return MelDataset(store, labels, class_num=len(machine_id_list), rng=rng)
+
+    # the size of every file is known from its wav header, the other files are
+    # assumed to be as long as the first one (list_to_vector_array() raises on overflow)
+    file_rows = [file_vector_rows(file_name, frames=feature_param["frames"], hop_length=feature_param["hop_length"])
+                 for files in file_lists for file_name in files]
+    if None in file_rows:
+        rows_per_file = com.file_to_vector_array(file_lists[0][0],
+                                                 n_mels=feature_param["n_mels"],
+                                                 frames=feature_param["frames"],
+                                                 n_fft=feature_param["n_fft"],
+                                                 hop_length=feature_param["hop_length"],
+                                                 power=feature_param["power"],
+                                                 cache=cache).shape[0]
+        file_rows = [rows_per_file if rows is None else rows for rows in file_rows]
+    n_rows = sum(file_rows)
+    if memmap_path:
+        os.makedirs(os.path.dirname(os.path.abspath(memmap_path)), exist_ok=True)
+        features = np.memmap(memmap_path, dtype=np.float32, mode="w+", shape=(n_rows, dims))
+    else:
+        features = np.empty((n_rows, dims), dtype=np.float32)
+    labels = np.empty(n_rows, dtype=np.int16)
+    nm_labels = np.empty(n_rows, dtype=np.int16) if nm_sampling == "dataset" else None
+
+    row = 0
+    for i, files in enumerate(file_lists):
+        _, sub_labels, sub_nm_labels = list_to_vector_array(files,
+                                                            cls_label=i,
+                                                            cls_num=len(machine_id_list),
+                                                            msg="generate train_dataset",
+                                                            n_mels=feature_param["n_mels"],
+                                                            frames=feature_param["frames"],
+                                                            n_fft=feature_param["n_fft"],
+                                                            hop_length=feature_param["hop_length"],
+                                                            power=feature_param["power"],
+                                                            cache=cache,
+                                                            n_jobs=param["extraction"]["n_jobs"],
+                                                            chunksize=param["extraction"]["chunksize"],
+                                                            out=features[row:],
+                                                            rng=rng)
+        labels[row: row + len(sub_labels)] = sub_labels
+        if nm_labels is not None:
+            nm_labels[row: row + len(sub_labels)] = sub_nm_labels
+        row += len(sub_labels)
+
+    if nm_labels is None:
+        return MelDataset(features[:row], labels[:row], class_num=len(machine_id_list), rng=rng)
+    return MelDataset(features[:row], labels[:row], nm_labels[:row])
         
 '''
 def file_list_generator(target_dir,
@@ -190,11 +361,57 @@ def file_list_generator(target_dir,
     return files
 '''
 
+def encode_dataset(encoder, dataset, batch_size, device):
+    """
+    run the frozen encoder once over every row of the dataset.
+
+    encoder : Encoder
+        trained encoder, it is switched to eval mode
+    dataset : MelDataset
+    batch_size : int
+    device : torch.device
+
+    return : numpy.array( float32 )
+        latent of every row, shape = (n_rows, latent_dim)
+    """
+    import torch
+
+    latents = None
+    encoder.eval()
+    with torch.no_grad():
+        for start in range(0, len(dataset), batch_size):
+            feature_batch = np.ascontiguousarray(dataset.features[start: start + batch_size], dtype=np.float32)
+            latent, _ = encoder(torch.from_numpy(feature_batch).to(device, dtype=torch.float32))
+            if latents is None:
+                latents = np.empty((len(dataset), latent.shape[1]), dtype=np.float32)
+            latents[start: start + latent.shape[0]] = latent.cpu().numpy()
+    return latents
+
+
+def early_stopping(config):
+    """
+    config : dict
+        one phase of fit.idcae.early_stopping in baseline.yaml
+
+    return : EarlyStopping or None
+        None when early stopping is disabled for the phase
+    """
+    from pytorch_model import EarlyStopping
+
+    if not config.get("enabled", False):
+        return None
+    return EarlyStopping(patience=int(config["patience"]),
+                         min_delta=float(config["min_delta"]),
+                         restore_best_weights=config["restore_best_weights"])
+
+
 def file_list_generator(target_dir,
                              id_name,
                              dir_name="train",
                              prefix_normal="normal",
-                             ext="wav"):
+                             ext="wav",
+                             rng=None,
+                             max_files=0):
     """
     target_dir : str
         base directory path of the dev_data or eval_data
@@ -206,27 +423,32 @@ def file_list_generator(target_dir,
         normal directory name
     ext : str (default="wav")
         file extension of audio files
+    rng : random.Random (default=None)
+        generator of the file order, None uses the global one
+    max_files : int (default=0)
+        number of files kept after shuffling, 0 keeps all of them
 
     """
     com.logger.info("target_dir : {}".format(target_dir+"_"+id_name))
 
     # development
     #if mode:
-    files = sorted(
-        glob.glob("{dir}/{dir_name}/{prefix_normal}_{id_name}*.{ext}".format(dir=target_dir,
-                                                                                dir_name=dir_name,
-                                                                                prefix_normal=prefix_normal,
-                                                                                id_name=id_name,
-                                                                                ext=ext)))
+    files = indexed_files(target_dir, dir_name, param.get("dataset_index"), machine_id=id_name, condition=prefix_normal) if ext == "wav" else None
+    if files is None:
+        files = sorted(
+            glob.glob("{dir}/{dir_name}/{prefix_normal}_{id_name}*.{ext}".format(dir=target_dir,
+                                                                                    dir_name=dir_name,
+                                                                                    prefix_normal=prefix_normal,
+                                                                                    id_name=id_name,
+                                                                                    ext=ext)))
 
     
-    random.shuffle(files)
+    (rng or random).shuffle(files)
     '''
     control number of training files
     '''
-    # files = files[:600]
-    files = files[:300]
-    #files = files[:100]
+    if max_files > 0:
+        files = files[:max_files]
 
     com.logger.info("train_file  num : {num}".format(num=len(files)))
     if len(files) == 0:
@@ -237,357 +459,596 @@ def file_list_generator(target_dir,
 ########################################################################
 
 
-########################################################################
-# main 00_train.py
-########################################################################
-if __name__ == "__main__":
-    # check mode
-    # "development": mode == True
-    # "evaluation": mode == False
-    mode = com.command_line_chk()
-    if mode is None:
-        sys.exit(-1)
-        
-    # make output directory
-    os.makedirs(param["model_directory"]["idcae"], exist_ok=True)
+def train_machine(target_dir, device, feature_cache=None, num_workers=0):
+    """
+    train the encoder and the decoder of one machine type.
 
-    # initialize the visualizer
-    visualizer = visualizer()
+    target_dir : str
+        base directory path of the machine type in dev_data or eval_data
+    device : torch.device
+    feature_cache : FeatureCache ( default = None )
+        on-disk log mel cache
+    num_workers : int ( default = 0 )
+        number of batch prefetch threads, see BatchLoader
+
+    return : str
+        "trained", or "skipped" when both models already exist
+    """
+    machine_type = os.path.split(target_dir)[1]
 
-    # load base_directory list
-    dirs = com.select_dirs(param=param, mode=mode)
+    print("\n===========================")
+    print("{dirname}".format(dirname=target_dir))
+    #print("[{idx}/{total}] {dirname}".format(dirname=target_dir, idx=idx+1, total=len(dirs)))
 
-    machine_list = []
-    for dir in dirs:
-        machine = os.path.split(dir)[1]
-        machine_list.append(machine)
+    # set path
+    '''
+    model_file_path change to .pt
+    '''
+    
+    encoder_file_path = "{model}/encoder_{machine_type}.pt".format(model=param["model_directory"]["idcae"],
+                                                                 machine_type=machine_type)
+    decoder_file_path = "{model}/decoder_{machine_type}.pt".format(model=param["model_directory"]["idcae"],
+                                                                 machine_type=machine_type)
 
-    print("Found machine types:")
-    for machine in machine_list:
-        print(machine)
+    history_img = "{model}/history_{machine_type}.png".format(model=param["model_directory"]["idcae"],
+                                                              machine_type=machine_type)
 
-    print()
-    print("Which machine model would you like to train")
-    target_machine = input()
+    if os.path.exists(encoder_file_path) and os.path.exists(decoder_file_path):
+        com.logger.info("model exists")
+        return "skipped"
+    
+    '''
+    For tensorboard
+    '''
+    writer = SummaryWriter(comment="_"+machine_type)
+    # generate dataset
+    print("============== DATASET_GENERATOR ==============")
+
+    machine_id_list = com.get_machine_id_list(target_dir, dir_name="train", index_param=param.get("dataset_index"))
+
+    memmap_path = None
+    if param["fit"]["idcae"].get("memmap_directory"):
+        memmap_path = "{dir}/features_{machine_type}.dat".format(dir=param["fit"]["idcae"]["memmap_directory"],
+                                                                 machine_type=machine_type)
+    store_param = param.get("feature_store") or {}
+    store_directory = None
+    shard_rows = 0
+    # the in-RAM matrix keeps the old cap of files per machine ID, the store is meant for all of them
+    max_files = int(param["fit"]["idcae"]["max_files"])
+    if store_param.get("enabled", False):
+        store_directory = "{dir}/{machine_type}".format(dir=store_param["directory"], machine_type=machine_type)
+        shard_rows = int(store_param["shard_rows"])
+        max_files = int(store_param.get("max_files", 0))
+        # the batches are gathered from memory-mapped shards, keep some of them in flight
+        num_workers = max(num_workers, int(store_param["prefetch_workers"]))
+    dataset = generate_dataset(target_dir,
+                               machine_id_list,
+                               cache=feature_cache,
+                               memmap_path=memmap_path,
+                               nm_sampling=param["fit"]["idcae"]["nm_sampling"],
+                               seed=param["fit"]["idcae"]["seed"],
+                               store_directory=store_directory,
+                               shard_rows=shard_rows,
+                               max_files=max_files)
+    
+    # train model
+    print("============== MODEL TRAINING ==============")
+    ########################################################################################
+    # pytorch
+    import torch.nn as nn
+    import torch
+    from pytorch_model import Encoder, Decoder, CustomLoss, condition_label
+    import json
+    # from get_Threshold import get_threshold
+    ########################################################################################
+
+    paramF = param["feature"]["idcae"]["frames"]
+    paramM = param["feature"]["idcae"]["n_mels"]
+    dim = paramF * paramM
+
+    encoder = Encoder(paramF=paramF, paramM=paramM, classNum=len(machine_id_list))
+    decoder = Decoder(paramF=paramF, paramM=paramM, classNum=len(machine_id_list))
+    encoder.float()
+    decoder.float()
+    
+    '''
+    1. Dataset input to model
+    2. Define optimizer and loss
+    3. Validation
+    '''  
+    epochs = int(param["fit"]["idcae"]["epochs"])
+    batch_size = int(param["fit"]["idcae"]["batch_size"])
+    validate_every = max(int(param["fit"]["idcae"]["validate_every"]), 1)
+
+    #scheduler = lr_sched.StepLR(optimizer=optimizer, step_size=5, gamma=0.95)
+    
+    val_split = param["fit"]["idcae"]["validation_split"]
+    val_size = int(len(dataset) * val_split)
+    train_size = len(dataset) - val_size
 
-    # loop of the base directory
-    for target_dir in dirs:
-        machine_type = os.path.split(target_dir)[1]
-        if machine_type != target_machine:
-            continue
+    '''
+    Train batches contain: feature, match label, non match label
+    '''
+    indices = np.random.permutation(len(dataset))
+    train_indices, val_indices = indices[:train_size], indices[train_size:]
+
+    # resume from the latest checkpoint of an interrupted run, with its split;
+    # the split indices only address the same rows when the dataset was generated with the same seed
+    seed = param["fit"]["idcae"]["seed"]
+    checkpoint_path = "{model}/checkpoint_{machine_type}.pt".format(model=param["model_directory"]["idcae"],
+                                                                    machine_type=machine_type)
+    checkpoint_every = int(param["fit"]["idcae"]["checkpoint_every"])
+    checkpoint = load_checkpoint(checkpoint_path, device) if checkpoint_every > 0 else None
+    if checkpoint is not None and (seed is None
+                                   or checkpoint["seed"] != seed
+                                   or len(checkpoint["train_indices"]) + len(checkpoint["val_indices"]) != len(dataset)):
+        com.logger.warning("checkpoint does not match the dataset, starting over : {}".format(checkpoint_path))
+        checkpoint = None
+    if checkpoint is not None:
+        train_indices, val_indices = checkpoint["train_indices"], checkpoint["val_indices"]
+        dataset.rng.set_state(checkpoint["dataset_rng"])
+    shuffle_shards = int(store_param.get("shuffle_shards", 4))
+    train_batches = BatchLoader(dataset, train_indices, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                                shard_rows=shard_rows, shuffle_shards=shuffle_shards)
+    val_batches = BatchLoader(dataset, val_indices, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                              shard_rows=shard_rows, shuffle_shards=shuffle_shards)
 
-        print("\n===========================")
-        print("{dirname}".format(dirname=target_dir))
-        #print("[{idx}/{total}] {dirname}".format(dirname=target_dir, idx=idx+1, total=len(dirs)))
+    
+    '''
+    Encoder Training
 
-        # set path
-        '''
-        model_file_path change to .pt
-        '''
-        
-        encoder_file_path = "{model}/encoder_{machine_type}.pt".format(model=param["model_directory"]["idcae"],
-                                                                     machine_type=machine_type)
-        decoder_file_path = "{model}/decoder_{machine_type}.pt".format(model=param["model_directory"]["idcae"],
-                                                                     machine_type=machine_type)
+    Encoder outputs: latent, output of classifier
+    In encoder training stage, we will use the output of classifier 
+    Train the encoder with Cross Entropy function as loss function
+    '''
+    en_train_loss_list = []
+    en_val_loss_list = []
+
+    lr = param["train_param"][machine_type]["encoder"]["lr"]
+
+    en_loss_fn = nn.CrossEntropyLoss(reduction='sum')
+    en_optim = torch.optim.SGD(encoder.parameters(), lr, weight_decay=1e-7)
+    encoder = encoder.to(device=device, dtype=torch.float32)
+    if os.path.exists(encoder_file_path):
+        print("Encoder exists...")
+        encoder.load_state_dict(torch.load(encoder_file_path, map_location=device))
+    else:
+        print("Start Encoder training...")
+        en_stopping = early_stopping(param["fit"]["idcae"]["early_stopping"]["encoder"])
+        start_epoch = 1
+        if checkpoint is not None and checkpoint["phase"] == "encoder":
+            encoder.load_state_dict(checkpoint["encoder"])
+            en_optim.load_state_dict(checkpoint["en_optim"])
+            if en_stopping is not None and checkpoint["en_stopping"] is not None:
+                en_stopping.load_state_dict(checkpoint["en_stopping"])
+            en_train_loss_list, en_val_loss_list = checkpoint["en_loss"]
+            start_epoch = checkpoint["epoch"] + 1
+            set_rng_state(checkpoint["rng"])
+            com.logger.info("resume encoder training at epoch {}".format(start_epoch))
+        for epoch in range(start_epoch, epochs+1):
+            # losses are summed on the device and read back once per epoch
+            train_loss = torch.zeros((), device=device)
+            val_loss = torch.zeros((), device=device)
+            print("Epoch: {}".format(epoch))
 
-        history_img = "{model}/history_{machine_type}.png".format(model=param["model_directory"]["idcae"],
-                                                                  machine_type=machine_type)
+            encoder.train()
+            for feature_batch, label_batch, _ in tqdm(train_batches):
+                en_optim.zero_grad()
 
-        if os.path.exists(encoder_file_path) and os.path.exists(decoder_file_path):
-            com.logger.info("model exists")
-            continue
-        
-        '''
-        For tensorboard
-        '''
-        writer = SummaryWriter(comment="_"+machine_type)
-        # generate dataset
-        print("============== DATASET_GENERATOR ==============")
-
-        machine_id_list = com.get_machine_id_list(target_dir, dir_name="train")
-
-        for i in range(len(machine_id_list)):
-            files = file_list_generator(target_dir, machine_id_list[i])
-
-            sub_dataset = list_to_vector_array(files,
-                                        cls_label=i,
-                                        cls_num=len(machine_id_list),
-                                        msg="generate train_dataset",
-                                        n_mels=param["feature"]["idcae"]["n_mels"],
-                                        frames=param["feature"]["idcae"]["frames"],
-                                        n_fft=param["feature"]["idcae"]["n_fft"],
-                                        hop_length=param["feature"]["idcae"]["hop_length"],
-                                        power=param["feature"]["idcae"]["power"])
-
-
-            if i == 0:
-                dataset = sub_dataset
-                #del sub_dataset
-            else:
-                dataset = np.concatenate((dataset, sub_dataset), axis=0)
-                #del sub_dataset
-        
-        # train model
-        print("============== MODEL TRAINING ==============")
-        ########################################################################################
-        # pytorch
-        import torch.nn as nn
-        import torch
-        from torch.utils.data import random_split, DataLoader
-        from pytorch_model import Encoder, Decoder, CustomLoss
-        import json
-        # from get_Threshold import get_threshold
-        ########################################################################################
-
-        paramF = param["feature"]["idcae"]["frames"]
-        paramM = param["feature"]["idcae"]["n_mels"]
-        dim = paramF * paramM
-
-        encoder = Encoder(paramF=paramF, paramM=paramM, classNum=len(machine_id_list))
-        decoder = Decoder(paramF=paramF, paramM=paramM, classNum=len(machine_id_list))
-        encoder.float()
-        decoder.float()
-        
-        '''
-        1. Dataset input to model
-        2. Define optimizer and loss
-        3. Validation
-        '''  
-        epochs = int(param["fit"]["idcae"]["epochs"])
-        batch_size = int(param["fit"]["idcae"]["batch_size"])
-
-        #scheduler = lr_sched.StepLR(optimizer=optimizer, step_size=5, gamma=0.95)
-        
-        val_split = param["fit"]["idcae"]["validation_split"]
-        val_size = int(len(dataset) * val_split)
-        train_size = len(dataset) - val_size
-
-        '''
-        Train batches contain: feature, match label, non match label
-        '''
-        train_dataset, valid_dataset = random_split(dataset, [train_size, val_size])
-        train_batches = DataLoader(dataset=MelDataLoader(train_dataset), batch_size=batch_size, shuffle=True)
-        val_batches = DataLoader(dataset=MelDataLoader(valid_dataset), batch_size=batch_size, shuffle=True)
-
-        device = torch.device('cuda')
-        
-        '''
-        Encoder Training
-
-        Encoder outputs: latent, output of classifier
-        In encoder training stage, we will use the output of classifier 
-        Train the encoder with Cross Entropy function as loss function
-        '''
-        en_train_loss_list = []
-        en_val_loss_list = []
-
-        lr = param["train_param"][machine_type]["encoder"]["lr"]
-
-        en_loss_fn = nn.CrossEntropyLoss(reduction='sum')
-        en_optim = torch.optim.SGD(encoder.parameters(), lr, weight_decay=1e-7)
-        encoder = encoder.to(device=device, dtype=torch.float32)
-        if os.path.exists(encoder_file_path):
-            print("Encoder exists...")
-            encoder.load_state_dict(torch.load(encoder_file_path))
-        else:
-            print("Start Encoder training...")
-            for epoch in range(1, epochs+1):
-                train_loss = 0.0
-                val_loss = 0.0
-                print("Epoch: {}".format(epoch))
+                feature_batch = feature_batch.to(device, non_blocking=True, dtype=torch.float32)
+                label_batch = label_batch.to(device, non_blocking=True)
 
-                encoder.train()
-                for feature_batch, label_batch, _ in tqdm(train_batches):
-                    en_optim.zero_grad()
+                _ , cls_output = encoder(feature_batch)
+                cls_output = cls_output.to(device=device, non_blocking=True, dtype=torch.float32)
+                
+                loss = en_loss_fn(cls_output, label_batch)
+                loss.backward()
+                en_optim.step()
 
-                    feature_batch = feature_batch.to(device, non_blocking=True, dtype=torch.float32)
-                    label_batch = label_batch.to(device, non_blocking=True, dtype=torch.float32)
+                train_loss += loss.detach()
+            train_loss = train_loss.item() / len(train_batches)
+            en_train_loss_list.append(train_loss)
 
-                    _ , cls_output = encoder(feature_batch)
-                    cls_output = cls_output.to(device=device, non_blocking=True, dtype=torch.float32)
+            # validate every validate_every epochs and after the last epoch
+            validate = epoch % validate_every == 0 or epoch == epochs
+            writer.add_scalar('en_train/loss', train_loss, epoch)
+            if validate:
+                encoder.eval()
+                with torch.no_grad():
+                    for feature_batch, label_batch, _ in tqdm(val_batches):
 
-                    label_batch = torch.argmax(label_batch, dim=1)
-                    
-                    loss = en_loss_fn(cls_output, label_batch.long())
-                    loss.backward()
-                    en_optim.step()
+                        feature_batch = feature_batch.to(device, non_blocking=True, dtype=torch.float32)
+                        label_batch = label_batch.to(device, non_blocking=True)
 
-                    train_loss += loss.item()
-                    del feature_batch, label_batch, cls_output
-                    gc.collect()
-                train_loss /= len(train_batches)
-                en_train_loss_list.append(train_loss)
+                        _ , cls_output = encoder(feature_batch)
+                        cls_output = cls_output.to(device=device, non_blocking=True, dtype=torch.float32)
 
-                encoder.eval()
-                for feature_batch, label_batch, _ in tqdm(val_batches):
+                        val_loss += en_loss_fn(cls_output, label_batch)
 
-                    feature_batch = feature_batch.to(device, non_blocking=True, dtype=torch.float32)
-                    label_batch = label_batch.to(device, non_blocking=True, dtype=torch.float32)
-                    
-                    _ , cls_output = encoder(feature_batch)
-                    cls_output = cls_output.to(device=device, non_blocking=True, dtype=torch.float32)
-                    label_batch = torch.argmax(label_batch, dim=1)
-                    
-                    loss = en_loss_fn(cls_output, label_batch.long())
-                    val_loss += loss.item()
-
-                    del feature_batch, label_batch, cls_output
-                    gc.collect()  
-                
-                val_loss /= len(val_batches)
+                val_loss = val_loss.item() / len(val_batches)
                 en_val_loss_list.append(val_loss)
 
-                writer.add_scalar('en_train/loss', train_loss, epoch)
                 writer.add_scalar('en_val/loss', val_loss, epoch)
                 writer.add_scalars('en_comp/loss', {'train': train_loss, 'validation': val_loss}, epoch)
 
-            torch.save(encoder.state_dict(), encoder_file_path)
-        '''
-        Decoder Training
+                if en_stopping is not None and en_stopping.step(encoder, val_loss, epoch):
+                    com.logger.info("encoder early stopping at epoch {epoch}, best epoch {best}".format(
+                        epoch=epoch, best=en_stopping.best_epoch))
+                    break
+
+            if checkpoint_every > 0 and epoch % checkpoint_every == 0 and epoch < epochs:
+                save_checkpoint(checkpoint_path,
+                                phase="encoder",
+                                epoch=epoch,
+                                encoder=encoder.state_dict(),
+                                en_optim=en_optim.state_dict(),
+                                en_stopping=en_stopping.state_dict() if en_stopping is not None else None,
+                                en_loss=(en_train_loss_list, en_val_loss_list),
+                                seed=seed,
+                                train_indices=train_indices,
+                                val_indices=val_indices,
+                                dataset_rng=dataset.rng.get_state())
+
+        if en_stopping is not None:
+            en_stopping.restore(encoder)
+        atomic_save(encoder.state_dict(), encoder_file_path)
+    '''
+    Decoder Training
 
-        Decoder output match output (latent conditioned on match label) 
-        and non match output (latent conditioned on non match label)
+    Decoder output match output (latent conditioned on match label) 
+    and non match output (latent conditioned on non match label)
 
-        In this stage, we send pre-processed audio data to encoder, and take the latent as input of decoder
-        The decoder contains the conditioning layer, with label vector as input(match and non match)
+    In this stage, we send pre-processed audio data to encoder, and take the latent as input of decoder
+    The decoder contains the conditioning layer, with label vector as input(match and non match)
 
-        Before sending the vector to that layer, first change 0 to -1 and then send the vector to the layer
-        For example, if the label vector is [1, 0, 0, 0], then the input label vector is [1, -1, -1, -1]
+    Before sending the vector to that layer, first change 0 to -1 and then send the vector to the layer
+    For example, if the label vector is [1, 0, 0, 0], then the input label vector is [1, -1, -1, -1]
 
-        Calculate MSE Loss between match output and input data and between non match output and constant vector C
-        Finally, the loss is alpha * (match loss) + (1-alpha) * (non match loss)
-        '''
-        de_train_loss_list = []
-        de_val_loss_list = []
+    Calculate MSE Loss between match output and input data and between non match output and constant vector C
+    Finally, the loss is alpha * (match loss) + (1-alpha) * (non match loss)
+    '''
+    de_train_loss_list = []
+    de_val_loss_list = []
+    de_val_epochs = []
 
-        decoder = decoder.to(device=device, dtype=torch.float32)  
-        de_loss_fn = nn.MSELoss()
+    decoder = decoder.to(device=device, dtype=torch.float32)  
+    de_loss_fn = nn.MSELoss()
 
-        lr = param["train_param"][machine_type]["decoder"]["lr"]
-        gamma = lr = param["train_param"][machine_type]["decoder"]["gamma"]
+    lr = param["train_param"][machine_type]["decoder"]["lr"]
+    gamma = lr = param["train_param"][machine_type]["decoder"]["gamma"]
 
-        de_optim = torch.optim.SGD(decoder.parameters(), lr=lr, weight_decay=1e-7)
-        scheduler = lr_sched.StepLR(optimizer=de_optim, step_size=5, gamma=gamma)
-        alpha = 0.75
-        C = 5
+    de_optim = torch.optim.SGD(decoder.parameters(), lr=lr, weight_decay=1e-7)
+    scheduler = lr_sched.StepLR(optimizer=de_optim, step_size=5, gamma=gamma)
+    alpha = 0.75
+    C = 5
 
-        nm_input = np.empty(shape=(batch_size, dim))
-        nm_input.fill(C)
-        nm_input = torch.Tensor(nm_input).to(device=device, non_blocking=True, dtype=torch.float32)
-        
+    nm_input = np.empty(shape=(batch_size, dim))
+    nm_input.fill(C)
+    nm_input = torch.Tensor(nm_input).to(device=device, non_blocking=True, dtype=torch.float32)
+    
 
-        print("Start Decoder training...")
-        encoder.eval()
-        m_lost_list = np.array([])
-        nm_lost_list = np.array([])
-        m_output_toimg, nm_output_toimg = None, None
-        for epoch in range(1, epochs+1):
-            train_loss = 0.0
-            val_loss = 0.0
-            ml = 0.0
-            nml = 0.0
-            bl = 0.0
-            print("Epoch: {}".format(epoch))
-            nm_loss, m_loss = 0, 0
-            decoder.train()
-            for feature_batch, label_batch, nm_label_batch in tqdm(train_batches):
-                de_optim.zero_grad()
-                
-                feature_batch = feature_batch.to(device, non_blocking=True, dtype=torch.float32)
-                label_batch = label_batch.to(device, non_blocking=True, dtype=torch.float32)
-                nm_label_batch = nm_label_batch.to(device, non_blocking=True, dtype=torch.float32)
-                
+    print("Start Decoder training...")
+    encoder.eval()
+
+    # the encoder is frozen from here on, so its latents can be computed once
+    cache_latents = param["fit"]["idcae"]["cache_latents"]
+    if cache_latents:
+        dataset.set_latents(encode_dataset(encoder, dataset, batch_size, device))
+
+    fused_decoder = param["fit"]["idcae"]["fused_decoder"]
+    de_stopping = early_stopping(param["fit"]["idcae"]["early_stopping"]["decoder"])
+
+    # the last batch outputs and the per batch losses of the last epoch are only kept on request,
+    # the per batch losses go to buffers allocated once instead of growing arrays and are
+    # overwritten every epoch, so they hold the last epoch also when training stops early
+    keep_samples = param["fit"]["idcae"]["keep_samples"]
+    if keep_samples:
+        m_loss_buffer = torch.zeros(len(train_batches), device=device)
+        nm_loss_buffer = torch.zeros(len(train_batches), device=device)
+        m_output_sample, nm_output_sample = None, None
+
+    start_epoch = 1
+    if checkpoint is not None and checkpoint["phase"] == "decoder":
+        decoder.load_state_dict(checkpoint["decoder"])
+        de_optim.load_state_dict(checkpoint["de_optim"])
+        scheduler.load_state_dict(checkpoint["scheduler"])
+        if de_stopping is not None and checkpoint["de_stopping"] is not None:
+            de_stopping.load_state_dict(checkpoint["de_stopping"])
+        de_train_loss_list, de_val_loss_list, de_val_epochs = checkpoint["de_loss"]
+        start_epoch = checkpoint["epoch"] + 1
+        set_rng_state(checkpoint["rng"])
+        com.logger.info("resume decoder training at epoch {}".format(start_epoch))
+
+    for epoch in range(start_epoch, epochs+1):
+        # losses are summed on the device and read back once per epoch,
+        # val_sums holds the (total, match, non match, non match to input) validation losses
+        train_loss = torch.zeros((), device=device)
+        val_sums = torch.zeros(4, device=device)
+        print("Epoch: {}".format(epoch))
+        decoder.train()
+        for step, batch in enumerate(tqdm(train_batches)):
+            de_optim.zero_grad()
+            
+            feature_batch, label_batch, nm_label_batch = batch[:3]
+            feature_batch = feature_batch.to(device, non_blocking=True, dtype=torch.float32)
+            label_batch = label_batch.to(device, non_blocking=True)
+            nm_label_batch = nm_label_batch.to(device, non_blocking=True)
+            
+            if cache_latents:
+                latent = batch[3].to(device, non_blocking=True, dtype=torch.float32)
+            else:
                 latent, _ = encoder(feature_batch)
 
-                label_batch = 2 * (label_batch - 0.5)
-                nm_label_batch = 2 * (nm_label_batch - 0.5)
-                
-                m_output, nm_output = decoder(latent, label_batch, nm_label_batch)
-                m_output = m_output.to(device, non_blocking=True, dtype=torch.float32)
-                nm_output = nm_output.to(device, non_blocking=True, dtype=torch.float32)
-
-                m_loss = de_loss_fn(m_output, feature_batch)
-                nm_to_m = de_loss_fn(nm_output, feature_batch)
-                if nm_output.shape[0] < batch_size:
-                    nm_loss = de_loss_fn(nm_output, nm_input[:nm_output.shape[0]])
-                else:
-                    nm_loss = de_loss_fn(nm_output, nm_input)
-
-                # m_loss, nm_loss = de_loss_fn(m_output, nm_output, feature_batch)
-                
-                loss = alpha * m_loss + (1-alpha) * nm_loss
+            label_batch = condition_label(label_batch, len(machine_id_list))
+            nm_label_batch = condition_label(nm_label_batch, len(machine_id_list))
+            
+            m_output, nm_output = decoder(latent, label_batch, nm_label_batch, fused=fused_decoder)
+            m_output = m_output.to(device, non_blocking=True, dtype=torch.float32)
+            nm_output = nm_output.to(device, non_blocking=True, dtype=torch.float32)
 
-                loss.backward()
-                de_optim.step()
-                train_loss += loss.item()
-                m_output_toimg = m_output.cpu().detach().numpy()
-                nm_output_toimg = nm_output.cpu().detach().numpy()
-                if epoch == epochs:
-                    m_lost_list = np.concatenate((m_lost_list, m_loss.cpu().detach().numpy()), axis=None)
-                    nm_lost_list = np.concatenate((nm_lost_list, nm_to_m.cpu().detach().numpy()), axis=None)   
-                del m_output, nm_output, feature_batch, label_batch, nm_label_batch
-                gc.collect() 
-            train_loss /= len(train_batches)
-            # print("loss m & nm:", m_loss.cpu().detach().numpy(), nm_loss.cpu().detach().numpy(), train_loss)
-
-            de_train_loss_list.append(train_loss)
+            m_loss = de_loss_fn(m_output, feature_batch)
+            if nm_output.shape[0] < batch_size:
+                nm_loss = de_loss_fn(nm_output, nm_input[:nm_output.shape[0]])
+            else:
+                nm_loss = de_loss_fn(nm_output, nm_input)
 
+            # m_loss, nm_loss = de_loss_fn(m_output, nm_output, feature_batch)
+            
+            loss = alpha * m_loss + (1-alpha) * nm_loss
+
+            loss.backward()
+            de_optim.step()
+            train_loss += loss.detach()
+            if keep_samples:
+                m_loss_buffer[step] = m_loss.detach()
+                nm_loss_buffer[step] = de_loss_fn(nm_output.detach(), feature_batch)
+                m_output_sample, nm_output_sample = m_output.detach(), nm_output.detach()
+        train_loss = train_loss.item() / len(train_batches)
+        # print("loss m & nm:", m_loss.cpu().detach().numpy(), nm_loss.cpu().detach().numpy(), train_loss)
+
+        de_train_loss_list.append(train_loss)
+
+        # validate every validate_every epochs and after the last epoch
+        validate = epoch % validate_every == 0 or epoch == epochs
+        writer.add_scalar('de_train/loss', train_loss, epoch)
+        if validate:
             decoder.eval()
 
-            for feature_batch, label_batch, nm_label_batch in tqdm(val_batches):
-                
-                feature_batch = feature_batch.to(device, non_blocking=True, dtype=torch.float32)
-                label_batch = label_batch.to(device, non_blocking=True, dtype=torch.float32)
-                nm_label_batch = nm_label_batch.to(device, non_blocking=True, dtype=torch.float32)
-                
-                latent, _ = encoder(feature_batch)
+            with torch.no_grad():
+                for batch in tqdm(val_batches):
+
+                    feature_batch, label_batch, nm_label_batch = batch[:3]
+                    feature_batch = feature_batch.to(device, non_blocking=True, dtype=torch.float32)
+                    label_batch = label_batch.to(device, non_blocking=True)
+                    nm_label_batch = nm_label_batch.to(device, non_blocking=True)
 
-                label_batch = 2 * (label_batch - 0.5)
-                nm_label_batch = 2 * (nm_label_batch - 0.5)
+                    if cache_latents:
+                        latent = batch[3].to(device, non_blocking=True, dtype=torch.float32)
+                    else:
+                        latent, _ = encoder(feature_batch)
 
-                m_output, nm_output = decoder(latent, label_batch, nm_label_batch)
-                m_output = m_output.to(device, non_blocking=True, dtype=torch.float32)
-                nm_output = nm_output.to(device, non_blocking=True, dtype=torch.float32)
+                    label_batch = condition_label(label_batch, len(machine_id_list))
+                    nm_label_batch = condition_label(nm_label_batch, len(machine_id_list))
 
-                m_loss = de_loss_fn(m_output, feature_batch)
-                if nm_output.shape[0] < batch_size:
-                    nm_loss = de_loss_fn(nm_output, nm_input[:nm_output.shape[0]])
-                else:
-                    nm_loss = de_loss_fn(nm_output, nm_input)
+                    m_output, nm_output = decoder(latent, label_batch, nm_label_batch, fused=fused_decoder)
+                    m_output = m_output.to(device, non_blocking=True, dtype=torch.float32)
+                    nm_output = nm_output.to(device, non_blocking=True, dtype=torch.float32)
 
-                bad_loss = de_loss_fn(nm_output, feature_batch)
-                bl += bad_loss.item()
+                    m_loss = de_loss_fn(m_output, feature_batch)
+                    if nm_output.shape[0] < batch_size:
+                        nm_loss = de_loss_fn(nm_output, nm_input[:nm_output.shape[0]])
+                    else:
+                        nm_loss = de_loss_fn(nm_output, nm_input)
 
-                loss = alpha * m_loss + (1-alpha) * nm_loss
-                val_loss += loss.item()
-                ml += m_loss.item()
-                nml += nm_loss.item()
-                del m_output, nm_output, feature_batch, label_batch, nm_label_batch
-                gc.collect()
-            val_loss /= len(val_batches)
-            # print("val loss m & nm:", m_loss.cpu().detach().numpy(), nm_loss.cpu().detach().numpy(), val_loss)
+                    bad_loss = de_loss_fn(nm_output, feature_batch)
 
-            ml /= len(val_batches)
-            nml /= len(val_batches)
-            bl /= len(val_batches)
+                    loss = alpha * m_loss + (1-alpha) * nm_loss
+                    val_sums += torch.stack((loss, m_loss, nm_loss, bad_loss))
+            val_loss, ml, nml, bl = (val_sums / len(val_batches)).tolist()
 
             de_val_loss_list.append(val_loss)
-            
-            writer.add_scalar('de_train/loss', train_loss, epoch)
+            de_val_epochs.append(epoch)
+
             writer.add_scalar('de_val/loss', val_loss, epoch)
             writer.add_scalars('de_comp/loss', {'train': train_loss, 'validation': val_loss}, epoch)
             writer.add_scalar('match loss', ml, epoch)
             writer.add_scalar('non match loss', nml, epoch)
             writer.add_scalar('bad loss', bl, epoch)
 
-            scheduler.step()
-        visualizer.loss_plot(de_train_loss_list, de_val_loss_list)
-        visualizer.save_figure(history_img)
+            if de_stopping is not None and de_stopping.step(decoder, val_loss, epoch):
+                com.logger.info("decoder early stopping at epoch {epoch}, best epoch {best}".format(
+                    epoch=epoch, best=de_stopping.best_epoch))
+                break
+
+        scheduler.step()
+
+        if checkpoint_every > 0 and epoch % checkpoint_every == 0 and epoch < epochs:
+            save_checkpoint(checkpoint_path,
+                            phase="decoder",
+                            epoch=epoch,
+                            decoder=decoder.state_dict(),
+                            de_optim=de_optim.state_dict(),
+                            scheduler=scheduler.state_dict(),
+                            de_stopping=de_stopping.state_dict() if de_stopping is not None else None,
+                            de_loss=(de_train_loss_list, de_val_loss_list, de_val_epochs),
+                            seed=seed,
+                            train_indices=train_indices,
+                            val_indices=val_indices,
+                            dataset_rng=dataset.rng.get_state())
+
+    if de_stopping is not None:
+        de_stopping.restore(decoder)
+    plot = visualizer()
+    plot.loss_plot(de_train_loss_list, de_val_loss_list, val_epochs=de_val_epochs)
+    plot.save_figure(history_img)
+
+    atomic_save(decoder.state_dict(), decoder_file_path)
+    # both models are saved, the run does not need to be resumed any more
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    if keep_samples:
+        sample_path = "{model}/samples_{machine_type}.npz".format(model=param["model_directory"]["idcae"],
+                                                                  machine_type=machine_type)
+        np.savez(sample_path,
+                 m_output=m_output_sample.cpu().numpy(),
+                 nm_output=nm_output_sample.cpu().numpy(),
+                 m_loss=m_loss_buffer.cpu().numpy(),
+                 nm_loss=nm_loss_buffer.cpu().numpy())
+        com.logger.info("save_samples -> {}".format(sample_path))
+
+    com.logger.info("save_model -> en: {en_path} de: {de_path}".format(en_path=encoder_file_path, de_path=decoder_file_path))
+
+    del dataset, train_batches, val_batches
+    gc.collect()
+    if memmap_path and os.path.exists(memmap_path):
+        os.remove(memmap_path)
+    return "trained"
+
+
+def train_job(target_dir, runtime, results):
+    """
+    entry point of a training process started by train_schedule().
+
+    target_dir : str
+        base directory path of the machine type
+    runtime : dict
+        runtime settings of this job (device and thread budget), see com.setup_runtime()
+    results : multiprocessing.Queue
+        receives (target_dir, status, wall time in seconds)
+    """
+    start = time.time()
+    try:
+        param["runtime"].update(runtime)
+        device = com.setup_runtime(param)
+        status = train_machine(target_dir,
+                               device,
+                               feature_cache=open_feature_cache(param),
+                               num_workers=int(param["runtime"]["num_workers"]))
+    except Exception:
+        com.logger.exception("training failed : {}".format(target_dir))
+        status = "failed"
+    results.put((target_dir, status, time.time() - start))
+
+
+def train_schedule(target_dirs, jobs=1, job_threads=0):
+    """
+    train several machine types, up to `jobs` of them concurrently in separate processes.
+
+    target_dirs : list [ str ]
+        base directory paths of the machine types
+    jobs : int ( default = 1 )
+        maximum number of concurrent training processes, 1 trains in this process one by one
+    job_threads : int ( default = 0 )
+        intra-op threads of every job, 0 shares the CPU cores evenly among concurrent jobs and
+        keeps runtime.intra_op_threads when the machine types are trained one by one
+
+    return : list [ (str, str, float) ]
+        machine type, status and wall time in seconds of every job, in the order of target_dirs
+    """
+    runtime = dict(param["runtime"])
+    if job_threads > 0:
+        runtime["intra_op_threads"] = job_threads
+    elif min(jobs, len(target_dirs)) > 1:
+        runtime["intra_op_threads"] = max((os.cpu_count() or 1) // min(jobs, len(target_dirs)), 1)
+
+    finished = {}
+    if jobs <= 1:
+        results = queue.Queue()
+        for target_dir in target_dirs:
+            train_job(target_dir, runtime, results)
+            target_dir, status, wall = results.get()
+            finished[target_dir] = (status, wall)
+    else:
+        # spawn, so that every job starts with a fresh torch (and CUDA) state
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        pending = list(target_dirs)
+        running = {}
+
+        def record(target_dir, status, wall):
+            # a reported status replaces the "failed" placeholder of a job recorded as dead before its result was read
+            job = running.pop(target_dir, None)
+            if job is not None:
+                job[0].join()
+            finished[target_dir] = (status, wall)
+
+        while pending or running:
+            while pending and len(running) < jobs:
+                target_dir = pending.pop(0)
+                process = context.Process(target=train_job, args=(target_dir, runtime, results))
+                process.start()
+                running[target_dir] = (process, time.time())
+                com.logger.info("start training : {}".format(target_dir))
+            try:
+                record(*results.get(timeout=1.0))
+            except queue.Empty:
+                dead = [target_dir for target_dir, (process, _) in running.items() if not process.is_alive()]
+                if not dead:
+                    continue
+                # a job may have reported and exited right after the timeout, read its result first
+                while True:
+                    try:
+                        record(*results.get_nowait())
+                    except queue.Empty:
+                        break
+                # a job that died without reporting (e.g. killed) is recorded as failed
+                for target_dir in dead:
+                    if target_dir in running:
+                        process, started = running.pop(target_dir)
+                        finished[target_dir] = ("failed", time.time() - started)
+
+    summary = []
+    for target_dir in target_dirs:
+        status, wall = finished[target_dir]
+        summary.append((os.path.split(target_dir)[1], status, wall))
+    return summary
+
+
+########################################################################
+# main 00_train.py
+########################################################################
+if __name__ == "__main__":
+    # check mode
+    # "development": mode == True
+    # "evaluation": mode == False
+    mode = com.command_line_chk(param)
+    if mode is None:
+        sys.exit(-1)
+        
+    # make output directory
+    os.makedirs(param["model_directory"]["idcae"], exist_ok=True)
+
+    # load base_directory list
+    dirs = com.select_dirs(param=param, mode=mode)
 
-        torch.save(decoder.state_dict(), decoder_file_path)
+    machine_list = []
+    for dir in dirs:
+        machine = os.path.split(dir)[1]
+        machine_list.append(machine)
 
-        com.logger.info("save_model -> en: {en_path} de: {de_path}".format(en_path=encoder_file_path, de_path=decoder_file_path))
+    print("Found machine types:")
+    for machine in machine_list:
+        print(machine)
 
-        del dataset, train_batches, val_batches
-        gc.collect()
-        time.sleep(30)
\ No newline at end of file
+    # select the machine types to train ("all" or a comma separated list)
+    target_dirs = com.select_machines(dirs, param["schedule"]["machines"])
+    print()
+    print("Train machine types: {}".format(", ".join(os.path.split(dir)[1] for dir in target_dirs)))
+
+    # train the selected machine types
+    summary = train_schedule(target_dirs,
+                             jobs=int(param["schedule"]["jobs"]),
+                             job_threads=int(param["schedule"]["job_threads"]))
+
+    # save the wall time of every machine type
+    summary_path = "{model}/train_summary.csv".format(model=param["model_directory"]["idcae"])
+    with open(summary_path, "w", newline="") as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(["machine_type", "status", "wall_time_sec"])
+        for machine_type, status, wall in summary:
+            writer.writerow([machine_type, status, "{:.1f}".format(wall)])
+            com.logger.info("{machine_type} : {status} in {wall:.1f} s".format(machine_type=machine_type,
+                                                                              status=status,
+                                                                              wall=wall))
+    com.logger.info("training summary -> {}".format(summary_path))
@@ -30,6 +30,13 @@ from sklearn import metrics
 # original lib
 import common as com
 from pytorch_model import *
+from feature_cache import open_feature_cache
+from dataset_index import indexed_files
+from scoring import standardize, anomaly_score, load_scorer
+from export import export_scorer, scorer_path, scorer_up_to_date
+from inference import InferenceEngine
+from score_ledger import ScoreLedger, model_fingerprint
+from score_table import ScoreTableWriter
 from torchsummary import summary
 from torch.utils.data import DataLoader
 import torch.nn as nn
@@ -112,19 +119,23 @@ def test_file_list_generator(target_dir,
 
     # development
     if mode:
-        normal_files = sorted(
-            glob.glob("{dir}/{dir_name}/{prefix_normal}_{id_name}*.{ext}".format(dir=target_dir,
-                                                                                 dir_name=dir_name,
-                                                                                 prefix_normal=prefix_normal,
-                                                                                 id_name=id_name,
-                                                                                 ext=ext)))
+        normal_files = indexed_files(target_dir, dir_name, param.get("dataset_index"), machine_id=id_name, condition=prefix_normal) if ext == "wav" else None
+        if normal_files is None:
+            normal_files = sorted(
+                glob.glob("{dir}/{dir_name}/{prefix_normal}_{id_name}*.{ext}".format(dir=target_dir,
+                                                                                     dir_name=dir_name,
+                                                                                     prefix_normal=prefix_normal,
+                                                                                     id_name=id_name,
+                                                                                     ext=ext)))
         normal_labels = np.zeros(len(normal_files))
-        anomaly_files = sorted(
-            glob.glob("{dir}/{dir_name}/{prefix_anomaly}_{id_name}*.{ext}".format(dir=target_dir,
-                                                                                  dir_name=dir_name,
-                                                                                  prefix_anomaly=prefix_anomaly,
-                                                                                  id_name=id_name,
-                                                                                  ext=ext)))
+        anomaly_files = indexed_files(target_dir, dir_name, param.get("dataset_index"), machine_id=id_name, condition=prefix_anomaly) if ext == "wav" else None
+        if anomaly_files is None:
+            anomaly_files = sorted(
+                glob.glob("{dir}/{dir_name}/{prefix_anomaly}_{id_name}*.{ext}".format(dir=target_dir,
+                                                                                      dir_name=dir_name,
+                                                                                      prefix_anomaly=prefix_anomaly,
+                                                                                      id_name=id_name,
+                                                                                      ext=ext)))
         anomaly_labels = np.ones(len(anomaly_files))
         files = np.concatenate((normal_files, anomaly_files), axis=0)
         labels = np.concatenate((normal_labels, anomaly_labels), axis=0)
@@ -135,11 +146,13 @@ def test_file_list_generator(target_dir,
 
     # evaluation
     else:
-        files = sorted(
-            glob.glob("{dir}/{dir_name}/*{id_name}*.{ext}".format(dir=target_dir,
-                                                                  dir_name=dir_name,
-                                                                  id_name=id_name,
-                                                                  ext=ext)))
+        files = indexed_files(target_dir, dir_name, param.get("dataset_index"), machine_id=id_name) if ext == "wav" else None
+        if files is None:
+            files = sorted(
+                glob.glob("{dir}/{dir_name}/*{id_name}*.{ext}".format(dir=target_dir,
+                                                                      dir_name=dir_name,
+                                                                      id_name=id_name,
+                                                                      ext=ext)))
         labels = None
         com.logger.info("test_file  num : {num}".format(num=len(files)))
         if len(files) == 0:
@@ -150,6 +163,54 @@ def test_file_list_generator(target_dir,
 ########################################################################
 
 
+def file_scores(test_files, encoder, decoder, device, cache=None, top_k=0):
+    """
+    score test files one at a time.
+
+    test_files : list [ str ]
+        .wav files to score
+    encoder, decoder : Encoder, Decoder
+        trained models in eval mode
+    device : torch.device
+    cache : FeatureCache ( default = None )
+        on-disk log mel cache
+    top_k : int ( default = 0 )
+        decode only the top_k machine IDs of the classifier, 0 decodes all of them
+
+    return : numpy.array( float ), numpy.array( numpy.array( float ) )
+        anomaly score of every file and its reconstruction error per class,
+        shape = (files, classNum), nan for broken files
+    """
+    scores = np.full(len(test_files), np.nan)
+    errors = np.full((len(test_files), decoder.class_num), np.nan)
+    vector_arrays = com.iter_vector_arrays(test_files,
+                                           n_jobs=param["extraction"]["n_jobs"],
+                                           chunksize=param["extraction"]["chunksize"],
+                                           n_mels=param["feature"]["idcae"]["n_mels"],
+                                           frames=param["feature"]["idcae"]["frames"],
+                                           n_fft=param["feature"]["idcae"]["n_fft"],
+                                           hop_length=param["feature"]["idcae"]["hop_length"],
+                                           power=param["feature"]["idcae"]["power"],
+                                           cache=cache)
+    for file_idx, vector_array in tqdm(enumerate(vector_arrays), total=len(test_files)):
+        if vector_array is None:
+            continue
+
+        vector_array = standardize(vector_array)
+
+        '''
+        During testing, we try all labels and take the smallest reconstruction error as anomaly score
+        Like the process in training, the label contains 1 and -1
+        ex. label = [-1, -1, 1, -1], then it means we try label number 2
+        All labels are decoded in one batch, see scoring.reconstruction_errors()
+        Given ground truth and anomaly score, use sklearn metric roc_auc_score to get auc and pauc
+        '''
+        features = torch.Tensor(vector_array).to(device=device, non_blocking=True, dtype=torch.float32)
+        scores[file_idx], errors[file_idx] = anomaly_score(encoder, decoder, features, top_k=top_k)
+    return scores, errors
+########################################################################
+
+
 ########################################################################
 # main 01_test.py
 ########################################################################
@@ -157,18 +218,30 @@ if __name__ == "__main__":
     # check mode
     # "development": mode == True
     # "evaluation": mode == False
-    mode = com.command_line_chk()
+    mode = com.command_line_chk(param)
     if mode is None:
         sys.exit(-1)
 
     # make output result directory
     os.makedirs(param["result_directory"]["idcae"], exist_ok=True)
 
-    # load base directory
-    dirs = com.select_dirs(param=param, mode=mode)
+    # load base directory, restricted to the machine types given by --machines
+    dirs = com.select_machines(com.select_dirs(param=param, mode=mode), param["schedule"]["machines"])
+
+    # open the on-disk log mel cache
+    feature_cache = open_feature_cache(param)
+
+    # select the device and the number of threads
+    device = com.setup_runtime(param)
+    if param["test"]["quantized"] and device.type != "cpu":
+        # the int8 kernels of dynamic quantization exist for the CPU only
+        com.logger.warning("test.quantized: the int8 models run on the cpu, not on {}".format(device))
+        device = torch.device("cpu")
 
     # initialize lines in csv for AUC and pAUC
     csv_lines = []
+    # every score of the run, written as one columnar table at the end
+    score_table = ScoreTableWriter()
 
     # loop of the base directory
     for idx, target_dir in enumerate(dirs):
@@ -204,27 +277,96 @@ if __name__ == "__main__":
             csv_lines.append(["id", "AUC", "pAUC"])
             performance = []
 
-        machine_id_list = com.get_machine_id_list(target_dir)
-
-        # load model (encoder & decoder)
-        encoder = Encoder(paramF=paramF, paramM=paramM, classNum=len(machine_id_list))
-        decoder = Decoder(paramF=paramF, paramM=paramM, classNum=len(machine_id_list))
-        encoder.load_state_dict(torch.load(encoder_file_path))
-        decoder.load_state_dict(torch.load(decoder_file_path))
-        encoder.eval()
-        decoder.eval()
-
-        device = torch.device('cuda')
-
-        encoder = encoder.to(device)
-        encoder.float()
-        decoder = decoder.to(device)
-        decoder.float()
-
+        machine_id_list = com.get_machine_id_list(target_dir, index_param=param.get("dataset_index"))
+
+        # load test files
+        test_file_lists = [test_file_list_generator(target_dir, id_str, dir_name="test") for id_str in machine_id_list]
+        all_files = list(itertools.chain.from_iterable(files for files, _ in test_file_lists))
+
+        scripted = param["test"]["scripted"] or param["test"]["quantized"]
+        quantized = param["test"]["quantized"]
+        if scripted and not scorer_up_to_date(param["model_directory"]["idcae"], machine_type, quantized=quantized):
+            # BatchNorm folded (and int8) TorchScript models, exported again when the trained models are newer
+            export_scorer(param["model_directory"]["idcae"], machine_type,
+                          frames=paramF,
+                          n_mels=paramM,
+                          quantized=quantized)
+
+        if param["test"]["incremental"]:
+            # score only the files whose audio or models changed since the last run
+            model_files = [scorer_path(param["model_directory"]["idcae"], machine_type, quantized=quantized)] if scripted \
+                else [encoder_file_path, decoder_file_path]
+            # one ledger per dataset, dev_data and eval_data runs keep their records apart
+            score_ledger = ScoreLedger("{result}/score_ledger_{base}_{machine_type}.json".format(
+                                           result=param["result_directory"]["idcae"],
+                                           base=os.path.basename(os.path.dirname(os.path.abspath(target_dir))),
+                                           machine_type=machine_type),
+                                       model_fingerprint(model_files,
+                                                         feature=param["feature"]["idcae"],
+                                                         top_k=param["test"]["top_k"]))
+            pending_files = score_ledger.pending(all_files)
+            com.logger.info("incremental scoring : {} of {} files to score".format(len(pending_files), len(all_files)))
+        else:
+            score_ledger = None
+            pending_files = all_files
+
+        if len(pending_files) > 0:
+            if scripted:
+                encoder, decoder = load_scorer(scorer_path(param["model_directory"]["idcae"], machine_type, quantized=quantized),
+                                               paramF=paramF,
+                                               paramM=paramM,
+                                               device=device)
+            else:
+                # load model (encoder & decoder)
+                encoder = Encoder(paramF=paramF, paramM=paramM, classNum=len(machine_id_list))
+                decoder = Decoder(paramF=paramF, paramM=paramM, classNum=len(machine_id_list))
+                encoder.load_state_dict(torch.load(encoder_file_path, map_location=device))
+                decoder.load_state_dict(torch.load(decoder_file_path, map_location=device))
+                encoder.eval()
+                decoder.eval()
+
+                encoder = encoder.to(device)
+                encoder.float()
+                decoder = decoder.to(device)
+                decoder.float()
+
+        if len(pending_files) == 0:
+            pending_scores, pending_errors = np.zeros(0), np.zeros((0, len(machine_id_list)))
+        elif param["test"]["engine"]:
+            # score the test files of every machine ID in one pipelined pass
+            engine = InferenceEngine(encoder,
+                                     decoder,
+                                     device,
+                                     batch_rows=param["test"]["batch_rows"],
+                                     queue_size=param["test"]["queue_size"],
+                                     n_jobs=param["extraction"]["n_jobs"],
+                                     chunksize=param["extraction"]["chunksize"],
+                                     cache=feature_cache,
+                                     top_k=param["test"]["top_k"],
+                                     n_mels=param["feature"]["idcae"]["n_mels"],
+                                     frames=param["feature"]["idcae"]["frames"],
+                                     n_fft=param["feature"]["idcae"]["n_fft"],
+                                     hop_length=param["feature"]["idcae"]["hop_length"],
+                                     power=param["feature"]["idcae"]["power"])
+            pending_scores, pending_errors = engine.score_files(pending_files)
+        else:
+            pending_scores, pending_errors = file_scores(pending_files, encoder, decoder, device,
+                                                         cache=feature_cache,
+                                                         top_k=param["test"]["top_k"])
+
+        if score_ledger is not None:
+            # merge the new scores with the recorded ones
+            score_ledger.update(pending_files, pending_scores, pending_errors)
+            all_scores = score_ledger.scores(all_files)
+            all_errors = score_ledger.errors(all_files, len(machine_id_list))
+            score_ledger.save(all_files)
+        else:
+            all_scores, all_errors = pending_scores, pending_errors
+
+        offset = 0
         for idx in range(len(machine_id_list)):
-            # load test file
             id_str = machine_id_list[idx]
-            test_files, y_true = test_file_list_generator(target_dir, id_str, dir_name="test")
+            test_files, y_true = test_file_lists[idx]
 
             # setup anomaly score file path
             anomaly_score_csv = "{result}/anomaly_score_{machine_type}_{id_str}.csv".format(
@@ -236,74 +378,24 @@ if __name__ == "__main__":
             print("\n============== BEGIN TEST FOR A MACHINE ID ==============")
             y_pred = [0. for k in test_files]
 
-            loss_fn = nn.MSELoss()
-            rec_errors = []
-            nm_rec_errors = []
-            latent_list = []
-            nm_latent_list = []
-            for file_idx, file_path in tqdm(enumerate(test_files), total=len(test_files)):
-                try:
-                    vector_array = com.file_to_vector_array(file_path,
-                                                n_mels=param["feature"]["idcae"]["n_mels"],
-                                                frames=param["feature"]["idcae"]["frames"],
-                                                n_fft=param["feature"]["idcae"]["n_fft"],
-                                                hop_length=param["feature"]["idcae"]["hop_length"],
-                                                power=param["feature"]["idcae"]["power"])
-                except:
-                    com.logger.error("file broken!!: {}".format(file_path))
-
-                data = vector_array.flatten()
-                mean = np.mean(data, dtype=np.float32)
-                std = np.std(data, dtype=np.float32)
-
-                vector_array = (vector_array - mean) / std
-
-
-                '''
-                During testing, we try all labels and take the smallest reconstruction error as anomaly score
-                Like the process in training, the label contains 1 and -1
-                ex. label = [-1, -1, 1, -1], then it means we try label number 2
-                Given ground truth and anomaly score, use sklearn metric roc_auc_score to get auc and pauc
-                '''
-                with torch.no_grad():
-                    features = torch.Tensor(vector_array).to(device=device, non_blocking=True, dtype=torch.float32)
-                    label = np.zeros(shape=(features.shape[0], len(machine_id_list)))
-                    label = torch.Tensor(label).to(device=device, non_blocking=True, dtype=torch.float32)
-                    label = label - 1
-
-                    reconstruction_list = np.zeros((len(machine_id_list), ))
-                    latent, cls_output = encoder(features)
-                    for i in range(len(machine_id_list)):
-                        if i == 0:
-                            label[:, 0] = 1
-                        else:
-                            label[:, i-1] = -1
-                            label[:, i] = 1
-                        rec, nm_rec = decoder(latent, label, label)
-                        error = loss_fn(rec, features)
-                        reconstruction_list[i] = error.cpu().detach().numpy()
-                    errors = np.min(reconstruction_list)
-                    y_pred[file_idx] = errors
-
-                    rec_errors.append(np.min(reconstruction_list))
-                    nm_rec_errors.append(reconstruction_list[idx])
-                    latent_list.append(rec)
-                    nm_latent_list.append(nm_rec)
+            scores = all_scores[offset: offset + len(test_files)]
+            score_table.append(machine_type, id_str, test_files, scores, all_errors[offset: offset + len(test_files)],
+                               labels=y_true)
+            offset += len(test_files)
+
+            for file_idx, file_path in enumerate(test_files):
+                if np.isnan(scores[file_idx]):
+                    # broken file, already reported by com.iter_vector_arrays()
+                    continue
+                y_pred[file_idx] = float(scores[file_idx])
 
                 # FIXME: un common
                 anomaly_score_list.append([os.path.basename(file_path), y_pred[file_idx]])
 
-                ############################################################################
-                """ errors = numpy.mean(numpy.square(data - model.predict(data)), axis=1)
-                y_pred[file_idx] = numpy.mean(errors)
-                anomaly_score_list.append([os.path.basename(file_path), y_pred[file_idx]]) """
-                ############################################################################
-                """ except:
-                    com.logger.error("file broken!!: {}".format(file_path)) """
-            
-            # save anomaly score
-            save_csv(save_file_path=anomaly_score_csv, save_data=anomaly_score_list)
-            com.logger.info("anomaly score result ->  {}".format(anomaly_score_csv))
+            if param["test"]["score_csv"]:
+                # save anomaly score
+                save_csv(save_file_path=anomaly_score_csv, save_data=anomaly_score_list)
+                com.logger.info("anomaly score result ->  {}".format(anomaly_score_csv))
             
             if mode:
                 # append AUC and pAUC to lists
@@ -322,6 +414,9 @@ if __name__ == "__main__":
             csv_lines.append(["Average"] + list(averaged_performance))
             csv_lines.append([])
 
+    # save the scores of every machine type and ID in one table
+    score_table.save("{result}/{file_name}".format(result=param["result_directory"]["idcae"], file_name=param["score_table_file"]))
+
     if mode:
         # output results
         result_path = "{result}/{file_name}".format(result=param["result_directory"]["idcae"], file_name=param["result_file"])
@@ -1,12 +1,145 @@
+import collections
+import concurrent.futures
+
+import numpy as np
+import torch
 from torch.utils.data import Dataset
 
-class MelDataLoader(Dataset):
-    def __init__(self, dataset):
-        self.dataset = dataset
+class MelDataset(Dataset):
+    """
+    Columnar training dataset.
+
+    features : numpy.array( float32 ), numpy.memmap or FeatureStore
+        contiguous feature matrix, shape = (n_rows, dims)
+    labels : numpy.array( int )
+        match class index of every row
+    nm_labels : numpy.array( int ) ( default = None )
+        non match class index of every row, when it is None the non match
+        labels are drawn for every batch when it is served
+    class_num : int ( default = None )
+        number of classes, required when nm_labels is None
+    rng : numpy.random.RandomState ( default = None )
+        generator of the per batch non match labels
+
+    Indexing with an array of row indices returns a whole batch
+    (feature, label, non match label) as tensors with a single slice per column,
+    followed by the encoder latent once set_latents() was called.
+    """
+    def __init__(self, features, labels, nm_labels=None, class_num=None, rng=None):
+        assert len(features) == len(labels)
+        assert nm_labels is None or len(nm_labels) == len(labels)
+        assert nm_labels is not None or class_num is not None
+        self.features = features
+        self.labels = labels
+        self.nm_labels = nm_labels
+        self.class_num = class_num
+        self.rng = rng if rng is not None else np.random.RandomState()
+        self.latents = None
+
+    def set_latents(self, latents):
+        """
+        attach precomputed encoder latents, batches then also contain the latent of every row.
+
+        latents : numpy.array( float32 ) or None
+            shape = (n_rows, latent_dim), None detaches them
+        """
+        assert latents is None or len(latents) == len(self.labels)
+        self.latents = latents
 
     def __len__(self):
-        return len(self.dataset)
+        return len(self.labels)
 
     def __getitem__(self, idx):
-        feature, label, nm_label = self.dataset[idx]
-        return feature, label, nm_label
\ No newline at end of file
+        # sorted indices read a memmap front to back, the order inside a batch does not matter
+        idx = np.sort(np.asarray(idx))
+        feature = torch.from_numpy(np.ascontiguousarray(self.features[idx], dtype=np.float32))
+        label = self.labels[idx].astype(np.int64)
+        if self.nm_labels is not None:
+            nm_label = self.nm_labels[idx].astype(np.int64)
+        else:
+            # a shift of 1 .. class_num-1 picks uniformly among the other classes
+            nm_label = (label + self.rng.randint(1, self.class_num, size=len(label))) % self.class_num
+        if self.latents is not None:
+            latent = torch.from_numpy(np.ascontiguousarray(self.latents[idx], dtype=np.float32))
+            return feature, torch.from_numpy(label), torch.from_numpy(nm_label), latent
+        return feature, torch.from_numpy(label), torch.from_numpy(nm_label)
+
+
+def shard_permutation(indices, shard_rows, window=4):
+    """
+    shuffle row indices of a sharded store while keeping the reads local.
+
+    The shards are visited in a random order, and the rows of every `window` consecutive
+    shards of that order are shuffled together, so a batch mixes rows of up to `window`
+    shards instead of touching one page of every shard.
+
+    indices : numpy.array( int )
+        rows to shuffle
+    shard_rows : int
+        number of rows per shard
+    window : int ( default = 4 )
+        number of shards shuffled together
+
+    return : numpy.array( int )
+        permutation of indices, drawn from the global numpy generator
+    """
+    indices = np.asarray(indices)
+    shards = indices // shard_rows
+    order = np.random.permutation(np.unique(shards))
+    groups = [indices[np.isin(shards, order[start:start + window])] for start in range(0, len(order), window)]
+    return np.concatenate([np.random.permutation(group) for group in groups]) if groups else indices
+
+
+class BatchLoader(object):
+    """
+    Iterate over the rows of a MelDataset in batches.
+
+    dataset : MelDataset
+    indices : numpy.array( int )
+        rows served by this loader, e.g. the train or the validation split
+    batch_size : int
+    shuffle : boolean
+        reshuffle the rows every epoch
+    num_workers : int ( default = 0 )
+        number of threads gathering the next batches while the model runs,
+        0 gathers every batch in the iterating thread
+    shard_rows : int ( default = 0 )
+        rows per shard when the features are a FeatureStore, the rows are then
+        shuffled with shard_permutation(), 0 shuffles all of them at once
+    shuffle_shards : int ( default = 4 )
+        window of shard_permutation()
+    """
+    def __init__(self, dataset, indices, batch_size, shuffle=False, num_workers=0, shard_rows=0, shuffle_shards=4):
+        self.dataset = dataset
+        self.indices = np.asarray(indices)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.num_workers = num_workers
+        self.shard_rows = shard_rows
+        self.shuffle_shards = shuffle_shards
+
+    def __len__(self):
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if not self.shuffle:
+            indices = self.indices
+        elif self.shard_rows > 0:
+            indices = shard_permutation(self.indices, self.shard_rows, window=self.shuffle_shards)
+        else:
+            indices = np.random.permutation(self.indices)
+        batches = (indices[start:start + self.batch_size] for start in range(0, len(indices), self.batch_size))
+        if self.num_workers <= 0:
+            for batch in batches:
+                yield self.dataset[batch]
+            return
+
+        # keep up to 2 batches per worker in flight, results are yielded in order
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            pending = collections.deque()
+            for batch in batches:
+                pending.append(executor.submit(self.dataset.__getitem__, batch))
+                if len(pending) >= 2 * self.num_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
@@ -0,0 +1,801 @@
+"""
+ @file   benchmark.py
+ @brief  Micro-benchmarks of the feature pipeline and the IDCAE models
+"""
+
+########################################################################
+# import default python-library
+########################################################################
+import argparse
+import time
+########################################################################
+
+
+########################################################################
+# import additional python-library
+########################################################################
+import numpy as np
+# original lib
+import common as com
+########################################################################
+
+
+########################################################################
+# helpers
+########################################################################
+def timeit(func, repeat=5, number=10):
+    """
+    func : callable
+        function without arguments to be timed
+    repeat : int
+        number of measurements, the best one is reported
+    number : int
+        number of calls per measurement
+
+    return : float
+        best time per call in seconds
+    """
+    func()
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+
+def report(title, rows):
+    """
+    print a result table.
+
+    rows : list [ (str, float) ]
+        name and time per call in seconds, the first row is the reference of the speedup
+    """
+    print("\n{}".format(title))
+    reference = rows[0][1]
+    for name, seconds in rows:
+        print("  {name:<32} {ms:10.3f} ms   x{speedup:.2f}".format(name=name,
+                                                                   ms=seconds * 1000,
+                                                                   speedup=reference / seconds))
+
+
+########################################################################
+
+
+########################################################################
+# wav decoding of com.file_load
+########################################################################
+def bench_decode(args, param):
+    """
+    decode throughput of librosa.load() against com.wav_read() over the wav files of --wav_dir
+    (default: the dev directory), at most --max_files of them.
+    """
+    import glob
+    import os
+    import librosa
+
+    wav_dir = args.wav_dir or param["dev_directory"]
+    files = sorted(glob.glob(os.path.join(wav_dir, "**", "*.wav"), recursive=True))[:args.max_files]
+    if not files:
+        print("\nno wav files under {}".format(wav_dir))
+        return
+    total_bytes = sum(os.path.getsize(f) for f in files)
+
+    def decode_librosa():
+        return [librosa.load(f, sr=None, mono=False) for f in files]
+
+    def decode_fast():
+        return [com.wav_read(f) for f in files]
+
+    # same samples, and the files are in the page cache for both loaders
+    seconds_audio = 0.0
+    for (a, sr_a), (b, sr_b) in zip(decode_librosa(), decode_fast()):
+        assert sr_a == sr_b and np.array_equal(a, b)
+        seconds_audio += a.shape[-1] / sr_a
+
+    print("\ndecode {n} wav files ({mb:.1f} MB, {s:.0f} s of audio) from {d}".format(
+        n=len(files), mb=total_bytes / 1e6, s=seconds_audio, d=wav_dir))
+    print("  {:<14} {:>10} {:>10} {:>10} {:>14} {:>9}".format(
+        "loader", "ms/file", "files/s", "MB/s", "audio s/s", "speedup"))
+    reference = None
+    for name, decode in (("librosa.load", decode_librosa), ("com.wav_read", decode_fast)):
+        seconds = timeit(decode, repeat=args.repeat, number=1)
+        reference = reference or seconds
+        print("  {:<14} {:>10.3f} {:>10.1f} {:>10.1f} {:>14.0f} {:>8.2f}x".format(
+            name,
+            seconds * 1000 / len(files),
+            len(files) / seconds,
+            total_bytes / 1e6 / seconds,
+            seconds_audio / seconds,
+            reference / seconds))
+
+
+########################################################################
+
+
+########################################################################
+# frame stacking (com.log_mel_to_vector_array, step 04-08 of com.file_to_vector_array)
+########################################################################
+def frames_loop(log_mel_spectrogram, n_mels, frames):
+    """
+    reference implementation of the multiframe concatenation with a python loop over frames,
+    timed against com.log_mel_to_vector_array().
+    """
+    dims = n_mels * frames
+    vector_array_size = log_mel_spectrogram.shape[1] - frames + 1
+    vector_array = np.zeros((vector_array_size, dims), dtype=np.float32)
+    mean = np.mean(log_mel_spectrogram, dtype=np.float32, axis=0, keepdims=True)
+    std = np.std(log_mel_spectrogram, dtype=np.float32, axis=0, keepdims=True)
+    log_mel_spectrogram = (log_mel_spectrogram - mean) / std
+    for t in range(frames):
+        vector_array[:, n_mels * t: n_mels * (t + 1)] = log_mel_spectrogram[:, t: t + vector_array_size].T
+    return vector_array
+
+
+def bench_frames(args, param):
+    """
+    compare the frame stacking loop with the strided view on a typical 10 s clip.
+    """
+    feature = param["feature"]["idcae"]
+    n_mels, frames = feature["n_mels"], feature["frames"]
+    n_frames = int(args.seconds * args.sr / feature["hop_length"]) + 1
+    log_mel_spectrogram = np.random.RandomState(0).randn(n_mels, n_frames).astype(np.float32) * 10 - 40
+
+    def frames_strided():
+        return com.log_mel_to_vector_array(log_mel_spectrogram, n_mels=n_mels, frames=frames)
+
+    assert np.array_equal(frames_loop(log_mel_spectrogram, n_mels, frames), frames_strided())
+
+    rows = [("loop over frames", timeit(lambda: frames_loop(log_mel_spectrogram, n_mels, frames))),
+            ("strided view", timeit(frames_strided)),
+            ("strided view + contiguous copy", timeit(lambda: np.ascontiguousarray(frames_strided())))]
+    report("frame stacking, {s} s clip, n_mels={m}, frames={f} ({t} frames)".format(
+        s=args.seconds, m=n_mels, f=frames, t=n_frames), rows)
+
+
+########################################################################
+
+
+########################################################################
+# batched torch frontend against librosa clip by clip
+########################################################################
+def bench_frontend(args, param):
+    """
+    feature extraction throughput in clips/s: librosa and the numpy steps of
+    com.file_to_vector_array() clip by clip against frontend.LogMelFrontend on batches of
+    --batch_list clips, on synthetic waveforms in memory (no file I/O).
+    """
+    import sys
+    import librosa
+    import torch
+    from frontend import LogMelFrontend
+
+    torch.set_num_threads(args.threads)
+    feature = param["feature"]["idcae"]
+    batch_sizes = [int(b) for b in args.batch_list.split(",")]
+    n_clips = max(batch_sizes)
+    waveforms = (np.random.RandomState(0).randn(n_clips, int(args.seconds * args.sr)) * 0.1).astype(np.float32)
+    frontend = LogMelFrontend(args.sr,
+                              n_mels=feature["n_mels"],
+                              frames=feature["frames"],
+                              n_fft=feature["n_fft"],
+                              hop_length=feature["hop_length"],
+                              power=feature["power"])
+
+    def librosa_vector_array(y):
+        mel_spectrogram = librosa.feature.melspectrogram(y=y,
+                                                         sr=args.sr,
+                                                         n_fft=feature["n_fft"],
+                                                         hop_length=feature["hop_length"],
+                                                         n_mels=feature["n_mels"],
+                                                         power=feature["power"])
+        log_mel_spectrogram = 20.0 / feature["power"] * np.log10(mel_spectrogram + sys.float_info.epsilon)
+        return com.log_mel_to_vector_array(log_mel_spectrogram.astype(np.float32),
+                                           n_mels=feature["n_mels"],
+                                           frames=feature["frames"])
+
+    def librosa_all():
+        return [librosa_vector_array(y) for y in waveforms]
+
+    def frontend_all(batch_size):
+        with torch.no_grad():
+            return [frontend.vector_arrays(waveforms[start: start + batch_size])
+                    for start in range(0, n_clips, batch_size)]
+
+    reference = np.stack(librosa_all())
+    with torch.no_grad():
+        difference = np.max(np.abs(frontend.vector_arrays(waveforms).numpy() - reference))
+
+    rows = [("librosa, clip by clip", timeit(librosa_all, repeat=args.repeat, number=1))]
+    for batch_size in batch_sizes:
+        rows.append(("LogMelFrontend, batch {}".format(batch_size),
+                     timeit(lambda: frontend_all(batch_size), repeat=args.repeat, number=1)))
+
+    print("\nvector arrays of {n} clips of {s} s at {sr} Hz, {t} threads, max abs difference {d:.1e}".format(
+        n=n_clips, s=args.seconds, sr=args.sr, t=args.threads, d=difference))
+    for name, seconds in rows:
+        print("  {name:<32} {clips:10.1f} clips/s   x{speedup:.2f}".format(name=name,
+                                                                       clips=n_clips / seconds,
+                                                                       speedup=rows[0][1] / seconds))
+
+
+########################################################################
+
+
+########################################################################
+# decoder training step (pytorch_model.Decoder)
+########################################################################
+def decoder_train_step(decoder, optim, latent, label, nm_label, feature, nm_input, fused):
+    """
+    one decoder training step as in 00_train.py.
+    """
+    import torch.nn as nn
+
+    loss_fn = nn.MSELoss()
+    alpha = 0.75
+    optim.zero_grad()
+    m_output, nm_output = decoder(latent, label, nm_label, fused=fused)
+    loss = alpha * loss_fn(m_output, feature) + (1 - alpha) * loss_fn(nm_output, nm_input)
+    loss.backward()
+    optim.step()
+    return loss
+
+
+def bench_decoder(args, param):
+    """
+    compare the two pass decoder with the fused single pass decoder on CPU.
+    """
+    import copy
+    import torch
+    from pytorch_model import Decoder, condition_label
+
+    torch.manual_seed(0)
+    torch.set_num_threads(args.threads)
+    feature = param["feature"]["idcae"]
+    paramF, paramM = feature["frames"], feature["n_mels"]
+    batch_size = param["fit"]["idcae"]["batch_size"]
+    class_num = args.classes
+
+    latent = torch.randn(batch_size, 16)
+    label = torch.randint(0, class_num, (batch_size, ))
+    nm_label = (label + torch.randint(1, class_num, (batch_size, ))) % class_num
+    label, nm_label = condition_label(label, class_num), condition_label(nm_label, class_num)
+    feature_batch = torch.randn(batch_size, paramF * paramM)
+    nm_input = torch.full((batch_size, paramF * paramM), 5.0)
+
+    decoders = {}
+    for fused in (False, True):
+        decoder = Decoder(paramF=paramF, paramM=paramM, classNum=class_num)
+        if fused:
+            decoder = copy.deepcopy(decoders[False][0])
+        decoder.train()
+        decoders[fused] = (decoder, torch.optim.SGD(decoder.parameters(), lr=1e-3))
+
+    # the fused step trains the same parameters and BatchNorm statistics
+    for fused, (decoder, optim) in decoders.items():
+        decoder_train_step(decoder, optim, latent, label, nm_label, feature_batch, nm_input, fused)
+    state = [decoder.state_dict() for decoder, _ in decoders.values()]
+    for key in state[0]:
+        assert torch.allclose(state[0][key].float(), state[1][key].float(), atol=1e-5), key
+
+    rows = []
+    for fused, name in ((False, "two passes"), (True, "fused single pass")):
+        decoder, optim = decoders[fused]
+        rows.append((name, timeit(lambda: decoder_train_step(decoder, optim, latent, label, nm_label,
+                                                             feature_batch, nm_input, fused),
+                                  repeat=args.repeat, number=10)))
+    report("decoder train step, batch {b}, {c} classes, {t} threads".format(
+        b=batch_size, c=class_num, t=args.threads), rows)
+
+
+########################################################################
+
+
+########################################################################
+# CPU throughput at different thread settings
+########################################################################
+def bench_threads(args, param):
+    """
+    train step and scoring throughput on CPU for every intra-op thread count of --thread_list.
+    """
+    import torch
+    import torch.nn as nn
+    from pytorch_model import Encoder, Decoder, condition_label
+
+    torch.manual_seed(0)
+    feature = param["feature"]["idcae"]
+    paramF, paramM = feature["frames"], feature["n_mels"]
+    batch_size = param["fit"]["idcae"]["batch_size"]
+    batch_rows = param["test"]["batch_rows"]
+    class_num = args.classes
+    dims = paramF * paramM
+
+    encoder = Encoder(paramF=paramF, paramM=paramM, classNum=class_num)
+    decoder = Decoder(paramF=paramF, paramM=paramM, classNum=class_num)
+    en_optim = torch.optim.SGD(encoder.parameters(), lr=1e-6)
+    de_optim = torch.optim.SGD(decoder.parameters(), lr=1e-3)
+    feature_batch = torch.randn(batch_size, dims)
+    label = torch.randint(0, class_num, (batch_size, ))
+    nm_label = (label + torch.randint(1, class_num, (batch_size, ))) % class_num
+    nm_input = torch.full((batch_size, dims), 5.0)
+    score_batch = torch.randn(batch_rows, dims)
+    en_loss_fn = nn.CrossEntropyLoss(reduction='sum')
+    de_loss_fn = nn.MSELoss()
+
+    def train_step():
+        encoder.train()
+        en_optim.zero_grad()
+        _, cls_output = encoder(feature_batch)
+        en_loss_fn(cls_output, label).backward()
+        en_optim.step()
+
+        encoder.eval()
+        decoder.train()
+        de_optim.zero_grad()
+        with torch.no_grad():
+            latent, _ = encoder(feature_batch)
+        m_output, nm_output = decoder(latent, condition_label(label, class_num), condition_label(nm_label, class_num))
+        loss = 0.75 * de_loss_fn(m_output, feature_batch) + 0.25 * de_loss_fn(nm_output, nm_input)
+        loss.backward()
+        de_optim.step()
+
+    def score_step():
+        encoder.eval()
+        decoder.eval()
+        with torch.no_grad():
+            latent, _ = encoder(score_batch)
+            output = decoder.reconstruct_all(latent)
+            torch.mean((output - score_batch.unsqueeze(0)) ** 2, dim=2)
+
+    print("\nCPU throughput, train batch {b}, score batch {r} frames, {c} classes".format(
+        b=batch_size, r=batch_rows, c=class_num))
+    print("  {:<8} {:>14} {:>16} {:>18}".format("threads", "train ms/step", "train rows/s", "score frames/s"))
+    for threads in [int(t) for t in args.thread_list.split(",")]:
+        torch.set_num_threads(threads)
+        train_time = timeit(train_step, repeat=args.repeat, number=5)
+        score_time = timeit(score_step, repeat=args.repeat, number=2)
+        print("  {:<8d} {:>14.2f} {:>16.0f} {:>18.0f}".format(threads,
+                                                             train_time * 1000,
+                                                             batch_size / train_time,
+                                                             batch_rows / score_time))
+
+
+########################################################################
+
+
+########################################################################
+# BatchNorm folding and TorchScript export
+########################################################################
+def bench_scripted(args, param):
+    """
+    scoring time of the eager models against the BatchNorm folded TorchScript export,
+    for one clip of --seconds and for a batch of test.batch_rows frames.
+    """
+    import torch
+    import torch.nn as nn
+    from pytorch_model import Encoder, Decoder
+    from scoring import frame_errors
+    from export import export_models
+
+    torch.manual_seed(0)
+    torch.set_num_threads(args.threads)
+    feature = param["feature"]["idcae"]
+    paramF, paramM = feature["frames"], feature["n_mels"]
+    encoder = Encoder(paramF=paramF, paramM=paramM, classNum=args.classes)
+    decoder = Decoder(paramF=paramF, paramM=paramM, classNum=args.classes)
+    # trained-like BatchNorm statistics, the defaults (mean 0, var 1) would make the folding trivial
+    for module in list(encoder.modules()) + list(decoder.modules()):
+        if isinstance(module, nn.BatchNorm1d):
+            module.running_mean.uniform_(-1.0, 1.0)
+            module.running_var.uniform_(0.5, 2.0)
+            module.weight.data.uniform_(0.5, 1.5)
+            module.bias.data.uniform_(-0.5, 0.5)
+    encoder.eval()
+    decoder.eval()
+    scorer = export_models(encoder, decoder, paramF, paramM)
+
+    clip_frames = int(args.seconds * args.sr) // feature["hop_length"] + 1 - paramF + 1
+    for title, rows in (("clip of {} frames".format(clip_frames), clip_frames),
+                        ("batch of {} frames".format(param["test"]["batch_rows"]), param["test"]["batch_rows"])):
+        features = torch.randn(rows, paramF * paramM)
+        with torch.no_grad():
+            reference = frame_errors(encoder, decoder, features)
+            difference = torch.max(torch.abs(scorer(features) - reference) / reference)
+
+        def eager():
+            with torch.no_grad():
+                frame_errors(encoder, decoder, features)
+
+        def scripted_parts():
+            with torch.no_grad():
+                frame_errors(scorer.encoder, scorer.decoder, features)
+
+        def scripted():
+            with torch.no_grad():
+                scorer(features)
+
+        report("frame errors, {t}, {c} classes, max relative difference {d:.1e}".format(
+                   t=title, c=args.classes, d=float(difference)),
+               [("eager Encoder / Decoder", timeit(eager, repeat=args.repeat)),
+                ("scripted encoder / decoder", timeit(scripted_parts, repeat=args.repeat)),
+                ("scripted ScoringModel", timeit(scripted, repeat=args.repeat))])
+
+
+########################################################################
+
+
+########################################################################
+# decoder training loop of 00_train.py, before and after removing the host syncs
+########################################################################
+def decoder_epoch_legacy(decoder, optim, batches, nm_input, last_epoch=True):
+    """
+    decoder epoch as 00_train.py ran it before: loss.item() and a numpy copy of the outputs
+    every step, growing per batch loss arrays and gc.collect() after every batch.
+    """
+    import gc
+    import torch.nn as nn
+
+    loss_fn = nn.MSELoss()
+    alpha = 0.75
+    train_loss = 0.0
+    m_lost_list = np.array([])
+    nm_lost_list = np.array([])
+    for latent, label, nm_label, feature in batches:
+        optim.zero_grad()
+        m_output, nm_output = decoder(latent, label, nm_label)
+        m_loss = loss_fn(m_output, feature)
+        nm_to_m = loss_fn(nm_output, feature)
+        loss = alpha * m_loss + (1 - alpha) * loss_fn(nm_output, nm_input)
+        loss.backward()
+        optim.step()
+        train_loss += loss.item()
+        m_output_toimg = m_output.cpu().detach().numpy()
+        nm_output_toimg = nm_output.cpu().detach().numpy()
+        if last_epoch:
+            m_lost_list = np.concatenate((m_lost_list, m_loss.cpu().detach().numpy()), axis=None)
+            nm_lost_list = np.concatenate((nm_lost_list, nm_to_m.cpu().detach().numpy()), axis=None)
+        del m_output, nm_output
+        gc.collect()
+    return train_loss / len(batches)
+
+
+def decoder_epoch_lean(decoder, optim, batches, nm_input, keep_samples=False):
+    """
+    decoder epoch as 00_train.py runs it now: the loss is summed on the device and read back
+    once, per batch losses go to a preallocated buffer only when samples are kept.
+    """
+    import torch
+    import torch.nn as nn
+
+    loss_fn = nn.MSELoss()
+    alpha = 0.75
+    train_loss = torch.zeros(())
+    if keep_samples:
+        m_loss_buffer = torch.zeros(len(batches))
+    for step, (latent, label, nm_label, feature) in enumerate(batches):
+        optim.zero_grad()
+        m_output, nm_output = decoder(latent, label, nm_label)
+        m_loss = loss_fn(m_output, feature)
+        loss = alpha * m_loss + (1 - alpha) * loss_fn(nm_output, nm_input)
+        loss.backward()
+        optim.step()
+        train_loss += loss.detach()
+        if keep_samples:
+            m_loss_buffer[step] = m_loss.detach()
+    return train_loss.item() / len(batches)
+
+
+def bench_train_loop(args, param):
+    """
+    time per decoder training step of the legacy and the lean loop on CPU.
+    """
+    import torch
+    from pytorch_model import Decoder, condition_label
+
+    torch.manual_seed(0)
+    torch.set_num_threads(args.threads)
+    feature = param["feature"]["idcae"]
+    paramF, paramM = feature["frames"], feature["n_mels"]
+    batch_size = param["fit"]["idcae"]["batch_size"]
+    class_num = args.classes
+    n_batches = args.batches
+
+    batches = []
+    for _ in range(n_batches):
+        label = torch.randint(0, class_num, (batch_size, ))
+        nm_label = (label + torch.randint(1, class_num, (batch_size, ))) % class_num
+        batches.append((torch.randn(batch_size, 16),
+                        condition_label(label, class_num),
+                        condition_label(nm_label, class_num),
+                        torch.randn(batch_size, paramF * paramM)))
+    nm_input = torch.full((batch_size, paramF * paramM), 5.0)
+
+    decoder = Decoder(paramF=paramF, paramM=paramM, classNum=class_num)
+    decoder.train()
+    optim = torch.optim.SGD(decoder.parameters(), lr=1e-3)
+
+    rows = [("per batch sync + gc.collect()",
+             timeit(lambda: decoder_epoch_legacy(decoder, optim, batches, nm_input),
+                    repeat=args.repeat, number=1) / n_batches),
+            ("device accumulation",
+             timeit(lambda: decoder_epoch_lean(decoder, optim, batches, nm_input),
+                    repeat=args.repeat, number=1) / n_batches),
+            ("device accumulation + samples",
+             timeit(lambda: decoder_epoch_lean(decoder, optim, batches, nm_input, keep_samples=True),
+                    repeat=args.repeat, number=1) / n_batches)]
+    report("decoder train loop, time per step, batch {b}, {n} batches, {c} classes, {t} threads".format(
+        b=batch_size, n=n_batches, c=class_num, t=args.threads), rows)
+
+
+########################################################################
+
+
+########################################################################
+# classifier-guided top-k pruning on the dev set (01_test.py, test.top_k)
+########################################################################
+def dev_test_sets(target_dir, feature):
+    """
+    standardized features of the test files of every machine ID of a dev machine type.
+
+    return : list [ (str, list [ int ], list [ torch.Tensor ]) ]
+        machine ID, normal / anomaly labels and features of every test file
+    """
+    import glob
+    import os
+    import torch
+    from scoring import standardize
+
+    test_sets = []
+    for id_str in com.get_machine_id_list(target_dir):
+        files = sorted(glob.glob("{}/test/*_{}_*.wav".format(target_dir, id_str)))
+        y_true = [0 if os.path.basename(f).startswith("normal") else 1 for f in files]
+        vector_arrays = com.iter_vector_arrays(files,
+                                               n_mels=feature["n_mels"],
+                                               frames=feature["frames"],
+                                               n_fft=feature["n_fft"],
+                                               hop_length=feature["hop_length"],
+                                               power=feature["power"])
+        features = [torch.from_numpy(np.ascontiguousarray(standardize(v), dtype=np.float32)) for v in vector_arrays]
+        test_sets.append((id_str, y_true, features))
+    return test_sets
+
+
+def mean_auc(test_sets, scores, max_fpr):
+    """
+    test_sets : list
+        output of dev_test_sets()
+    scores : list [ list [ float ] ]
+        anomaly score of every test file of every machine ID
+
+    return : float, float
+        AUC and pAUC averaged over the machine IDs
+    """
+    from sklearn import metrics
+
+    aucs, p_aucs = [], []
+    for (_, y_true, _), y_pred in zip(test_sets, scores):
+        aucs.append(metrics.roc_auc_score(y_true, y_pred))
+        p_aucs.append(metrics.roc_auc_score(y_true, y_pred, max_fpr=max_fpr))
+    return float(np.mean(aucs)), float(np.mean(p_aucs))
+
+
+def trained_machine_types(param):
+    """
+    return : list [ (str, str) ]
+        directory and machine type of every dev machine type with a trained encoder and decoder
+    """
+    import glob
+    import os
+
+    model_dir = param["model_directory"]["idcae"]
+    machines = []
+    for target_dir in sorted(glob.glob(os.path.abspath("{}/*".format(param["dev_directory"])))):
+        machine_type = os.path.split(target_dir)[1]
+        if all(os.path.exists("{}/{}_{}.pt".format(model_dir, net, machine_type)) for net in ("encoder", "decoder")):
+            machines.append((target_dir, machine_type))
+    return machines
+
+
+def bench_topk(args, param):
+    """
+    time and AUC / pAUC of the exhaustive search over the machine IDs against top-k pruning,
+    for every machine type of the dev set with trained models.
+    """
+    import torch
+    from scoring import anomaly_score, load_models
+
+    torch.set_num_threads(args.threads)
+    device = torch.device("cpu")
+    feature = param["feature"]["idcae"]
+    model_dir = param["model_directory"]["idcae"]
+    k_list = [int(k) for k in args.k_list.split(",")]
+
+    for target_dir, machine_type in trained_machine_types(param):
+        encoder, decoder = load_models("{}/encoder_{}.pt".format(model_dir, machine_type),
+                                       "{}/decoder_{}.pt".format(model_dir, machine_type),
+                                       feature["frames"], feature["n_mels"], device)
+        # features of the test files of every machine ID, extracted once
+        test_sets = dev_test_sets(target_dir, feature)
+        n_files = sum(len(features) for _, _, features in test_sets)
+
+        def score_all(top_k):
+            return [[anomaly_score(encoder, decoder, x, top_k=top_k)[0] for x in features]
+                    for _, _, features in test_sets]
+
+        print("\n{m}: {c} machine IDs, {n} test files, {t} threads".format(
+            m=machine_type, c=len(test_sets), n=n_files, t=args.threads))
+        print("  {:<12} {:>10} {:>9} {:>9} {:>9} {:>10} {:>10}".format(
+            "search", "ms/file", "speedup", "AUC", "pAUC", "dAUC", "same min"))
+        reference = None
+        for top_k in [0] + [k for k in k_list if 0 < k < len(test_sets)]:
+            seconds = timeit(lambda: score_all(top_k), repeat=args.repeat, number=1)
+            results = score_all(top_k)
+            auc, p_auc = mean_auc(test_sets, results, param["max_fpr"])
+            scores = np.array([score for id_results in results for score in id_results])
+            if reference is None:
+                reference = (seconds, auc, p_auc, scores)
+            print("  {:<12} {:>10.2f} {:>8.2f}x {:>9.4f} {:>9.4f} {:>+10.4f} {:>9.1f}%".format(
+                "exhaustive" if top_k == 0 else "top-{}".format(top_k),
+                seconds * 1000 / n_files,
+                reference[0] / seconds,
+                auc,
+                p_auc,
+                auc - reference[1],
+                100.0 * np.mean(np.isclose(scores, reference[3]))))
+
+
+def bench_quantized(args, param):
+    """
+    model size, scoring throughput and AUC / pAUC of the fp32 models against the BatchNorm
+    folded TorchScript export and its dynamic int8 quantization (test.scripted, test.quantized),
+    for every machine type of the dev set with trained models.
+    """
+    import io
+    import os
+    import torch
+    from scoring import anomaly_score, load_models
+    from export import export_models
+
+    torch.set_num_threads(args.threads)
+    device = torch.device("cpu")
+    feature = param["feature"]["idcae"]
+    model_dir = param["model_directory"]["idcae"]
+
+    for target_dir, machine_type in trained_machine_types(param):
+        encoder_path = "{}/encoder_{}.pt".format(model_dir, machine_type)
+        decoder_path = "{}/decoder_{}.pt".format(model_dir, machine_type)
+        encoder, decoder = load_models(encoder_path, decoder_path, feature["frames"], feature["n_mels"], device)
+        variants = [("fp32", encoder, decoder, os.path.getsize(encoder_path) + os.path.getsize(decoder_path))]
+        for name, quantized in (("fp32 scripted", False), ("int8 scripted", True)):
+            scorer = export_models(encoder, decoder, feature["frames"], feature["n_mels"], quantized=quantized)
+            buffer = io.BytesIO()
+            torch.jit.save(scorer, buffer)
+            variants.append((name, scorer.encoder, scorer.decoder, buffer.tell()))
+
+        test_sets = dev_test_sets(target_dir, feature)
+        n_files = sum(len(features) for _, _, features in test_sets)
+
+        print("\n{m}: {c} machine IDs, {n} test files, {t} threads".format(
+            m=machine_type, c=len(test_sets), n=n_files, t=args.threads))
+        print("  {:<14} {:>8} {:>9} {:>9} {:>9} {:>8} {:>8} {:>9} {:>9} {:>10}".format(
+            "model", "size kB", "ms/file", "files/s", "speedup", "AUC", "pAUC", "dAUC", "dpAUC", "max dscore"))
+        reference = None
+        for name, variant_encoder, variant_decoder, size in variants:
+            def score_all():
+                return [[anomaly_score(variant_encoder, variant_decoder, x)[0] for x in features]
+                        for _, _, features in test_sets]
+
+            seconds = timeit(score_all, repeat=args.repeat, number=1)
+            results = score_all()
+            auc, p_auc = mean_auc(test_sets, results, param["max_fpr"])
+            scores = np.array([score for id_results in results for score in id_results])
+            if reference is None:
+                reference = (seconds, auc, p_auc, scores)
+            print("  {:<14} {:>8.1f} {:>9.2f} {:>9.1f} {:>8.2f}x {:>8.4f} {:>8.4f} {:>+9.4f} {:>+9.4f} {:>10.2e}".format(
+                name,
+                size / 1024.0,
+                seconds * 1000 / n_files,
+                n_files / seconds,
+                reference[0] / seconds,
+                auc,
+                p_auc,
+                auc - reference[1],
+                p_auc - reference[2],
+                float(np.max(np.abs(scores - reference[3]) / reference[3]))))
+
+
+########################################################################
+
+
+########################################################################
+# columnar score table against the per machine ID csv files
+########################################################################
+def bench_score_table(args, param):
+    """
+    size and read time of the scores of a synthetic test run (6 machine types, --classes machine
+    IDs of --files_per_id files each) as anomaly_score_<machine_type>_<id>.csv files against one
+    score_table.py table.
+    """
+    import csv
+    import os
+    import tempfile
+    from score_table import ScoreTableWriter, load_score_table, load_score_csv
+
+    rng = np.random.RandomState(0)
+    machine_types = sorted(["fan", "pump", "slider", "ToyCar", "ToyConveyor", "valve"])
+    with tempfile.TemporaryDirectory() as result_dir:
+        writer = ScoreTableWriter()
+        for machine_type in machine_types:
+            for class_idx in range(args.classes):
+                machine_id = "id_{:02d}".format(class_idx)
+                files = ["{}_{}_{:08d}.wav".format("normal" if i % 2 else "anomaly", machine_id, i)
+                         for i in range(args.files_per_id)]
+                errors = rng.rand(len(files), args.classes).astype(np.float32) * 10
+                scores = errors.min(axis=1).astype(np.float64)
+                writer.append(machine_type, machine_id, files, scores, errors, labels=np.arange(len(files)) % 2 == 0)
+                with open(os.path.join(result_dir, "anomaly_score_{}_{}.csv".format(machine_type, machine_id)), "w",
+                          newline="") as f:
+                    csv.writer(f, lineterminator="\n").writerows(zip(files, scores))
+        table_path = os.path.join(result_dir, "scores.npz")
+        writer.save(table_path)
+
+        csv_size = sum(os.path.getsize(os.path.join(result_dir, name))
+                       for name in os.listdir(result_dir) if name.endswith(".csv"))
+        table_size = os.path.getsize(table_path)
+        assert np.array_equal(load_score_csv(result_dir)["score"], load_score_table(table_path, columns=["score"])["score"])
+
+        rows = [("csv files", timeit(lambda: load_score_csv(result_dir), repeat=args.repeat, number=1)),
+                ("table, all columns", timeit(lambda: load_score_table(table_path), repeat=args.repeat, number=1)),
+                ("table, csv columns", timeit(lambda: load_score_table(table_path,
+                                                                       columns=["file_name", "machine_type",
+                                                                                "machine_id", "score"]),
+                                              repeat=args.repeat, number=1)),
+                ("table, score column", timeit(lambda: load_score_table(table_path, columns=["score"]),
+                                               repeat=args.repeat, number=1))]
+
+    report("read the scores of {n} files in {c} csv files ({cs:.1f} kB) or one table ({ts:.1f} kB, "
+           "with errors and labels)".format(n=len(writer), c=len(machine_types) * args.classes,
+                                            cs=csv_size / 1024.0, ts=table_size / 1024.0), rows)
+
+
+########################################################################
+
+
+########################################################################
+# main benchmark.py
+########################################################################
+BENCHMARKS = {
+    "decode": bench_decode,
+    "decoder": bench_decoder,
+    "frames": bench_frames,
+    "frontend": bench_frontend,
+    "quantized": bench_quantized,
+    "score_table": bench_score_table,
+    "scripted": bench_scripted,
+    "threads": bench_threads,
+    "topk": bench_topk,
+    "train_loop": bench_train_loop,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="IDCAE micro-benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS.keys()) + ["all"])
+    parser.add_argument("--seconds", type=float, default=10.0, help="clip length of synthetic inputs")
+    parser.add_argument("--sr", type=int, default=16000, help="sampling rate of synthetic inputs")
+    parser.add_argument("--classes", type=int, default=4, help="number of machine IDs of synthetic models")
+    parser.add_argument("--threads", type=int, default=1, help="number of torch intra-op threads")
+    parser.add_argument("--k_list", type=str, default="1,2,4", help="comma separated k of the topk benchmark")
+    parser.add_argument("--batch_list", type=str, default="1,8,32", help="comma separated batch sizes of the frontend benchmark")
+    parser.add_argument("--batches", type=int, default=20, help="number of batches per training loop")
+    parser.add_argument("--repeat", type=int, default=5, help="number of measurements, the best is reported")
+    parser.add_argument("--wav_dir", type=str, default=None, help="directory of the wav files of the decode benchmark")
+    parser.add_argument("--max_files", type=int, default=200, help="maximum number of wav files of the decode benchmark")
+    parser.add_argument("--files_per_id", type=int, default=500, help="number of test files per machine ID of the score_table benchmark")
+    parser.add_argument("--thread_list", type=str, default="1,2,4,8", help="comma separated intra-op thread counts")
+    args = parser.parse_args()
+
+    param = com.yaml_load()
+    names = sorted(BENCHMARKS.keys()) if args.benchmark == "all" else [args.benchmark]
+    for name in names:
+        BENCHMARKS[name](args, param)
@@ -0,0 +1,130 @@
+"""
+ @file   checkpoint.py
+ @brief  Atomic model saving and training checkpoints for resuming 00_train.py
+"""
+
+########################################################################
+# import python-library
+########################################################################
+# default
+import os
+import random
+import tempfile
+
+# additional
+import numpy
+import torch
+
+# original lib
+import common as com
+########################################################################
+
+
+########################################################################
+# atomic save
+########################################################################
+def atomic_save(obj, path, save=torch.save):
+    """
+    torch.save() to a temporary file in the directory of path, then rename it.
+
+    obj : object
+        anything torch.save() accepts
+    path : str
+        destination, an interrupted write leaves the previous file untouched
+    save : callable ( default = torch.save )
+        save(obj, file) writing obj to a binary file object, e.g. torch.jit.save
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            save(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+########################################################################
+
+
+########################################################################
+# random number generators
+########################################################################
+def rng_state():
+    """
+    return : dict
+        states of the python, numpy and torch (and CUDA, if available) generators
+    """
+    state = {"python": random.getstate(),
+             "numpy": numpy.random.get_state(),
+             "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """
+    restore the generators saved by rng_state().
+
+    state : dict
+    """
+    random.setstate(state["python"])
+    numpy.random.set_state(state["numpy"])
+    # the generator states must be CPU byte tensors, whatever map_location was used to load them
+    torch.set_rng_state(state["torch"].cpu())
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([cuda_state.cpu() for cuda_state in state["cuda"]])
+
+
+########################################################################
+
+
+########################################################################
+# training checkpoints
+########################################################################
+def save_checkpoint(path, **state):
+    """
+    write a training checkpoint atomically, together with the current generator states.
+
+    path : str
+        checkpoint file
+    state : dict
+        phase, epoch, model / optimizer / scheduler state_dicts, split indices, ...
+    """
+    state["rng"] = rng_state()
+    atomic_save(state, path)
+    com.logger.info("checkpoint -> {path} ({phase} epoch {epoch})".format(path=path,
+                                                                       phase=state.get("phase"),
+                                                                       epoch=state.get("epoch")))
+
+
+def load_checkpoint(path, device=None):
+    """
+    path : str
+        checkpoint file
+    device : torch.device ( default = None )
+        tensors are loaded onto this device, None keeps the saved devices
+
+    return : dict or None
+        the checkpoint, None when there is none or it cannot be read
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        # the checkpoint holds numpy arrays and generator states besides tensors
+        try:
+            return torch.load(path, map_location=device, weights_only=False)
+        except TypeError:
+            return torch.load(path, map_location=device)
+    except Exception:
+        com.logger.warning("checkpoint broken, starting over : {}".format(path))
+        return None
+
+
+########################################################################
@@ -15,6 +15,9 @@ import sys
 import os
 import itertools
 import re
+import struct
+import time
+import concurrent.futures
 
 # additional
 import numpy
@@ -55,16 +58,46 @@ __versions__ = "1.0.0"
 ########################################################################
 # argparse
 ########################################################################
-def command_line_chk():
+def command_line_chk(param=None):
+    """
+    param : dict ( default = None )
+        baseline.yaml data, when given the runtime options of the command line
+        (--device, --threads, --interop_threads, --workers) override param["runtime"]
+        and the scheduling options (--machines, --jobs, --job_threads) override param["schedule"]
+
+    return : boolean or None
+        True for development mode, False for evaluation mode, None for incorrect arguments
+    """
     parser = argparse.ArgumentParser(description='Without option argument, it will not run properly.')
     parser.add_argument('-v', '--version', action='store_true', help="show application version")
     parser.add_argument('-e', '--eval', action='store_true', help="run mode Evaluation")
     parser.add_argument('-d', '--dev', action='store_true', help="run mode Development")
+    parser.add_argument('--device', type=str, default=None, help="torch device: auto, cpu, cuda or cuda:<n>")
+    parser.add_argument('--threads', type=int, default=None, help="number of intra-op threads (0: torch default)")
+    parser.add_argument('--interop_threads', type=int, default=None, help="number of inter-op threads (0: torch default)")
+    parser.add_argument('--workers', type=int, default=None, help="number of batch prefetch workers")
+    parser.add_argument('--machines', type=str, default=None, help="machine types to process: all or a comma separated list")
+    parser.add_argument('--jobs', type=int, default=None, help="number of machine types trained concurrently")
+    parser.add_argument('--job_threads', type=int, default=None, help="intra-op threads per training job (0: share the cores)")
     args = parser.parse_args()
     if args.version:
         print("===============================")
         print("DCASE 2020 task 2 baseline\nversion {}".format(__versions__))
         print("===============================\n")
+    if param is not None:
+        runtime = param.setdefault("runtime", {})
+        for key, value in (("device", args.device),
+                           ("intra_op_threads", args.threads),
+                           ("inter_op_threads", args.interop_threads),
+                           ("num_workers", args.workers)):
+            if value is not None:
+                runtime[key] = value
+        schedule = param.setdefault("schedule", {})
+        for key, value in (("machines", args.machines),
+                           ("jobs", args.jobs),
+                           ("job_threads", args.job_threads)):
+            if value is not None:
+                schedule[key] = value
     if args.eval ^ args.dev:
         if args.dev:
             flag = True
@@ -89,14 +122,173 @@ def yaml_load():
 ########################################################################
 
 
+########################################################################
+# torch runtime
+########################################################################
+def setup_runtime(param):
+    """
+    select the torch device and set the torch thread pools from param["runtime"].
+
+    param : dict
+        baseline.yaml data
+
+    return : torch.device
+        "auto" selects cuda when it is available, a requested cuda device
+        that is not available falls back to the cpu
+    """
+    import torch
+
+    runtime = param.get("runtime") or {}
+    device_name = str(runtime.get("device") or "auto")
+    if device_name == "auto":
+        device_name = "cuda" if torch.cuda.is_available() else "cpu"
+    elif device_name.startswith("cuda") and not torch.cuda.is_available():
+        logger.warning("{} is not available, fall back to cpu".format(device_name))
+        device_name = "cpu"
+    device = torch.device(device_name)
+
+    intra_op_threads = int(runtime.get("intra_op_threads") or 0)
+    inter_op_threads = int(runtime.get("inter_op_threads") or 0)
+    if intra_op_threads > 0:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads > 0:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            # can only be set once, before any inter-op parallel work started
+            logger.warning("inter-op threads already set to {}".format(torch.get_num_interop_threads()))
+    logger.info("device : {device}, intra-op threads : {intra}, inter-op threads : {inter}".format(
+        device=device, intra=torch.get_num_threads(), inter=torch.get_num_interop_threads()))
+    return device
+
+########################################################################
+
+
 ########################################################################
 # file I/O
 ########################################################################
+# sample formats read by wav_read(): (format tag, bits per sample) -> (dtype, scale to [-1, 1))
+WAV_PCM = 1
+WAV_IEEE_FLOAT = 3
+WAV_EXTENSIBLE = 0xFFFE
+WAV_SAMPLE_FORMATS = {(WAV_PCM, 8): ("u1", 1.0 / 128),
+                      (WAV_PCM, 16): ("<i2", 1.0 / 32768),
+                      (WAV_PCM, 32): ("<i4", 1.0 / 2147483648),
+                      (WAV_IEEE_FLOAT, 32): ("<f4", 1.0),
+                      (WAV_IEEE_FLOAT, 64): ("<f8", 1.0)}
+
+
+def wav_header(wav_name):
+    """
+    parse the RIFF header of a .wav file, whatever its sample format.
+
+    wav_name : str
+        target .wav file
+
+    return : dict
+        format_tag, channels, sr, bits, offset (of the sample data in bytes),
+        data_size (in bytes) and n_samples (per channel)
+
+    raise : ValueError
+        the file is not a RIFF / WAVE file or its header is broken
+    """
+    with open(wav_name, "rb") as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+            raise ValueError("not a RIFF / WAVE file")
+        file_size = os.fstat(f.fileno()).st_size
+        fmt = None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                raise ValueError("no data chunk")
+            chunk_id, chunk_size = chunk[:4], int.from_bytes(chunk[4:], "little")
+            if chunk_id == b"fmt ":
+                fmt = f.read(chunk_size)
+                if len(fmt) < 16:
+                    raise ValueError("fmt chunk too short")
+                format_tag, channels, sr = struct.unpack("<HHI", fmt[:8])
+                bits = struct.unpack("<H", fmt[14:16])[0]
+                if format_tag == WAV_EXTENSIBLE and len(fmt) >= 26:
+                    # the sub format GUID starts with the actual format tag
+                    format_tag = struct.unpack("<H", fmt[24:26])[0]
+            elif chunk_id == b"data":
+                if fmt is None:
+                    raise ValueError("data chunk before fmt chunk")
+                offset = f.tell()
+                # streamed files may leave the size at 0 or 0xFFFFFFFF, the data runs to the end of the file
+                data_size = min(chunk_size, file_size - offset) if chunk_size else file_size - offset
+                break
+            else:
+                f.seek(chunk_size, os.SEEK_CUR)
+            if chunk_size % 2:
+                # chunks are word aligned
+                f.seek(1, os.SEEK_CUR)
+
+    if channels == 0 or bits == 0 or sr == 0:
+        raise ValueError("broken fmt chunk")
+    return {"format_tag": format_tag,
+            "channels": channels,
+            "sr": sr,
+            "bits": bits,
+            "offset": offset,
+            "data_size": data_size,
+            "n_samples": data_size // (channels * ((bits + 7) // 8))}
+
+
+def wav_read(wav_name, mono=False):
+    """
+    read a PCM or float .wav file without librosa.
+
+    The RIFF header is parsed directly (wav_header()) and the sample data is memory-mapped and
+    converted to float32 in one step, with the same scaling as librosa.load() (soundfile):
+    int16 / 32768, 8 bit offset by 128, float samples unchanged.
+
+    wav_name : str
+        target .wav file
+    mono : boolean
+        average the channels of a multi channels file
+
+    return : numpy.array( float32 ), int
+        samples, shape = (n_samples, ) or (channels, n_samples) like librosa.load(), and sampling rate
+
+    raise : ValueError
+        the file is not a RIFF / WAVE file or its sample format is not in WAV_SAMPLE_FORMATS
+        (24 bit, compressed, ...), use librosa.load() instead
+    """
+    header = wav_header(wav_name)
+    format_tag, channels, sr, bits = header["format_tag"], header["channels"], header["sr"], header["bits"]
+    offset, n_samples = header["offset"], header["n_samples"]
+
+    if (format_tag, bits) not in WAV_SAMPLE_FORMATS:
+        raise ValueError("unsupported sample format {} / {} bits".format(format_tag, bits))
+    dtype, scale = WAV_SAMPLE_FORMATS[(format_tag, bits)]
+    if n_samples == 0:
+        return numpy.zeros((channels, 0) if channels > 1 and not mono else 0, dtype=numpy.float32), sr
+
+    samples = numpy.memmap(wav_name, dtype=dtype, mode="r", offset=offset, shape=(n_samples, channels))
+    if dtype == "u1":
+        y = (samples.astype(numpy.float32) - 128.0) * numpy.float32(scale)
+    elif scale != 1.0:
+        y = numpy.multiply(samples, numpy.float32(scale), dtype=numpy.float32)
+    else:
+        y = numpy.array(samples, dtype=numpy.float32)
+    del samples
+
+    if channels == 1:
+        return y[:, 0], sr
+    if mono:
+        return numpy.mean(y, axis=1, dtype=numpy.float32), sr
+    return numpy.ascontiguousarray(y.T), sr
+
+
 # wav file Input
 def file_load(wav_name, mono=False):
     """
     load .wav file.
 
+    PCM and float wav files are read by wav_read(), other formats by librosa.load().
+
     wav_name : str
         target .wav file
     sampling_rate : int
@@ -104,10 +296,13 @@ def file_load(wav_name, mono=False):
     mono : boolean
         When load a multi channels file and this param True, the returned data will be merged for mono data
 
-    return : numpy.array( float )
+    return : numpy.array( float32 )
     """
     try:
-        return librosa.load(wav_name, sr=None, mono=mono)
+        try:
+            return wav_read(wav_name, mono=mono)
+        except ValueError:
+            return librosa.load(wav_name, sr=None, mono=mono)
     except:
         logger.error("file_broken or not exists!! : {}".format(wav_name))
 
@@ -118,24 +313,31 @@ def file_load(wav_name, mono=False):
 ########################################################################
 # feature extractor
 ########################################################################
-def file_to_vector_array(file_name,
-                         n_mels=64,
-                         frames=5,
-                         n_fft=1024,
-                         hop_length=512,
-                         power=2.0):
+def file_to_log_mel(file_name,
+                    n_mels=64,
+                    n_fft=1024,
+                    hop_length=512,
+                    power=2.0,
+                    cache=None):
     """
-    convert file_name to a vector array.
+    convert file_name to a log mel spectrogram.
 
     file_name : str
         target .wav file
+    cache : FeatureCache ( default = None )
+        when given, the log mel spectrogram is read from / written to the on-disk cache
 
-    return : numpy.array( numpy.array( float ) )
-        vector array
-        * dataset.shape = (dataset_size, feature_vector_length)
+    return : numpy.array( numpy.array( float32 ) )
+        log mel spectrogram
+        * shape = (n_mels, n_frames)
     """
-    # 01 calculate the number of dimensions
-    dims = n_mels * frames
+    key = None
+    if cache is not None:
+        key = cache.key(file_name, n_mels=n_mels, n_fft=n_fft, hop_length=hop_length, power=power)
+        if key is not None:
+            log_mel_spectrogram = cache.get(key)
+            if log_mel_spectrogram is not None:
+                return log_mel_spectrogram
 
     # 02 generate melspectrogram using librosa
     y, sr = file_load(file_name)
@@ -148,31 +350,186 @@ def file_to_vector_array(file_name,
 
     # 03 convert melspectrogram to log mel energy
     log_mel_spectrogram = 20.0 / power * numpy.log10(mel_spectrogram + sys.float_info.epsilon)
+    log_mel_spectrogram = log_mel_spectrogram.astype("float32")
+
+    if key is not None:
+        cache.put(key, log_mel_spectrogram)
+    return log_mel_spectrogram
+
+
+def file_to_vector_array(file_name,
+                         n_mels=64,
+                         frames=5,
+                         n_fft=1024,
+                         hop_length=512,
+                         power=2.0,
+                         cache=None):
+    """
+    convert file_name to a vector array.
+
+    file_name : str
+        target .wav file
+    cache : FeatureCache ( default = None )
+        on-disk log mel cache, see file_to_log_mel()
+
+    return : numpy.array( numpy.array( float ) )
+        vector array
+        * dataset.shape = (dataset_size, feature_vector_length)
+        * read-only strided view, consecutive rows share memory
+    """
+    # 02-03 generate log mel spectrogram (or read it from the cache)
+    log_mel_spectrogram = file_to_log_mel(file_name,
+                                          n_mels=n_mels,
+                                          n_fft=n_fft,
+                                          hop_length=hop_length,
+                                          power=power,
+                                          cache=cache)
     
+    # 04-08 standardize and stack the frames
+    return log_mel_to_vector_array(log_mel_spectrogram, n_mels=n_mels, frames=frames)
+
+
+def log_mel_to_vector_array(log_mel_spectrogram,
+                            n_mels=64,
+                            frames=5):
+    """
+    concatenate the standardized frames of a log mel spectrogram to multiframe vectors,
+    step 04-08 of file_to_vector_array().
+
+    log_mel_spectrogram : numpy.array( float )
+        shape = (n_mels, n_frames)
+
+    return : numpy.array( numpy.array( float ) )
+        vector array, read-only strided view, consecutive rows share memory
+    """
+    # 01 calculate the number of dimensions
+    dims = n_mels * frames
+
     # 04 calculate total vector size
-    log_mel_spectrogram = log_mel_spectrogram.astype("float32")
-    vector_array_size = len(log_mel_spectrogram[0, :]) - frames + 1
+    vector_array_size = log_mel_spectrogram.shape[1] - frames + 1
 
     # 05 skip too short clips
     if vector_array_size < 1:
         return numpy.empty((0, dims))
 
-    # 06 generate feature vectors by concatenating multiframes
-
-    vector_array = numpy.zeros((vector_array_size, dims), dtype=numpy.float32)
-
-    # 07 standardization
+    # 06 standardization statistics of each frame
     mean = numpy.mean(log_mel_spectrogram, dtype=numpy.float32, axis=0, keepdims=True)
     std = numpy.std(log_mel_spectrogram, dtype=numpy.float32, axis=0, keepdims=True)
-    log_mel_spectrogram = (log_mel_spectrogram - mean) / std
+
+    # 07 standardization, done in place on a (n_frames, n_mels) copy
+    log_mel_spectrogram = numpy.array(log_mel_spectrogram.T, dtype=numpy.float32, order="C")
+    log_mel_spectrogram -= mean.T
+    log_mel_spectrogram /= std.T
 
     # 08 create dataset
-    for t in range(frames):
-        vector_array[:, n_mels * t: n_mels * (t + 1)] = log_mel_spectrogram[:, t: t + vector_array_size].T
+    # frames t .. t+frames-1 are consecutive rows of the C-ordered copy, so the concatenated
+    # multiframe vectors are a sliding window over its memory and need no copy at all
+    item_size = log_mel_spectrogram.itemsize
+    vector_array = numpy.lib.stride_tricks.as_strided(log_mel_spectrogram,
+                                                      shape=(vector_array_size, dims),
+                                                      strides=(n_mels * item_size, item_size),
+                                                      writeable=False)
 
     return vector_array
 
 
+def _vector_array_worker(task):
+    """
+    process pool entry point of iter_vector_arrays().
+
+    return : (int, float, numpy.array or None)
+        worker pid, elapsed seconds and the vector array (None if the file is broken)
+    """
+    file_name, kwargs = task
+    start = time.time()
+    try:
+        vector_array = file_to_vector_array(file_name, **kwargs)
+    except Exception:
+        logger.error("file broken!!: {}".format(file_name))
+        vector_array = None
+    return os.getpid(), time.time() - start, vector_array
+
+
+def _vector_array_chunk_worker(tasks):
+    """
+    process pool entry point of iter_vector_arrays(), converts a chunk of files.
+
+    return : list [ (int, float, numpy.array or None) ]
+        see _vector_array_worker()
+    """
+    return [_vector_array_worker(task) for task in tasks]
+
+
+def _bounded_map(executor, tasks, chunksize, window):
+    """
+    ordered results of the tasks, with at most `window` chunks submitted and not yet consumed,
+    so the finished vector arrays waiting in the executor stay bounded.
+    """
+    chunks = iter(lambda: list(itertools.islice(tasks, chunksize)), [])
+    futures = [executor.submit(_vector_array_chunk_worker, chunk) for chunk in itertools.islice(chunks, window)]
+    while futures:
+        future = futures.pop(0)
+        for chunk in itertools.islice(chunks, 1):
+            futures.append(executor.submit(_vector_array_chunk_worker, chunk))
+        for result in future.result():
+            yield result
+
+
+def iter_vector_arrays(file_list,
+                       n_jobs=1,
+                       chunksize=16,
+                       **kwargs):
+    """
+    convert every file of file_list to a vector array, optionally in a process pool.
+    results are yielded in the order of file_list, so the output is identical to calling
+    file_to_vector_array() in a loop.
+
+    file_list : list [ str ]
+        .wav filename list
+    n_jobs : int ( default = 1 )
+        number of worker processes, 1 runs in the calling process and
+        a value <= 0 uses every CPU core
+    chunksize : int ( default = 16 )
+        number of files submitted to a worker at once, at most 2 chunks per worker are
+        extracted ahead of the consumer
+    kwargs :
+        feature parameters passed to file_to_vector_array()
+
+    return : generator of numpy.array( numpy.array( float ) ) or None
+        vector array per file, None for broken files
+    """
+    if n_jobs <= 0:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = min(n_jobs, max(len(file_list), 1))
+    tasks = ((file_name, kwargs) for file_name in file_list)
+
+    stats = {}
+    start = time.time()
+    if n_jobs == 1:
+        results = map(_vector_array_worker, tasks)
+        executor = None
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs)
+        results = _bounded_map(executor, tasks, max(int(chunksize), 1), window=2 * n_jobs)
+    try:
+        for pid, elapsed, vector_array in results:
+            n_files, busy = stats.get(pid, (0, 0.0))
+            stats[pid] = (n_files + 1, busy + elapsed)
+            yield vector_array
+    finally:
+        if executor is not None:
+            # a consumer that stops early waits for the running chunks only
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    # report per worker throughput
+    wall = time.time() - start
+    for pid, (n_files, busy) in sorted(stats.items()):
+        logger.info("extract worker {pid} : {n} files, {rate:.1f} files/s busy, {util:.0%} utilization".format(
+            pid=pid, n=n_files, rate=n_files / max(busy, 1e-9), util=busy / max(wall, 1e-9)))
+    logger.info("extract total : {n} files in {wall:.1f} s ({rate:.1f} files/s, {jobs} jobs)".format(
+        n=len(file_list), wall=wall, rate=len(file_list) / max(wall, 1e-9), jobs=n_jobs))
+
+
 # load dataset
 def select_dirs(param, mode):
     """
@@ -187,22 +544,50 @@ def select_dirs(param, mode):
             dirs : list [ str ]
                 load base directory list of eval_data
     """
+    # imported here, dataset_index itself imports common
+    from dataset_index import open_dataset_index
+
     if mode:
         logger.info("load_directory <- development")
-        dir_path = os.path.abspath("{base}/*".format(base=param["dev_directory"]))
-        dirs = sorted(glob.glob(dir_path))
+        base_dir = param["dev_directory"]
     else:
         logger.info("load_directory <- evaluation")
-        dir_path = os.path.abspath("{base}/*".format(base=param["eval_directory"]))
-        dirs = sorted(glob.glob(dir_path))
+        base_dir = param["eval_directory"]
+    index = open_dataset_index(base_dir, param.get("dataset_index"))
+    if index is not None:
+        return index.machine_dirs()
+    dir_path = os.path.abspath("{base}/*".format(base=base_dir))
+    dirs = sorted(glob.glob(dir_path))
     return dirs
 
+
+def select_machines(dirs, machines="all"):
+    """
+    dirs : list [ str ]
+        base directory list, see select_dirs()
+    machines : str or list [ str ] ( default = "all" )
+        "all", or the machine types to keep as a comma separated string or a list
+
+    return : list [ str ]
+        base directories of the requested machine types, in the order of dirs
+    """
+    if machines is None or machines == "all":
+        return list(dirs)
+    if isinstance(machines, str):
+        machines = [machine.strip() for machine in machines.split(",") if machine.strip()]
+    found = {os.path.split(dir)[1]: dir for dir in dirs}
+    unknown = [machine for machine in machines if machine not in found]
+    if unknown:
+        logger.warning("unknown machine types ignored: {}".format(", ".join(unknown)))
+    return [dir for dir in dirs if os.path.split(dir)[1] in machines]
+
 ########################################################################
 
 ########################################################################
 def get_machine_id_list(target_dir,
                                  dir_name="test",
-                                 ext="wav"):
+                                 ext="wav",
+                                 index_param=None):
     """
     target_dir : str
         base directory path of "dev_data" or "eval_data"
@@ -210,11 +595,20 @@ def get_machine_id_list(target_dir,
         directory containing test data
     ext : str (default="wav)
         file extension of audio files
+    index_param : dict (default=None)
+        dataset_index section of baseline.yaml, None lists the files with glob
 
     return :
         machine_id_list : list [ str ]
             list of machine IDs extracted from the names of test files
     """
+    from dataset_index import index_of
+
+    if ext == "wav":
+        index, machine_type = index_of(target_dir, index_param)
+        if index is not None and not index.unparsed(machine_type, dir_name):
+            return index.machine_ids(machine_type, dir_name)
+
     # create test files
     dir_path = os.path.abspath("{dir}/{dir_name}/*.{ext}".format(dir=target_dir, dir_name=dir_name, ext=ext))
     file_paths = sorted(glob.glob(dir_path))
@@ -0,0 +1,328 @@
+"""
+ @file   dataset_index.py
+ @brief  Incrementally maintained index of the wav files of dev_data / eval_data
+"""
+
+########################################################################
+# import python-library
+########################################################################
+# default
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+# original lib
+import common as com
+########################################################################
+
+
+########################################################################
+# version
+########################################################################
+# bump when the layout of the index changes
+__index_version__ = "1"
+########################################################################
+
+
+########################################################################
+# dataset index
+########################################################################
+# <condition>_id_<nn>_<clip>.wav in dev_data, id_<nn>_<clip>.wav in the eval_data test sets
+FILE_NAME_PATTERN = re.compile(r"^(?:(normal|anomaly)_)?(id_[0-9][0-9])_([0-9]+)\.wav$")
+
+# columns of the file records in the index
+COLUMNS = ["name", "condition", "machine_id", "clip", "duration", "size", "mtime_ns"]
+
+
+def parse_file_name(name):
+    """
+    name : str
+        base name of a wav file, e.g. normal_id_01_00000000.wav
+
+    return : (str or None, str or None, int or None)
+        condition ("normal", "anomaly" or None), machine ID (e.g. "id_01") and clip index,
+        all None when the name does not follow the DCASE naming
+    """
+    match = FILE_NAME_PATTERN.match(name)
+    if match is None:
+        return None, None, None
+    return match.group(1), match.group(2), int(match.group(3))
+
+
+def wav_duration(path):
+    """
+    return : float or None
+        length in seconds read from the wav header, None when it cannot be parsed
+    """
+    try:
+        header = com.wav_header(path)
+    except (OSError, ValueError):
+        return None
+    return header["n_samples"] / float(header["sr"])
+
+
+class DatasetIndex(object):
+    """
+    Index of the wav files under a dataset base directory (dev_data or eval_data).
+
+    The index is a json file holding, for every <machine_type>/<split> directory, its
+    modification time and one record per wav file: name, condition (normal / anomaly),
+    machine ID, clip index, duration, size and modification time. Listing queries are
+    answered from dictionaries built when the index is opened, without touching the
+    dataset directories.
+
+    refresh() brings the index up to date incrementally: a directory whose modification
+    time did not change is not listed again; in a changed directory only the files that
+    are new or whose size / mtime changed are parsed. A file rewritten in place leaves the
+    directory mtime alone and is not noticed, remove the index file to rebuild it.
+
+    Files whose name is not <normal|anomaly>_id_<nn>_<clip>.wav (or id_<nn>_<clip>.wav) are
+    kept without condition and machine ID; unparsed() reports them, so that callers glob
+    those splits as before instead of missing files.
+
+    base_dir : str
+        dataset base directory, its sub directories are the machine types
+    index_path : str
+        json file of the index
+    """
+    def __init__(self, base_dir, index_path):
+        self.base_dir = os.path.abspath(base_dir)
+        self.index_path = index_path
+        self.data = self._load()
+        self.refresh()
+
+    def _load(self):
+        try:
+            with open(self.index_path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {"version": __index_version__, "base_dir": self.base_dir, "mtime_ns": None, "machine_types": {}}
+        if data.get("version") != __index_version__ or data.get("base_dir") != self.base_dir:
+            return {"version": __index_version__, "base_dir": self.base_dir, "mtime_ns": None, "machine_types": {}}
+        return data
+
+    def _save(self):
+        directory = os.path.dirname(os.path.abspath(self.index_path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.data, f, separators=(",", ":"))
+        os.replace(tmp_path, self.index_path)
+
+    def _scan_split(self, path, old):
+        """
+        list a split directory again, reusing the records of unchanged files.
+
+        return : list [ list ]
+            records sorted by name, see COLUMNS
+        """
+        reused = {record[0]: record for record in (old or {}).get("files", [])}
+        records = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".wav") or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                record = reused.get(entry.name)
+                if record is None or record[5] != stat.st_size or record[6] != stat.st_mtime_ns:
+                    condition, machine_id, clip = parse_file_name(entry.name)
+                    record = [entry.name, condition, machine_id, clip, wav_duration(entry.path), stat.st_size, stat.st_mtime_ns]
+                records.append(record)
+        records.sort(key=lambda record: record[0])
+        return records
+
+    def refresh(self):
+        """
+        bring the index up to date with the directories and save it when something changed.
+
+        return : int
+            number of rescanned split directories
+        """
+        rescanned = 0
+        try:
+            base_mtime = os.stat(self.base_dir).st_mtime_ns
+        except OSError:
+            base_mtime = None
+        machine_types = self.data["machine_types"]
+        if base_mtime != self.data["mtime_ns"]:
+            names = sorted(entry.name for entry in os.scandir(self.base_dir) if entry.is_dir()) if base_mtime else []
+            machine_types = {name: machine_types.get(name, {"mtime_ns": None, "splits": {}}) for name in names}
+            self.data["mtime_ns"] = base_mtime
+            rescanned += 1
+
+        for machine_type, machine in machine_types.items():
+            machine_dir = os.path.join(self.base_dir, machine_type)
+            try:
+                machine_mtime = os.stat(machine_dir).st_mtime_ns
+            except OSError:
+                continue
+            splits = machine["splits"]
+            if machine_mtime != machine["mtime_ns"]:
+                names = sorted(entry.name for entry in os.scandir(machine_dir) if entry.is_dir())
+                splits = {name: splits.get(name, {"mtime_ns": None, "files": []}) for name in names}
+                machine["mtime_ns"] = machine_mtime
+                rescanned += 1
+            for split, old in list(splits.items()):
+                split_dir = os.path.join(machine_dir, split)
+                try:
+                    split_mtime = os.stat(split_dir).st_mtime_ns
+                except OSError:
+                    del splits[split]
+                    continue
+                if split_mtime != old["mtime_ns"]:
+                    splits[split] = {"mtime_ns": split_mtime, "files": self._scan_split(split_dir, old)}
+                    rescanned += 1
+            machine["splits"] = splits
+
+        self.data["machine_types"] = machine_types
+        self.data["columns"] = COLUMNS
+        if rescanned:
+            self._save()
+            com.logger.info("dataset index -> {} ({} directories rescanned)".format(self.index_path, rescanned))
+        self._build_lookups()
+        return rescanned
+
+    def _build_lookups(self):
+        # (machine_type, split, machine_id, condition) -> sorted paths, None matches any value
+        self._files = {}
+        self._ids = {}
+        self._records = {}
+        self._unparsed = {}
+        for machine_type, machine in self.data["machine_types"].items():
+            for split, entry in machine["splits"].items():
+                ids = set()
+                split_dir = os.path.join(self.base_dir, machine_type, split)
+                self._records[(machine_type, split)] = entry["files"]
+                for name, condition, machine_id, _, _, _, _ in entry["files"]:
+                    path = os.path.join(split_dir, name)
+                    for key_id in (None, machine_id):
+                        for key_condition in (None, condition):
+                            if (key_id is None or machine_id is not None) and (key_condition is None or condition is not None):
+                                self._files.setdefault((machine_type, split, key_id, key_condition), []).append(path)
+                    if machine_id is not None:
+                        ids.add(machine_id)
+                    else:
+                        self._unparsed.setdefault((machine_type, split), []).append(name)
+                self._ids[(machine_type, split)] = sorted(ids)
+                unparsed = self._unparsed.get((machine_type, split))
+                if unparsed:
+                    com.logger.warning("dataset index : {} wav files of {} do not follow the DCASE naming "
+                                       "and are listed with glob, e.g. {}".format(len(unparsed), split_dir, unparsed[0]))
+
+    def machine_dirs(self):
+        """
+        return : list [ str ]
+            absolute path of every machine type directory, sorted
+        """
+        return [os.path.join(self.base_dir, name) for name in sorted(self.data["machine_types"])]
+
+    def machine_ids(self, machine_type, split):
+        """
+        return : list [ str ]
+            sorted machine IDs (e.g. "id_01") of the files of a split
+        """
+        return list(self._ids.get((machine_type, split), []))
+
+    def unparsed(self, machine_type, split):
+        """
+        return : list [ str ]
+            names of the wav files of a split that do not follow the DCASE naming
+        """
+        return list(self._unparsed.get((machine_type, split), []))
+
+    def files(self, machine_type, split, machine_id=None, condition=None):
+        """
+        machine_type : str
+        split : str
+            "train" or "test"
+        machine_id : str ( default = None )
+            e.g. "id_01", None for all of them
+        condition : str ( default = None )
+            "normal" or "anomaly", None for all files
+
+        return : list [ str ]
+            absolute paths sorted by name
+        """
+        return list(self._files.get((machine_type, split, machine_id, condition), []))
+
+    def records(self, machine_type, split):
+        """
+        return : list [ dict ]
+            every indexed file of a split with the fields of COLUMNS, sorted by name
+        """
+        return [dict(zip(COLUMNS, record)) for record in self._records.get((machine_type, split), [])]
+
+
+########################################################################
+
+
+########################################################################
+# indexes of the current process
+########################################################################
+_indexes = {}
+
+
+def open_dataset_index(base_dir, index_param):
+    """
+    open (and refresh) the index of a dataset base directory once per process.
+
+    base_dir : str
+        dataset base directory, e.g. ./dev_data
+    index_param : dict or None
+        dataset_index section of baseline.yaml: enabled and the directory of the index
+        files, one per base directory
+
+    return : DatasetIndex or None
+        None when the index is disabled or the base directory does not exist
+    """
+    if not index_param or not index_param.get("enabled", False):
+        return None
+    base_dir = os.path.abspath(base_dir)
+    if not os.path.isdir(base_dir):
+        return None
+    index_path = os.path.abspath(os.path.join(index_param["directory"], "{name}_{digest}.json".format(
+        name=os.path.basename(base_dir), digest=hashlib.sha1(base_dir.encode("utf-8")).hexdigest()[:10])))
+    if index_path not in _indexes:
+        _indexes[index_path] = DatasetIndex(base_dir, index_path)
+    return _indexes[index_path]
+
+
+def index_of(target_dir, index_param):
+    """
+    target_dir : str
+        machine type directory, e.g. ./dev_data/fan
+    index_param : dict or None
+        dataset_index section of baseline.yaml, see open_dataset_index()
+
+    return : DatasetIndex or None, str
+        index of its base directory and the machine type
+    """
+    target_dir = os.path.abspath(target_dir)
+    return open_dataset_index(os.path.dirname(target_dir), index_param), os.path.basename(target_dir)
+
+
+def indexed_files(target_dir, dir_name, index_param, machine_id=None, condition=None):
+    """
+    list the wav files of a split from the index instead of a glob.
+
+    target_dir : str
+        machine type directory, e.g. ./dev_data/fan
+    dir_name : str
+        split directory, "train" or "test"
+    index_param : dict or None
+        dataset_index section of baseline.yaml, see open_dataset_index()
+    machine_id, condition : str ( default = None )
+        see DatasetIndex.files()
+
+    return : list [ str ] or None
+        absolute paths sorted by name, None when the index is disabled or the split holds
+        files it cannot parse, the caller then globs
+    """
+    index, machine_type = index_of(target_dir, index_param)
+    if index is None or index.unparsed(machine_type, dir_name):
+        return None
+    return index.files(machine_type, dir_name, machine_id=machine_id, condition=condition)
+
+########################################################################
@@ -0,0 +1,282 @@
+"""
+ @file   export.py
+ @brief  Fold the BatchNorm layers of trained models and export TorchScript scoring artifacts (fp32 and int8)
+"""
+
+########################################################################
+# import python-library
+########################################################################
+# default
+import copy
+import os
+import sys
+from typing import Tuple
+
+# additional
+import torch
+import torch.nn as nn
+
+# original lib
+import common as com
+from checkpoint import atomic_save
+from pytorch_model import condition_label
+from scoring import load_models, frame_errors
+########################################################################
+
+
+########################################################################
+# BatchNorm folding
+########################################################################
+def fold_batchnorm(linear, batch_norm):
+    """
+    fold an eval mode BatchNorm1d into the Linear layer in front of it.
+
+    BatchNorm1d(Linear(x)) = scale * (W x + b - running_mean) + beta
+                           = (scale * W) x + scale * (b - running_mean) + beta
+    with scale = gamma / sqrt(running_var + eps).
+
+    linear : nn.Linear
+    batch_norm : nn.BatchNorm1d
+
+    return : nn.Linear
+        a new layer computing both, the arguments are left untouched
+    """
+    with torch.no_grad():
+        scale = batch_norm.running_var.double().add(batch_norm.eps).rsqrt()
+        if batch_norm.weight is not None:
+            scale = scale * batch_norm.weight.double()
+        bias = linear.bias.double() if linear.bias is not None else torch.zeros_like(scale)
+        bias = (bias - batch_norm.running_mean.double()) * scale
+        if batch_norm.bias is not None:
+            bias = bias + batch_norm.bias.double()
+
+        folded = nn.Linear(linear.in_features, linear.out_features)
+        folded.weight.copy_(linear.weight.double() * scale.unsqueeze(1))
+        folded.bias.copy_(bias)
+    return folded.to(linear.weight.device)
+
+
+def fold_sequential(layers):
+    """
+    layers : nn.Sequential
+        Linear / BatchNorm1d / activation layers
+
+    return : nn.Sequential
+        copy of the layers with every Linear followed by a BatchNorm1d replaced by fold_batchnorm()
+    """
+    folded = []
+    layers = list(layers)
+    i = 0
+    while i < len(layers):
+        layer = layers[i]
+        if isinstance(layer, nn.Linear) and i + 1 < len(layers) and isinstance(layers[i + 1], nn.BatchNorm1d):
+            folded.append(fold_batchnorm(layer, layers[i + 1]))
+            i += 2
+        else:
+            folded.append(copy.deepcopy(layer))
+            i += 1
+    return nn.Sequential(*folded)
+
+
+########################################################################
+
+
+########################################################################
+# folded models
+########################################################################
+class FoldedEncoder(nn.Module):
+    """
+    Encoder with the BatchNorm layers folded into the Linear layers, same outputs in eval mode.
+    """
+    def __init__(self, encoder):
+        super(FoldedEncoder, self).__init__()
+        self.encoder = fold_sequential(encoder.encoder)
+        self.classifier = copy.deepcopy(encoder.classifier)
+
+    def forward(self, x) -> Tuple[torch.Tensor, torch.Tensor]:
+        latent = self.encoder(x)
+        cls_output = self.classifier(latent)
+        return latent, cls_output
+
+
+class FoldedDecoder(nn.Module):
+    """
+    Decoder for scoring only.
+
+    The conditioning vectors of the machine IDs are constants, so the conditioning layers
+    are evaluated once at export and their outputs Hr and Hb of every class are stored as
+    buffers. The BatchNorm layers of the decoder are folded into its Linear layers.
+    reconstruct_all() and reconstruct_classes() match those of Decoder in eval mode.
+    """
+    def __init__(self, decoder):
+        super(FoldedDecoder, self).__init__()
+        self.class_num = decoder.class_num
+        with torch.no_grad():
+            label = condition_label(torch.arange(self.class_num, device=decoder.decoder[0].weight.device),
+                                    self.class_num)
+            self.register_buffer("Hr", decoder.condition_layer_Hr.eval()(label).clone())
+            self.register_buffer("Hb", decoder.condition_layer_Hb.eval()(label).clone())
+        self.decoder = fold_sequential(decoder.decoder)
+
+    @torch.jit.export
+    def reconstruct_all(self, latent):
+        cond_latent = latent.unsqueeze(0) * self.Hr.unsqueeze(1) + self.Hb.unsqueeze(1)
+        output = self.decoder(cond_latent.view(-1, latent.shape[1]))
+        return output.view(self.class_num, latent.shape[0], -1)
+
+    @torch.jit.export
+    def reconstruct_classes(self, latent, classes):
+        cond_latent = latent.unsqueeze(1) * self.Hr[classes] + self.Hb[classes]
+        output = self.decoder(cond_latent.view(-1, latent.shape[1]))
+        return output.view(latent.shape[0], classes.shape[1], -1)
+
+    def forward(self, latent):
+        return self.reconstruct_all(latent)
+
+
+class ScoringModel(nn.Module):
+    """
+    Folded encoder and decoder of one machine type in a single module.
+
+    forward() is the whole scoring graph (encoder, conditioning and decoder) and returns the
+    same per class and frame errors as scoring.frame_errors(). The encoder and decoder
+    submodules keep the interface of Encoder / Decoder used by scoring.py and inference.py.
+
+    frames, n_mels : int
+        feature parameters the models were trained with, kept to check the test settings
+    """
+    def __init__(self, encoder, decoder, frames, n_mels):
+        super(ScoringModel, self).__init__()
+        self.frames = frames
+        self.n_mels = n_mels
+        self.encoder = FoldedEncoder(encoder)
+        self.decoder = FoldedDecoder(decoder)
+
+    def forward(self, features):
+        latent, _ = self.encoder(features)
+        output = self.decoder.reconstruct_all(latent)
+        return torch.mean((output - features.unsqueeze(0)) ** 2, dim=2)
+
+
+########################################################################
+
+
+########################################################################
+# export
+########################################################################
+def export_models(encoder, decoder, frames, n_mels, quantized=False):
+    """
+    fold and script a trained encoder / decoder pair.
+
+    encoder, decoder : Encoder, Decoder
+    frames, n_mels : int
+        feature parameters
+    quantized : boolean ( default = False )
+        dynamic int8 quantization of every Linear layer (int8 weights, activations quantized
+        on the fly), after the folding so that no BatchNorm is left in float
+
+    return : torch.jit.ScriptModule
+        scripted ScoringModel on the CPU in eval mode
+    """
+    encoder = copy.deepcopy(encoder).cpu().float().eval()
+    decoder = copy.deepcopy(decoder).cpu().float().eval()
+    model = ScoringModel(encoder, decoder, frames, n_mels).eval()
+    if quantized:
+        model = torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    return torch.jit.script(model)
+
+
+def scorer_path(model_dir, machine_type, quantized=False):
+    """
+    return : str
+        path of the scripted scoring artifact of a machine type,
+        scorer_int8_<machine_type>.pt for the quantized one
+    """
+    return "{model}/scorer_{int8}{machine_type}.pt".format(model=model_dir,
+                                                         int8="int8_" if quantized else "",
+                                                         machine_type=machine_type)
+
+
+def scorer_up_to_date(model_dir, machine_type, quantized=False):
+    """
+    return : boolean
+        True when the scoring artifact exists and is newer than both state_dict files
+    """
+    path = scorer_path(model_dir, machine_type, quantized=quantized)
+    if not os.path.exists(path):
+        return False
+    mtime = os.path.getmtime(path)
+    return all(os.path.getmtime("{model}/{net}_{machine_type}.pt".format(model=model_dir,
+                                                                       net=net,
+                                                                       machine_type=machine_type)) <= mtime
+               for net in ("encoder", "decoder"))
+
+
+def export_scorer(model_dir, machine_type, frames, n_mels, quantized=False, check_rows=256):
+    """
+    export the trained models of a machine type to model_dir/scorer_<machine_type>.pt,
+    or model_dir/scorer_int8_<machine_type>.pt when quantized.
+
+    The exported models are checked against the original ones on random features.
+
+    model_dir : str
+        directory of encoder_<machine_type>.pt and decoder_<machine_type>.pt
+    machine_type : str
+    frames, n_mels : int
+        feature parameters
+    quantized : boolean ( default = False )
+        dynamic int8 quantization, see export_models()
+    check_rows : int ( default = 256 )
+        number of random feature vectors of the check
+
+    return : str
+        path of the artifact
+    """
+    device = torch.device("cpu")
+    encoder, decoder = load_models("{}/encoder_{}.pt".format(model_dir, machine_type),
+                                   "{}/decoder_{}.pt".format(model_dir, machine_type),
+                                   paramF=frames,
+                                   paramM=n_mels,
+                                   device=device)
+    scorer = export_models(encoder, decoder, frames, n_mels, quantized=quantized)
+
+    features = torch.randn(check_rows, frames * n_mels)
+    with torch.no_grad():
+        reference = frame_errors(encoder, decoder, features)
+        errors = scorer(features)
+    max_error = float(torch.max(torch.abs(errors - reference) / torch.abs(reference).clamp_min(1e-12)))
+    com.logger.info("{} {} scorer : max relative difference {:.2e}".format(machine_type,
+                                                                         "int8" if quantized else "folded",
+                                                                         max_error))
+
+    path = scorer_path(model_dir, machine_type, quantized=quantized)
+    atomic_save(scorer, path, save=torch.jit.save)
+    com.logger.info("save_scorer -> {}".format(path))
+    return path
+
+
+########################################################################
+
+
+########################################################################
+# main export.py
+########################################################################
+if __name__ == "__main__":
+    param = com.yaml_load()
+    mode = com.command_line_chk(param)
+    if mode is None:
+        sys.exit(-1)
+
+    model_dir = param["model_directory"]["idcae"]
+    dirs = com.select_machines(com.select_dirs(param=param, mode=mode), param["schedule"]["machines"])
+    for target_dir in dirs:
+        machine_type = os.path.split(target_dir)[1]
+        if not all(os.path.exists("{}/{}_{}.pt".format(model_dir, net, machine_type)) for net in ("encoder", "decoder")):
+            com.logger.error("{} models not found".format(machine_type))
+            continue
+        for quantized in (False, True):
+            export_scorer(model_dir,
+                          machine_type,
+                          frames=param["feature"]["idcae"]["frames"],
+                          n_mels=param["feature"]["idcae"]["n_mels"],
+                          quantized=quantized)
@@ -0,0 +1,174 @@
+"""
+ @file   feature_cache.py
+ @brief  Persistent on-disk cache of log-mel spectrograms
+"""
+
+########################################################################
+# import python-library
+########################################################################
+# default
+import os
+import hashlib
+import tempfile
+
+# additional
+import numpy
+
+# original lib
+import common as com
+########################################################################
+
+
+########################################################################
+# version
+########################################################################
+# bump when the layout of the cached log-mel changes
+__cache_version__ = "1"
+########################################################################
+
+
+########################################################################
+# feature cache
+########################################################################
+class FeatureCache(object):
+    """
+    Cache of float32 log-mel spectrograms stored as .npy files.
+
+    Entries are keyed by the absolute wav path, its mtime/size and the
+    feature parameters, so a touched wav or a changed baseline.yaml simply
+    misses. Entries are loaded memory-mapped and the least recently used
+    ones are evicted once the cache exceeds max_size_mb.
+
+    directory : str
+        cache directory
+    max_size_mb : float ( default = None )
+        size limit of the cache directory, None means unlimited
+    """
+    def __init__(self, directory, max_size_mb=None):
+        self.directory = os.path.abspath(directory)
+        self.max_size = None if max_size_mb is None else int(max_size_mb * 1024 * 1024)
+        self._total_size = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, file_name, n_mels, n_fft, hop_length, power):
+        """
+        build the cache key of a wav file.
+
+        return : str
+            hex digest, None if the file does not exist
+        """
+        try:
+            stat = os.stat(file_name)
+        except OSError:
+            return None
+        source = "|".join([__cache_version__,
+                           os.path.abspath(file_name),
+                           str(stat.st_mtime_ns),
+                           str(stat.st_size),
+                           str(int(n_mels)),
+                           str(int(n_fft)),
+                           str(int(hop_length)),
+                           repr(float(power))])
+        return hashlib.sha1(source.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".npy")
+
+    def get(self, key):
+        """
+        return : numpy.array( float32 ) or None
+            memory-mapped log-mel spectrogram, None on a miss
+        """
+        path = self._path(key)
+        try:
+            log_mel_spectrogram = numpy.load(path, mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        # refresh mtime so that eviction is least recently used first
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return log_mel_spectrogram
+
+    def put(self, key, log_mel_spectrogram):
+        """
+        store a log-mel spectrogram atomically and evict old entries if needed.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                numpy.save(f, numpy.ascontiguousarray(log_mel_spectrogram, dtype=numpy.float32))
+            os.replace(tmp_path, path)
+        except OSError:
+            com.logger.warning("feature cache write failed : {}".format(path))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        if self.max_size is None:
+            return
+        if self._total_size is None:
+            self._total_size = self.size()
+        else:
+            self._total_size += os.path.getsize(path)
+        if self._total_size > self.max_size:
+            self.evict()
+
+    def _entries(self):
+        entries = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith(".npy"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def size(self):
+        """
+        return : int
+            total size of the cached entries in bytes
+        """
+        return sum(entry[1] for entry in self._entries())
+
+    def evict(self):
+        """
+        remove least recently used entries until the cache fits in max_size.
+        eviction goes down to 90% of max_size so that it does not run on every put.
+        """
+        entries = sorted(self._entries())
+        total_size = sum(entry[1] for entry in entries)
+        low_water = 0 if self.max_size is None else int(self.max_size * 0.9)
+        for _, size, path in entries:
+            if self.max_size is None or total_size <= low_water:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
+        self._total_size = total_size
+        com.logger.debug("feature cache evicted -> {:.1f} MB".format(total_size / 1024 / 1024))
+
+
+def open_feature_cache(param):
+    """
+    param : dict
+        baseline.yaml data
+
+    return : FeatureCache or None
+        None when the cache is disabled in baseline.yaml
+    """
+    cache_param = param.get("feature_cache")
+    if not cache_param or not cache_param.get("enabled", False):
+        return None
+    return FeatureCache(cache_param["directory"], max_size_mb=cache_param.get("max_size_mb"))
+
+########################################################################
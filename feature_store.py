@@ -0,0 +1,210 @@
+"""
+ @file   feature_store.py
+ @brief  Sharded on-disk store of the training vector arrays, written once and read memory-mapped
+"""
+
+########################################################################
+# import python-library
+########################################################################
+# default
+import glob
+import json
+import os
+import tempfile
+
+# additional
+import numpy
+from tqdm import tqdm
+
+# original lib
+import common as com
+########################################################################
+
+
+########################################################################
+# version
+########################################################################
+# bump when the layout of the shards or of the manifest changes
+__store_version__ = "1"
+########################################################################
+
+
+########################################################################
+# feature store
+########################################################################
+class FeatureStore(object):
+    """
+    Read side of a feature store, a read-only feature matrix spread over .npy shards.
+
+    The store directory holds shard_00000.npy, shard_00001.npy, ... of shard_rows rows each
+    (the last one may be partly used) and manifest.json with the feature parameters, the
+    number of used rows of every shard and the row offset, row count and machine ID label
+    of every source file. The shards are memory-mapped, so the matrix can be much larger
+    than the RAM.
+
+    Indexing with a slice or an array of row indices returns a float32 array, like the
+    in-memory matrix it replaces in MelDataset.
+
+    directory : str
+        store directory written by build_feature_store()
+    """
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.manifest = read_manifest(self.directory)
+        if self.manifest is None:
+            raise ValueError("no feature store in {}".format(self.directory))
+        self.shard_rows = self.manifest["shard_rows"]
+        self.dims = self.manifest["dims"]
+        self.dtype = numpy.dtype(numpy.float32)
+        self.shape = (self.manifest["n_rows"], self.dims)
+        self.shards = [numpy.load(os.path.join(self.directory, shard["file"]), mmap_mode="r")[:shard["rows"]]
+                       for shard in self.manifest["shards"]]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            idx = numpy.arange(*idx.indices(len(self)))
+        idx = numpy.asarray(idx, dtype=numpy.int64)
+        if idx.ndim == 0:
+            return numpy.array(self.shards[int(idx) // self.shard_rows][int(idx) % self.shard_rows])
+
+        out = numpy.empty((len(idx), self.dims), dtype=numpy.float32)
+        shard_idx = idx // self.shard_rows
+        row_idx = idx - shard_idx * self.shard_rows
+        for shard in numpy.unique(shard_idx):
+            mask = shard_idx == shard
+            out[mask] = self.shards[shard][row_idx[mask]]
+        return out
+
+    def labels(self):
+        """
+        return : numpy.array( int16 )
+            machine ID label of every row
+        """
+        labels = numpy.empty(len(self), dtype=numpy.int16)
+        for source in self.manifest["files"]:
+            labels[source["row_offset"]: source["row_offset"] + source["rows"]] = source["label"]
+        return labels
+
+
+def read_manifest(directory):
+    """
+    return : dict or None
+        manifest of the store in directory, None when there is no complete store
+    """
+    try:
+        with open(os.path.join(directory, "manifest.json"), "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != __store_version__:
+        return None
+    return manifest
+
+
+def build_feature_store(directory,
+                        file_lists,
+                        shard_rows=16384,
+                        cache=None,
+                        n_jobs=1,
+                        chunksize=16,
+                        **feature_param):
+    """
+    extract the vector arrays of every file into a sharded store, unless it already exists.
+
+    The store is reused as long as the feature parameters, the shard size and the labelled
+    file list are the same. It is written shard by shard, so only one shard is in memory at a
+    time, and the manifest is written last: an interrupted build leaves no manifest and is
+    started over the next time.
+
+    directory : str
+        store directory, e.g. feature_store/<machine_type>
+    file_lists : list [ list [ str ] ]
+        .wav files of every machine ID, the position in the list is the label
+    shard_rows : int ( default = 16384 )
+        number of rows per shard
+    cache : FeatureCache ( default = None )
+        on-disk log mel cache
+    n_jobs, chunksize : int
+        feature extraction processes, see com.iter_vector_arrays()
+    feature_param : dict
+        n_mels, frames, n_fft, hop_length, power
+
+    return : FeatureStore
+    """
+    directory = os.path.abspath(directory)
+    sources = [[os.path.abspath(file_name), label] for label, files in enumerate(file_lists) for file_name in files]
+    feature_param = {key: feature_param[key] for key in ("n_mels", "frames", "n_fft", "hop_length", "power")}
+    manifest = read_manifest(directory)
+    if (manifest is not None
+            and manifest["feature"] == feature_param
+            and manifest["shard_rows"] == shard_rows
+            and manifest["sources"] == sources):
+        com.logger.info("feature store <- {} ({} rows)".format(directory, manifest["n_rows"]))
+        return FeatureStore(directory)
+
+    # start over: a stale manifest must not describe the new shards
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, "manifest.json")) + glob.glob(os.path.join(directory, "shard_*.npy")):
+        os.remove(path)
+
+    dims = feature_param["n_mels"] * feature_param["frames"]
+    shards, files = [], []
+    shard, shard_used = None, 0
+    n_rows = 0
+
+    def close_shard():
+        shard.flush()
+        shards.append({"file": os.path.basename(shard.filename), "rows": shard_used})
+
+    for label, file_list in enumerate(file_lists):
+        vector_arrays = com.iter_vector_arrays(file_list,
+                                               n_jobs=n_jobs,
+                                               chunksize=chunksize,
+                                               cache=cache,
+                                               **feature_param)
+        for file_name, vector_array in tqdm(zip(file_list, vector_arrays), total=len(file_list), desc="feature store"):
+            if vector_array is None:
+                continue
+            files.append({"path": os.path.abspath(file_name),
+                          "label": label,
+                          "row_offset": n_rows,
+                          "rows": len(vector_array)})
+            written = 0
+            while written < len(vector_array):
+                if shard is None:
+                    shard = numpy.lib.format.open_memmap(os.path.join(directory, "shard_{:05d}.npy".format(len(shards))),
+                                                         mode="w+",
+                                                         dtype=numpy.float32,
+                                                         shape=(shard_rows, dims))
+                    shard_used = 0
+                n = min(len(vector_array) - written, shard_rows - shard_used)
+                shard[shard_used: shard_used + n] = vector_array[written: written + n]
+                shard_used += n
+                written += n
+                if shard_used == shard_rows:
+                    close_shard()
+                    shard = None
+            n_rows += len(vector_array)
+    if shard is not None:
+        close_shard()
+        del shard
+
+    manifest = {"version": __store_version__,
+                "feature": feature_param,
+                "dims": dims,
+                "shard_rows": shard_rows,
+                "n_rows": n_rows,
+                "shards": shards,
+                "files": files,
+                "sources": sources}
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=directory)
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(directory, "manifest.json"))
+    com.logger.info("feature store -> {} ({} rows in {} shards)".format(directory, n_rows, len(shards)))
+    return FeatureStore(directory)
+
+########################################################################
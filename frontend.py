@@ -0,0 +1,149 @@
+"""
+ @file   frontend.py
+ @brief  Batched log mel feature extraction with torch, for many clips of equal length at once
+"""
+
+########################################################################
+# import python-library
+########################################################################
+# default
+import inspect
+import sys
+
+# additional
+import numpy
+import librosa
+import torch
+
+# original lib
+import common as com
+########################################################################
+
+
+########################################################################
+# batched frontend
+########################################################################
+class LogMelFrontend(object):
+    """
+    The feature pipeline of com.file_to_vector_array() as tensor operations over a batch.
+
+    STFT (torch.stft), power spectrum, product with a mel filterbank computed once, log
+    compression, per frame standardization and multiframe stacking run on a whole stack of
+    waveforms of equal length in a few batched calls instead of one librosa call per clip.
+
+    The STFT follows librosa.stft(): periodic hann window, frames centered with the padding
+    mode of the installed librosa version ("constant" since 0.10, "reflect" before). The
+    features match com.file_to_vector_array() within float32 rounding.
+
+    sr : int
+        sampling rate of the waveforms
+    n_mels, frames, n_fft, hop_length, power :
+        feature parameters, see com.file_to_vector_array()
+    device : torch.device ( default = cpu )
+    pad_mode : str ( default = None )
+        padding of the centered frames, None uses the default of librosa.stft()
+    """
+    def __init__(self,
+                 sr,
+                 n_mels=64,
+                 frames=5,
+                 n_fft=1024,
+                 hop_length=512,
+                 power=2.0,
+                 device=None,
+                 pad_mode=None):
+        self.sr = sr
+        self.n_mels = n_mels
+        self.frames = frames
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.power = power
+        self.device = device or torch.device("cpu")
+        self.pad_mode = pad_mode or inspect.signature(librosa.stft).parameters["pad_mode"].default
+
+        self.window = torch.hann_window(n_fft, periodic=True, dtype=torch.float32, device=self.device)
+        mel_basis = librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels).astype(numpy.float32)
+        self.mel_basis = torch.from_numpy(mel_basis).to(self.device)
+
+    def log_mel(self, waveforms):
+        """
+        waveforms : torch.Tensor or numpy.array
+            shape = (batch, n_samples)
+
+        return : torch.Tensor( float32 )
+            log mel spectrograms, shape = (batch, n_mels, n_frames), as com.file_to_log_mel()
+        """
+        waveforms = torch.as_tensor(waveforms, dtype=torch.float32).to(self.device)
+        spectrum = torch.stft(waveforms,
+                              n_fft=self.n_fft,
+                              hop_length=self.hop_length,
+                              window=self.window,
+                              center=True,
+                              pad_mode=self.pad_mode,
+                              return_complex=True).abs()
+        if self.power != 1.0:
+            spectrum = spectrum ** self.power
+        # one product for the whole batch: (n_mels, n_freqs) x (batch, n_freqs, n_frames)
+        mel_spectrogram = torch.matmul(self.mel_basis, spectrum)
+        return 20.0 / self.power * torch.log10(mel_spectrogram + sys.float_info.epsilon)
+
+    def vector_arrays(self, waveforms):
+        """
+        waveforms : torch.Tensor or numpy.array
+            shape = (batch, n_samples)
+
+        return : torch.Tensor( float32 )
+            vector arrays, shape = (batch, n_vectors, n_mels * frames), as com.file_to_vector_array()
+        """
+        log_mel = self.log_mel(waveforms).transpose(1, 2)
+
+        # 06-07 standardization of each frame
+        mean = torch.mean(log_mel, dim=2, keepdim=True)
+        std = torch.std(log_mel, dim=2, keepdim=True, unbiased=False)
+        log_mel = (log_mel - mean) / std
+
+        # 08 frames t .. t+frames-1 of every clip, concatenated frame by frame
+        batch, n_frames, _ = log_mel.shape
+        if n_frames < self.frames:
+            return log_mel.new_empty((batch, 0, self.n_mels * self.frames))
+        windows = log_mel.unfold(1, self.frames, 1)
+        return windows.transpose(2, 3).reshape(batch, n_frames - self.frames + 1, self.n_mels * self.frames)
+
+    def file_vector_arrays(self, file_list, batch_size=32):
+        """
+        load wav files and extract their vector arrays batch by batch.
+
+        Files are grouped by length, every group of equal length is processed in batches
+        of batch_size clips.
+
+        file_list : list [ str ]
+            .wav files at self.sr
+        batch_size : int ( default = 32 )
+
+        return : list [ numpy.array( float32 ) or None ]
+            vector array of every file in the order of file_list, None for broken files
+            or files at another sampling rate
+        """
+        results = [None] * len(file_list)
+        groups = {}
+        for file_idx, file_name in enumerate(file_list):
+            loaded = com.file_load(file_name, mono=True)
+            if loaded is None:
+                continue
+            y, sr = loaded
+            if sr != self.sr:
+                com.logger.error("sampling rate {} instead of {} : {}".format(sr, self.sr, file_name))
+                continue
+            groups.setdefault(len(y), []).append((file_idx, y))
+
+        with torch.no_grad():
+            for clips in groups.values():
+                for start in range(0, len(clips), batch_size):
+                    batch = clips[start: start + batch_size]
+                    vectors = self.vector_arrays(numpy.stack([y for _, y in batch])).cpu().numpy()
+                    for (file_idx, _), vector_array in zip(batch, vectors):
+                        results[file_idx] = vector_array
+        return results
+
+
+########################################################################
@@ -0,0 +1,234 @@
+"""
+ @file   inference.py
+ @brief  Pipelined, cross-file micro-batched anomaly scoring of test sets
+"""
+
+########################################################################
+# import python-library
+########################################################################
+# default
+import threading
+import queue
+
+# additional
+import numpy as np
+import torch
+
+# original lib
+import common as com
+from scoring import standardize, frame_errors
+########################################################################
+
+
+########################################################################
+# inference engine
+########################################################################
+class InferenceEngine(object):
+    """
+    Score many test files with a trained encoder / decoder pair.
+
+    Feature extraction runs in a background thread (and optionally in the process pool of
+    com.iter_vector_arrays) and feeds a bounded queue. The scoring loop packs the frames of
+    consecutive files into fixed-size batches, so the models always see large batches
+    regardless of the clip length, and scatters the per-frame errors back to their files.
+    The scores are identical to scoring.anomaly_score() file by file.
+
+    encoder, decoder : Encoder, Decoder
+        trained models, they are switched to eval mode
+    device : torch.device
+    batch_rows : int ( default = 4096 )
+        number of frames per model call
+    queue_size : int ( default = 32 )
+        maximum number of extracted files waiting to be scored
+    n_jobs, chunksize : int
+        feature extraction processes, see com.iter_vector_arrays()
+    top_k : int ( default = 0 )
+        decode only the top_k machine IDs of the classifier for every file,
+        see scoring.pruned_reconstruction_errors(), 0 decodes all of them
+    feature_param : dict
+        feature parameters passed to com.file_to_vector_array()
+    """
+    def __init__(self,
+                 encoder,
+                 decoder,
+                 device,
+                 batch_rows=4096,
+                 queue_size=32,
+                 n_jobs=1,
+                 chunksize=16,
+                 cache=None,
+                 top_k=0,
+                 **feature_param):
+        self.encoder = encoder.eval()
+        self.decoder = decoder.eval()
+        self.device = device
+        self.batch_rows = int(batch_rows)
+        self.queue_size = int(queue_size)
+        self.n_jobs = n_jobs
+        self.chunksize = chunksize
+        self.cache = cache
+        self.feature_param = feature_param
+        self.class_num = decoder.class_num
+        self.top_k = min(int(top_k), self.class_num)
+
+    def _produce(self, file_list, feature_queue, stop):
+        def put(item):
+            # the consumer sets stop when it gives up, the queue may then stay full forever
+            while not stop.is_set():
+                try:
+                    feature_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        vector_arrays = None
+        try:
+            vector_arrays = com.iter_vector_arrays(file_list,
+                                                   n_jobs=self.n_jobs,
+                                                   chunksize=self.chunksize,
+                                                   cache=self.cache,
+                                                   **self.feature_param)
+            for file_idx, vector_array in enumerate(vector_arrays):
+                if vector_array is not None:
+                    vector_array = standardize(vector_array)
+                if not put((file_idx, vector_array)):
+                    return
+            put(None)
+        except BaseException as e:
+            put(e)
+        finally:
+            if vector_arrays is not None:
+                # shuts the extraction processes down when the consumer stopped early
+                vector_arrays.close()
+
+    def _iter_batches(self, feature_queue):
+        """
+        pack the queued files into batches of batch_rows frames.
+
+        return : generator of (numpy.array( float32 ), numpy.array( int ))
+            frames and the index of the file every frame belongs to
+        """
+        pending, pending_ids, n_pending = [], [], 0
+        while True:
+            item = feature_queue.get()
+            if isinstance(item, BaseException):
+                raise item
+            if item is not None:
+                file_idx, vector_array = item
+                if vector_array is None or len(vector_array) == 0:
+                    continue
+                pending.append(vector_array)
+                pending_ids.append(np.full(len(vector_array), file_idx, dtype=np.int64))
+                n_pending += len(vector_array)
+                if n_pending < self.batch_rows:
+                    continue
+            if n_pending == 0:
+                return
+            rows = np.concatenate(pending, axis=0).astype(np.float32, copy=False)
+            ids = np.concatenate(pending_ids, axis=0)
+            n_full = len(rows) // self.batch_rows * self.batch_rows if item is not None else len(rows)
+            for start in range(0, n_full, self.batch_rows):
+                yield rows[start: start + self.batch_rows], ids[start: start + self.batch_rows]
+            pending, pending_ids = [rows[n_full:]], [ids[n_full:]]
+            n_pending = len(rows) - n_full
+            if item is None:
+                return
+
+    def score_files(self, file_list):
+        """
+        file_list : list [ str ]
+            .wav files to score
+
+        return : numpy.array( float ), numpy.array( numpy.array( float ) )
+            anomaly score of every file (nan for broken files) and its
+            reconstruction error per class, shape = (files, classNum),
+            inf for the classes pruned by top_k
+        """
+        feature_queue = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(file_list, feature_queue, stop), daemon=True)
+        producer.start()
+        try:
+            if self.top_k > 0 and self.top_k < self.class_num:
+                return self._score_pruned(len(file_list), feature_queue)
+            return self._score_all(len(file_list), feature_queue)
+        except BaseException:
+            # the producer stops instead of waiting for a consumer that is gone
+            stop.set()
+            raise
+        finally:
+            producer.join()
+
+    def _score_all(self, n_files, feature_queue):
+        """
+        score_files() decoding every machine ID.
+        """
+        # squared error sums and frame counts per file stay on the device until the end
+        error_sums = torch.zeros(n_files, self.class_num, dtype=torch.float64, device=self.device)
+        frame_counts = torch.zeros(n_files, dtype=torch.float64, device=self.device)
+        with torch.no_grad():
+            for rows, ids in self._iter_batches(feature_queue):
+                features = torch.from_numpy(rows).to(self.device, non_blocking=True)
+                ids = torch.from_numpy(ids).to(self.device, non_blocking=True)
+                errors = frame_errors(self.encoder, self.decoder, features)
+                error_sums.index_add_(0, ids, errors.t().double())
+                frame_counts.index_add_(0, ids, torch.ones_like(ids, dtype=torch.float64))
+
+        errors = (error_sums / frame_counts.unsqueeze(1)).cpu().numpy()
+        scores = np.min(errors, axis=1)
+        return scores, errors
+
+    def _score_pruned(self, n_files, feature_queue):
+        """
+        score_files() decoding only the top_k machine IDs of every file.
+
+        The classes of a file are known once all its frames went through the encoder,
+        so the latents of the files that may continue in the next batch are held back
+        and decoded together with the following batch.
+        """
+        error_sums = torch.zeros(n_files, self.class_num, dtype=torch.float64, device=self.device)
+        prob_sums = torch.zeros(n_files, self.class_num, dtype=torch.float64, device=self.device)
+        frame_counts = torch.zeros(n_files, dtype=torch.float64, device=self.device)
+        file_classes = torch.zeros(n_files, self.top_k, dtype=torch.int64, device=self.device)
+        pending = []
+
+        def decode(features, latent, ids):
+            # the files of these rows are complete, choose their classes and decode
+            done = torch.unique(ids)
+            file_classes[done] = torch.topk(prob_sums[done], self.top_k, dim=1).indices
+            classes = file_classes[ids]
+            output = self.decoder.reconstruct_classes(latent, classes)
+            errors = torch.mean((output - features.unsqueeze(1)) ** 2, dim=2)
+            flat_index = (ids.unsqueeze(1) * self.class_num + classes).view(-1)
+            error_sums.view(-1).index_add_(0, flat_index, errors.view(-1).double())
+
+        with torch.no_grad():
+            for rows, ids in self._iter_batches(feature_queue):
+                features = torch.from_numpy(rows).to(self.device, non_blocking=True)
+                ids = torch.from_numpy(ids).to(self.device, non_blocking=True)
+                latent, cls_output = self.encoder(features)
+                prob_sums.index_add_(0, ids, torch.softmax(cls_output, dim=1).double())
+                frame_counts.index_add_(0, ids, torch.ones_like(ids, dtype=torch.float64))
+                pending.append((features, latent, ids))
+
+                # files come in order, every file before the last one of the batch is complete
+                features, latent, ids = (torch.cat(columns, dim=0) for columns in zip(*pending))
+                complete = ids < ids[-1]
+                if bool(complete.any()):
+                    decode(features[complete], latent[complete], ids[complete])
+                    rest = ~complete
+                    pending = [(features[rest], latent[rest], ids[rest])]
+                else:
+                    pending = [(features, latent, ids)]
+            if pending and len(pending[0][2]) > 0:
+                decode(*pending[0])
+
+        errors = error_sums / frame_counts.unsqueeze(1)
+        pruned = torch.ones(n_files, self.class_num, dtype=torch.bool, device=self.device)
+        pruned.scatter_(1, file_classes, False)
+        errors[pruned] = float("inf")
+        errors = errors.cpu().numpy()
+        return np.min(errors, axis=1), errors
+
+########################################################################
@@ -53,9 +53,50 @@ class Encoder(nn.Module):
         cls_output = self.classifier(latent)
         return latent, cls_output
 
+def condition_label(label, classNum):
+    """
+    convert class indices to the conditioning vector of the Decoder.
+    the one hot label with 0 changed to -1, e.g. class 0 of 4 -> [1, -1, -1, -1]
+
+    label : torch.Tensor( long )
+        class index, shape = (batch, )
+    classNum : int
+        number of classes
+
+    return : torch.Tensor( float32 )
+        shape = (batch, classNum)
+    """
+    one_hot = torch.zeros(label.shape[0], classNum, device=label.device, dtype=torch.float32)
+    one_hot.scatter_(1, label.view(-1, 1), 1)
+    return 2 * (one_hot - 0.5)
+
+def sequential_forward(layers, x, groups=1):
+    """
+    run the layers of a nn.Sequential on x, the concatenation of `groups` equally sized batches.
+
+    Linear and activation layers see the whole concatenated batch at once. In training mode
+    every BatchNorm1d normalizes each group with the statistics of that group and updates its
+    running statistics once per group in order, exactly as if the groups were passed through
+    the layers one after another. In eval mode this is the same as layers(x).
+
+    layers : nn.Sequential
+    x : torch.Tensor
+        shape = (groups * batch, features)
+    groups : int ( default = 1 )
+
+    return : torch.Tensor
+    """
+    for layer in layers:
+        if groups > 1 and layer.training and isinstance(layer, nn.BatchNorm1d):
+            x = torch.cat([layer(chunk) for chunk in x.chunk(groups, dim=0)], dim=0)
+        else:
+            x = layer(x)
+    return x
+
 class Decoder(nn.Module):
     def __init__(self, paramF, paramM, classNum):
         super(Decoder, self).__init__()
+        self.class_num = classNum
 
         self.condition_layer_Hr = nn.Sequential(
             nn.Linear(classNum, 16),
@@ -105,7 +146,29 @@ class Decoder(nn.Module):
             nn.Linear(256, paramF * paramM)
         )
 
-    def forward(self, latent, label, nm_label):
+    def forward(self, latent, label, nm_label, fused=False):
+        """
+        latent : torch.Tensor
+            encoder latent, shape = (batch, 16)
+        label, nm_label : torch.Tensor
+            match and non match conditioning vectors, see condition_label()
+        fused : boolean ( default = False )
+            run both conditionings as one batch of twice the size through the
+            conditioning layers and the decoder, see sequential_forward()
+
+        return : m_output, nm_output
+        """
+        if fused:
+            batch = latent.shape[0]
+            labels = torch.cat((label, nm_label), dim=0)
+            Hr = sequential_forward(self.condition_layer_Hr, labels, groups=2)
+            Hb = sequential_forward(self.condition_layer_Hb, labels, groups=2)
+            cond_latent = latent.repeat(2, 1) * Hr + Hb
+            output = sequential_forward(self.decoder, cond_latent, groups=2)
+            # split() backpropagates by concatenation, slicing would zero fill two full size gradients
+            m_output, nm_output = output.split(batch, dim=0)
+            return m_output, nm_output
+
         m_Hr = self.condition_layer_Hr(label)
         m_Hb = self.condition_layer_Hb(label)
         # m_Hr, m_Hb = m_cond[:, :16], m_cond[:, 16:32]
@@ -123,6 +186,53 @@ class Decoder(nn.Module):
         # print("NM HR, Hb", nm_Hr, nm_Hb)
         return m_output, nm_output
 
+    def reconstruct_all(self, latent):
+        """
+        reconstruct the latent conditioned on every class at once (eval mode only).
+
+        The conditioning layers run once on the classNum conditioning vectors and are
+        broadcast over the frames, the decoder then runs once on all classNum * frames rows.
+
+        latent : torch.Tensor
+            encoder latent, shape = (frames, 16)
+
+        return : torch.Tensor
+            shape = (classNum, frames, paramF * paramM)
+        """
+        assert not self.training, "reconstruct_all() needs the BatchNorm running statistics"
+        class_num = self.class_num
+        label = condition_label(torch.arange(class_num, device=latent.device), class_num)
+        Hr = self.condition_layer_Hr(label).unsqueeze(1)
+        Hb = self.condition_layer_Hb(label).unsqueeze(1)
+        cond_latent = latent.unsqueeze(0) * Hr + Hb
+        output = self.decoder(cond_latent.view(-1, latent.shape[1]))
+        return output.view(class_num, latent.shape[0], -1)
+
+    def reconstruct_classes(self, latent, classes):
+        """
+        reconstruct every latent conditioned on its own subset of the classes (eval mode only).
+
+        The conditioning layers run once on the classNum conditioning vectors, the rows of
+        the requested classes are gathered for every frame and the decoder runs once on
+        frames * k rows, so the cost grows with k instead of classNum.
+
+        latent : torch.Tensor
+            encoder latent, shape = (frames, 16)
+        classes : torch.Tensor( long )
+            classes to decode for every frame, shape = (frames, k)
+
+        return : torch.Tensor
+            shape = (frames, k, paramF * paramM)
+        """
+        assert not self.training, "reconstruct_classes() needs the BatchNorm running statistics"
+        class_num = self.class_num
+        label = condition_label(torch.arange(class_num, device=latent.device), class_num)
+        Hr = self.condition_layer_Hr(label)[classes]
+        Hb = self.condition_layer_Hb(label)[classes]
+        cond_latent = latent.unsqueeze(1) * Hr + Hb
+        output = self.decoder(cond_latent.view(-1, latent.shape[1]))
+        return output.view(latent.shape[0], classes.shape[1], -1)
+
     """ def predict(self, x, label):
         cond_latent = self.condition(label, latent)
         output = self.decoder(cond_latent)
@@ -171,12 +281,12 @@ import numpy as np
 import torch.nn as nn
 ##############################################################
 class CustomLoss(nn.Module):
-    def __init__(self, C, dim, batch_size):
+    def __init__(self, C, dim, batch_size, device=None):
         super(CustomLoss, self).__init__()
         
         self.const_vector = np.empty(shape=(batch_size, dim))
         self.const_vector.fill(C)
-        self.const_vector = torch.Tensor(self.const_vector).to(device=torch.device('cuda'), non_blocking=True, dtype=torch.float32)
+        self.const_vector = torch.Tensor(self.const_vector).to(device=device or torch.device('cpu'), non_blocking=True, dtype=torch.float32)
 
     def forward(self, m_output, nm_output, input):
         #print(nm_output[1])
@@ -199,4 +309,69 @@ class CustomLoss(nn.Module):
         else:
             nm_loss = loss_fn(nm_output, self.const_vector)
 
-        return m_loss, nm_loss
\ No newline at end of file
+        return m_loss, nm_loss
+
+
+##############################################################
+# Early stopping
+##############################################################
+class EarlyStopping(object):
+    """
+    Stop a training phase when the validation loss stops improving.
+
+    patience : int
+        number of epochs without improvement after the best epoch before stopping
+    min_delta : float
+        minimum decrease of the validation loss that counts as an improvement
+    restore_best_weights : boolean
+        keep a copy of the weights of the best epoch, restore() loads them back
+
+    step() is called with the validation loss of every validated epoch.
+    """
+    def __init__(self, patience=10, min_delta=0.0, restore_best_weights=True):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.restore_best_weights = restore_best_weights
+        self.best_loss = float("inf")
+        self.best_epoch = 0
+        self.best_state = None
+
+    def step(self, model, loss, epoch):
+        """
+        model : nn.Module
+        loss : float
+            validation loss of the epoch
+        epoch : int
+
+        return : boolean
+            True when the training phase should stop
+        """
+        if loss < self.best_loss - self.min_delta:
+            self.best_loss = loss
+            self.best_epoch = epoch
+            if self.restore_best_weights:
+                # stays on the device of the model, no host copy per improvement
+                self.best_state = {key: value.detach().clone() for key, value in model.state_dict().items()}
+            return False
+        return epoch - self.best_epoch >= self.patience
+
+    def restore(self, model):
+        """
+        load the weights of the best epoch into the model, if they were kept.
+        """
+        if self.restore_best_weights and self.best_state is not None:
+            model.load_state_dict(self.best_state)
+
+    def state_dict(self):
+        """
+        return : dict
+            progress of the phase, for training checkpoints
+        """
+        return {"best_loss": self.best_loss,
+                "best_epoch": self.best_epoch,
+                "best_state": self.best_state}
+
+    def load_state_dict(self, state):
+        self.best_loss = state["best_loss"]
+        self.best_epoch = state["best_epoch"]
+        self.best_state = state["best_state"]
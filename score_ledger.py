@@ -0,0 +1,210 @@
+"""
+ @file   score_ledger.py
+ @brief  Anomaly scores of the test files keyed by fingerprints of the audio and of the models, for incremental scoring
+"""
+
+########################################################################
+# import python-library
+########################################################################
+# default
+import hashlib
+import json
+import os
+import tempfile
+
+# additional
+import numpy
+
+# original lib
+import common as com
+########################################################################
+
+
+########################################################################
+# version
+########################################################################
+# bump when the layout of the ledger changes
+__ledger_version__ = "2"
+########################################################################
+
+
+########################################################################
+# fingerprints
+########################################################################
+def file_digest(path, block_size=1 << 20):
+    """
+    return : str
+        sha1 hex digest of the content of a file
+    """
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def model_fingerprint(model_files, **settings):
+    """
+    fingerprint of the model artifacts and of the settings a score depends on.
+
+    model_files : list [ str ]
+        files of the models used for scoring, e.g. the encoder and the decoder .pt
+    settings : dict
+        feature parameters, top_k, ... ; any change of a value changes the fingerprint
+
+    return : str
+        sha1 hex digest
+    """
+    digest = hashlib.sha1()
+    for path in model_files:
+        digest.update(file_digest(path).encode("utf-8"))
+    digest.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+########################################################################
+
+
+########################################################################
+# score ledger
+########################################################################
+class ScoreLedger(object):
+    """
+    Anomaly scores of the test files of one machine type, with the fingerprints they were computed from.
+
+    Every record holds the size, mtime and sha1 of the wav file, the fingerprint of the models
+    (see model_fingerprint()), the score, None for a file that could not be scored, and the
+    reconstruction error of every class. A file needs scoring when it has no record or its record
+    was scored with other models or from other audio. The sha1 of a file is only computed again when its size or mtime changed, so a file
+    that was merely touched or copied keeps its score.
+
+    path : str
+        json file of the ledger, e.g. result/score_ledger_dev_data_<machine_type>.json
+    model : str
+        fingerprint of the models of this run
+    """
+    def __init__(self, path, model):
+        self.path = path
+        self.model = model
+        self.records = self._load()
+        self.digests = {}
+        self.changed = False
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                ledger = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if ledger.get("version") != __ledger_version__:
+            return {}
+        return ledger["files"]
+
+    def _digest(self, path):
+        if path not in self.digests:
+            self.digests[path] = file_digest(path)
+        return self.digests[path]
+
+    def pending(self, files):
+        """
+        files : list [ str ]
+            test files of this run
+
+        return : list [ str ]
+            files without an up to date score, in the order of files
+        """
+        pending = []
+        for file_name in files:
+            path = os.path.abspath(file_name)
+            record = self.records.get(path)
+            if record is None or record["model"] != self.model:
+                pending.append(file_name)
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                pending.append(file_name)
+                continue
+            if record["size"] == stat.st_size and record["mtime_ns"] == stat.st_mtime_ns:
+                continue
+            if record["size"] == stat.st_size and record["audio"] == self._digest(path):
+                # same audio, only the mtime moved
+                record["mtime_ns"] = stat.st_mtime_ns
+                self.changed = True
+                continue
+            pending.append(file_name)
+        return pending
+
+    def update(self, files, scores, errors):
+        """
+        record the scores of newly scored files.
+
+        files : list [ str ]
+        scores : numpy.array( float )
+            score of every file, nan for files that could not be scored
+        errors : numpy.array( float )
+            reconstruction error of every file and class, shape = (files, classes)
+        """
+        for file_name, score, file_errors in zip(files, scores, errors):
+            path = os.path.abspath(file_name)
+            try:
+                stat = os.stat(path)
+                audio = self._digest(path)
+            except OSError:
+                self.records.pop(path, None)
+                continue
+            self.records[path] = {"size": stat.st_size,
+                                  "mtime_ns": stat.st_mtime_ns,
+                                  "audio": audio,
+                                  "model": self.model,
+                                  "score": None if numpy.isnan(score) else float(score),
+                                  "errors": [float(error) for error in file_errors]}
+            self.changed = True
+
+    def scores(self, files):
+        """
+        return : numpy.array( float )
+            recorded score of every file, nan for files without a score
+        """
+        scores = numpy.full(len(files), numpy.nan)
+        for file_idx, file_name in enumerate(files):
+            record = self.records.get(os.path.abspath(file_name))
+            if record is not None and record["score"] is not None:
+                scores[file_idx] = record["score"]
+        return scores
+
+    def errors(self, files, class_num):
+        """
+        return : numpy.array( float )
+            recorded reconstruction errors, shape = (files, class_num), nan for files without a score
+        """
+        errors = numpy.full((len(files), class_num), numpy.nan)
+        for file_idx, file_name in enumerate(files):
+            record = self.records.get(os.path.abspath(file_name))
+            if record is not None and record["score"] is not None:
+                errors[file_idx, :len(record["errors"])] = record["errors"]
+        return errors
+
+    def save(self, files):
+        """
+        keep the records of files only (test files that were removed are dropped) and write the ledger atomically.
+
+        files : list [ str ]
+            test files of this run
+        """
+        keep = set(os.path.abspath(file_name) for file_name in files)
+        removed = [path for path in self.records if path not in keep]
+        for path in removed:
+            del self.records[path]
+        if not (self.changed or removed):
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"version": __ledger_version__, "files": self.records}, f)
+        os.replace(tmp_path, self.path)
+        self.changed = False
+        com.logger.info("score ledger -> {} ({} files)".format(self.path, len(self.records)))
+
+########################################################################
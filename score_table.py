@@ -0,0 +1,190 @@
+"""
+ @file   score_table.py
+ @brief  Columnar table of the anomaly scores of a test run, one .npz file per run
+"""
+
+########################################################################
+# import python-library
+########################################################################
+# default
+import csv
+import glob
+import os
+import re
+import tempfile
+
+# additional
+import numpy
+
+# original lib
+import common as com
+########################################################################
+
+
+########################################################################
+# version
+########################################################################
+# bump when the columns of the table change
+__table_version__ = "1"
+########################################################################
+
+
+########################################################################
+# score table
+########################################################################
+# label of the files without ground truth (evaluation mode)
+UNKNOWN_LABEL = -1
+
+# column -> description, every column holds one entry per test file
+COLUMNS = {"file_name": "base name of the wav file",
+           "machine_type": "machine type, e.g. fan",
+           "machine_id": "machine ID, e.g. id_00",
+           "score": "anomaly score (float64), nan for files that could not be scored",
+           "errors": "reconstruction error per class (float32, files x classes), inf for classes pruned by "
+                     "test.top_k, nan beyond the number of classes of the machine type",
+           "label": "ground truth (int8), 0 normal, 1 anomaly, UNKNOWN_LABEL in evaluation mode"}
+
+# columns stored as utf-8 bytes, numpy unicode arrays take 4 bytes per character
+STRING_COLUMNS = ("file_name", "machine_type", "machine_id")
+
+
+class ScoreTableWriter(object):
+    """
+    Collect the scores of a test run machine type by machine type and write them in bulk as one table.
+
+    The table is an uncompressed .npz file with one array per column (see COLUMNS), so a reader
+    loads only the columns it asks for. The strings are stored as utf-8 bytes. The per class
+    errors of machine types with fewer classes are padded with nan up to the largest number of
+    classes of the run.
+    """
+    def __init__(self):
+        self.parts = []
+
+    def append(self, machine_type, machine_id, files, scores, errors, labels=None):
+        """
+        machine_type, machine_id : str
+        files : list [ str ]
+            scored wav files
+        scores : numpy.array( float )
+            anomaly score of every file
+        errors : numpy.array( float )
+            reconstruction error of every file and class, shape = (files, classes)
+        labels : numpy.array ( default = None )
+            0 / 1 ground truth of every file, None when it is unknown
+        """
+        n = len(files)
+        errors = numpy.asarray(errors, dtype=numpy.float32).reshape(n, -1)
+        labels = numpy.full(n, UNKNOWN_LABEL) if labels is None else numpy.asarray(labels)
+        self.parts.append({"file_name": numpy.array([os.path.basename(file_name) for file_name in files], dtype=str),
+                           "machine_type": numpy.full(n, machine_type),
+                           "machine_id": numpy.full(n, machine_id),
+                           "score": numpy.asarray(scores, dtype=numpy.float64),
+                           "errors": errors,
+                           "label": labels.astype(numpy.int8)})
+
+    def __len__(self):
+        return sum(len(part["score"]) for part in self.parts)
+
+    def columns(self):
+        """
+        return : dict [ str, numpy.array ]
+            the collected rows as one array per column
+        """
+        class_num = max([part["errors"].shape[1] for part in self.parts] or [0])
+        table = {}
+        for column in COLUMNS:
+            if column == "errors":
+                arrays = [numpy.pad(part["errors"], ((0, 0), (0, class_num - part["errors"].shape[1])),
+                                    constant_values=numpy.nan) for part in self.parts]
+                table[column] = numpy.concatenate(arrays) if arrays else numpy.zeros((0, 0), dtype=numpy.float32)
+            else:
+                arrays = [part[column] for part in self.parts]
+                table[column] = numpy.concatenate(arrays) if arrays else numpy.zeros(0)
+        return table
+
+    def save(self, path):
+        """
+        write the table atomically.
+
+        path : str
+            .npz file, e.g. result/scores.npz
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=directory)
+        with os.fdopen(fd, "wb") as f:
+            columns = self.columns()
+            for column in STRING_COLUMNS:
+                columns[column] = numpy.char.encode(columns[column].astype(str), "utf-8")
+            numpy.savez(f, version=numpy.array(__table_version__), **columns)
+        os.replace(tmp_path, path)
+        com.logger.info("score table -> {} ({} files)".format(path, len(self)))
+
+
+def load_score_table(path, columns=None, machine_type=None, machine_id=None):
+    """
+    read a score table written by ScoreTableWriter.
+
+    path : str
+        .npz file of a test run
+    columns : list [ str ] ( default = None )
+        columns to load, None loads all of them
+    machine_type, machine_id : str ( default = None )
+        keep the rows of this machine type / machine ID only
+
+    return : dict [ str, numpy.array ]
+        one array per column, rows in the order of the run
+    """
+    columns = list(COLUMNS) if columns is None else list(columns)
+    unknown = [column for column in columns if column not in COLUMNS]
+    if unknown:
+        raise ValueError("unknown score table columns {}, expected {}".format(unknown, list(COLUMNS)))
+    with numpy.load(path, allow_pickle=False) as npz:
+        if str(npz["version"]) != __table_version__:
+            raise ValueError("{} is a score table of version {}, not {}".format(path, npz["version"], __table_version__))
+        mask = None
+        if machine_type is not None:
+            mask = npz["machine_type"] == machine_type.encode("utf-8")
+        if machine_id is not None:
+            id_mask = npz["machine_id"] == machine_id.encode("utf-8")
+            mask = id_mask if mask is None else mask & id_mask
+        table = {}
+        for column in columns:
+            values = npz[column] if mask is None else npz[column][mask]
+            table[column] = decode_strings(values) if column in STRING_COLUMNS else values
+        return table
+
+
+def decode_strings(values):
+    """
+    return : numpy.array( str )
+        utf-8 bytes decoded to str, with one vectorized cast as long as they are ascii
+    """
+    try:
+        return values.astype(str)
+    except UnicodeDecodeError:
+        return numpy.char.decode(values, "utf-8")
+
+
+def load_score_csv(result_dir):
+    """
+    read the anomaly_score_<machine_type>_<id>.csv files of a result directory, for comparison with the table.
+
+    result_dir : str
+
+    return : dict [ str, numpy.array ]
+        file_name, machine_type, machine_id and score columns
+    """
+    table = {"file_name": [], "machine_type": [], "machine_id": [], "score": []}
+    for path in sorted(glob.glob(os.path.join(result_dir, "anomaly_score_*_id_[0-9][0-9].csv"))):
+        machine_type, machine_id = re.match(r"anomaly_score_(.+)_(id_[0-9][0-9])\.csv$", os.path.basename(path)).groups()
+        with open(path, "r", newline="") as f:
+            for file_name, score in csv.reader(f):
+                table["file_name"].append(file_name)
+                table["machine_type"].append(machine_type)
+                table["machine_id"].append(machine_id)
+                table["score"].append(float(score))
+    return {column: numpy.array(values, dtype=numpy.float64 if column == "score" else str)
+            for column, values in table.items()}
+
+########################################################################
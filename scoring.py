@@ -0,0 +1,166 @@
+"""
+ @file   scoring.py
+ @brief  Anomaly scoring with a trained IDCAE encoder / decoder pair
+"""
+
+########################################################################
+# import python-library
+########################################################################
+import numpy as np
+import torch
+########################################################################
+
+
+########################################################################
+# scoring
+########################################################################
+def standardize(vector_array):
+    """
+    standardize the vector array of a test file with the mean and std of all its values.
+
+    vector_array : numpy.array( numpy.array( float ) )
+        output of com.file_to_vector_array()
+
+    return : numpy.array( numpy.array( float32 ) )
+    """
+    data = vector_array.flatten()
+    mean = np.mean(data, dtype=np.float32)
+    std = np.std(data, dtype=np.float32)
+    return (vector_array - mean) / std
+
+
+def frame_errors(encoder, decoder, features):
+    """
+    reconstruction error of every frame conditioned on every machine ID.
+
+    encoder, decoder : Encoder, Decoder
+        trained models in eval mode
+    features : torch.Tensor
+        standardized vectors, shape = (frames, dims), the frames may belong to several files
+
+    return : torch.Tensor
+        mean squared error per class and frame, shape = (classNum, frames)
+    """
+    latent, _ = encoder(features)
+    output = decoder.reconstruct_all(latent)
+    return torch.mean((output - features.unsqueeze(0)) ** 2, dim=2)
+
+
+def reconstruction_errors(encoder, decoder, features):
+    """
+    reconstruction error of one file conditioned on every machine ID.
+
+    During testing, we try all labels and take the smallest reconstruction error as anomaly score.
+    All labels are decoded in one batched decoder call (Decoder.reconstruct_all) and the
+    error stays on the device, so the caller needs a single transfer per file.
+
+    encoder, decoder : Encoder, Decoder
+        trained models in eval mode
+    features : torch.Tensor
+        standardized vector array of one file, shape = (frames, dims)
+
+    return : torch.Tensor
+        mean squared error per class, shape = (classNum, )
+    """
+    return torch.mean(frame_errors(encoder, decoder, features), dim=1)
+
+
+def pruned_reconstruction_errors(encoder, decoder, features, top_k):
+    """
+    reconstruction error of one file conditioned on the top_k most likely machine IDs only.
+
+    The classifier probabilities of the encoder, averaged over the frames of the file,
+    select the machine IDs to decode. The score (min over the decoded IDs) equals the
+    exhaustive one whenever the best reconstructing ID is among them.
+
+    encoder, decoder : Encoder, Decoder
+        trained models in eval mode
+    features : torch.Tensor
+        standardized vector array of one file, shape = (frames, dims)
+    top_k : int
+        number of machine IDs to decode
+
+    return : torch.Tensor
+        mean squared error per class, inf for the pruned classes, shape = (classNum, )
+    """
+    latent, cls_output = encoder(features)
+    class_num = cls_output.shape[1]
+    top_k = min(top_k, class_num)
+    classes = torch.topk(torch.softmax(cls_output, dim=1).mean(dim=0), top_k).indices
+    output = decoder.reconstruct_classes(latent, classes.unsqueeze(0).expand(latent.shape[0], top_k))
+    errors = torch.full((class_num, ), float("inf"), device=features.device)
+    errors[classes] = torch.mean(torch.mean((output - features.unsqueeze(1)) ** 2, dim=2), dim=0)
+    return errors
+
+
+def anomaly_score(encoder, decoder, features, top_k=0):
+    """
+    features : torch.Tensor
+        standardized vector array of one file, shape = (frames, dims)
+    top_k : int ( default = 0 )
+        decode only the top_k machine IDs of the classifier, 0 decodes all of them
+
+    return : float, numpy.array( float32 )
+        anomaly score (min over classes) and the reconstruction error of every class
+        (inf for classes pruned by top_k)
+    """
+    with torch.no_grad():
+        if top_k > 0:
+            errors = pruned_reconstruction_errors(encoder, decoder, features, top_k).cpu().numpy()
+        else:
+            errors = reconstruction_errors(encoder, decoder, features).cpu().numpy()
+    return float(np.min(errors)), errors
+
+########################################################################
+
+
+########################################################################
+# model loading
+########################################################################
+def load_models(encoder_file_path, decoder_file_path, paramF, paramM, device):
+    """
+    load a trained encoder / decoder pair for scoring.
+
+    encoder_file_path, decoder_file_path : str
+        state_dict files saved by 00_train.py
+    paramF, paramM : int
+        frames and n_mels of the feature
+    device : torch.device
+
+    return : Encoder, Decoder
+        models in eval mode on device, the number of machine IDs is read from the classifier
+    """
+    from pytorch_model import Encoder, Decoder
+
+    encoder_state = torch.load(encoder_file_path, map_location=device)
+    decoder_state = torch.load(decoder_file_path, map_location=device)
+    class_num = encoder_state["classifier.0.weight"].shape[0]
+    encoder = Encoder(paramF=paramF, paramM=paramM, classNum=class_num)
+    decoder = Decoder(paramF=paramF, paramM=paramM, classNum=class_num)
+    encoder.load_state_dict(encoder_state)
+    decoder.load_state_dict(decoder_state)
+    encoder = encoder.to(device).float().eval()
+    decoder = decoder.to(device).float().eval()
+    return encoder, decoder
+
+
+def load_scorer(scorer_file_path, paramF, paramM, device):
+    """
+    load the scripted scoring artifact written by export.py.
+
+    scorer_file_path : str
+        scorer_<machine_type>.pt file
+    paramF, paramM : int
+        frames and n_mels of the feature, checked against those of the export
+    device : torch.device
+
+    return : ScriptModule, ScriptModule
+        folded encoder and decoder, drop-in replacements of Encoder / Decoder for scoring
+    """
+    scorer = torch.jit.load(scorer_file_path, map_location=device).eval()
+    if (scorer.frames, scorer.n_mels) != (paramF, paramM):
+        raise ValueError("{} was exported for frames {} and n_mels {}, not {} and {}".format(
+            scorer_file_path, scorer.frames, scorer.n_mels, paramF, paramM))
+    return scorer.encoder, scorer.decoder
+
+########################################################################
@@ -0,0 +1,481 @@
+"""
+ @file   server.py
+ @brief  Local scoring service: HTTP on localhost or a Unix socket with dynamic micro-batching
+"""
+
+########################################################################
+# import python-library
+########################################################################
+# default
+import argparse
+import collections
+import concurrent.futures
+import glob
+import http.server
+import io
+import json
+import os
+import queue
+import signal
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+
+# additional
+import numpy as np
+import torch
+
+# original lib
+import common as com
+from scoring import standardize, frame_errors, load_models
+########################################################################
+
+
+########################################################################
+# metrics
+########################################################################
+class Metrics(object):
+    """
+    Thread safe counters of the scoring service.
+
+    history : int ( default = 10000 )
+        number of recent requests kept for the latency percentiles and the recent throughput
+    """
+    def __init__(self, history=10000):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.requests = 0
+        self.failures = 0
+        self.frames = 0
+        self.batches = 0
+        self.batched_requests = 0
+        self.batched_frames = 0
+        # (finish time, latency in seconds, frames) of the recent requests
+        self.recent = collections.deque(maxlen=history)
+
+    def record_request(self, latency, frames, ok=True):
+        with self.lock:
+            self.requests += 1
+            if not ok:
+                self.failures += 1
+                return
+            self.frames += frames
+            self.recent.append((time.time(), latency, frames))
+
+    def record_batch(self, n_requests, n_frames):
+        with self.lock:
+            self.batches += 1
+            self.batched_requests += n_requests
+            self.batched_frames += n_frames
+
+    def snapshot(self, queue_depths, window=60.0):
+        """
+        queue_depths : dict { str : int }
+            requests waiting per machine type
+        window : float ( default = 60.0 )
+            seconds of the recent throughput
+
+        return : dict
+        """
+        now = time.time()
+        with self.lock:
+            recent = list(self.recent)
+            result = {"uptime_sec": now - self.start,
+                      "requests": self.requests,
+                      "failures": self.failures,
+                      "frames": self.frames,
+                      "batches": self.batches,
+                      "mean_batch_requests": self.batched_requests / self.batches if self.batches else 0.0,
+                      "mean_batch_frames": self.batched_frames / self.batches if self.batches else 0.0}
+        uptime = max(result["uptime_sec"], 1e-9)
+        in_window = [(latency, frames) for finish, latency, frames in recent if finish >= now - window]
+        span = min(window, uptime)
+        result["throughput"] = {"requests_per_sec": (result["requests"] - result["failures"]) / uptime,
+                                "frames_per_sec": result["frames"] / uptime,
+                                "recent_requests_per_sec": len(in_window) / span,
+                                "recent_frames_per_sec": sum(frames for _, frames in in_window) / span}
+        result["queue_depth"] = queue_depths
+        if recent:
+            latencies = np.asarray([latency for _, latency, _ in recent]) * 1000.0
+            result["latency_ms"] = {"mean": float(np.mean(latencies)),
+                                    "p50": float(np.percentile(latencies, 50)),
+                                    "p95": float(np.percentile(latencies, 95)),
+                                    "p99": float(np.percentile(latencies, 99)),
+                                    "max": float(np.max(latencies))}
+        return result
+
+
+########################################################################
+
+
+########################################################################
+# micro-batching
+########################################################################
+class MicroBatcher(object):
+    """
+    Scoring thread of one machine type that coalesces concurrent requests.
+
+    The first waiting request opens a batch; the requests queued behind it and those
+    arriving within max_latency of it join the batch until it holds batch_rows frames.
+    The whole batch is scored with one encoder / decoder call and the per frame errors
+    are averaged back per request.
+
+    encoder, decoder : Encoder, Decoder
+        trained models in eval mode
+    device : torch.device
+    batch_rows : int
+        frames after which a batch is closed early
+    max_latency : float
+        seconds the first request of a batch waits for others to join
+    metrics : Metrics ( default = None )
+    """
+    def __init__(self, encoder, decoder, device, batch_rows=4096, max_latency=0.01, metrics=None):
+        self.encoder = encoder.eval()
+        self.decoder = decoder.eval()
+        self.device = device
+        self.batch_rows = int(batch_rows)
+        self.max_latency = float(max_latency)
+        self.metrics = metrics
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, features):
+        """
+        features : numpy.array( float32 )
+            standardized vectors of one request, shape = (frames, dims)
+
+        return : concurrent.futures.Future
+            resolves to the reconstruction error per class, numpy.array( float ), shape = (classNum, )
+        """
+        future = concurrent.futures.Future()
+        self.requests.put((features, future, time.perf_counter()))
+        return future
+
+    def queue_depth(self):
+        return self.requests.qsize()
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+    def _run(self):
+        closing = False
+        while not closing:
+            item = self.requests.get()
+            if item is None:
+                return
+            batch, rows = [item], len(item[0])
+            deadline = item[2] + self.max_latency
+            while rows < self.batch_rows:
+                # requests already waiting always join, new ones only within the latency budget
+                timeout = deadline - time.perf_counter()
+                try:
+                    item = self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    closing = True
+                    break
+                batch.append(item)
+                rows += len(item[0])
+            self._score(batch, rows)
+
+    def _score(self, batch, rows):
+        try:
+            sizes = [len(vectors) for vectors, _, _ in batch]
+            features = torch.from_numpy(np.concatenate([vectors for vectors, _, _ in batch], axis=0))
+            features = features.to(self.device, dtype=torch.float32)
+            ids = torch.from_numpy(np.repeat(np.arange(len(batch), dtype=np.int64), sizes)).to(self.device)
+            with torch.no_grad():
+                errors = frame_errors(self.encoder, self.decoder, features).t().double()
+                error_sums = torch.zeros(len(batch), errors.shape[1], dtype=torch.float64, device=self.device)
+                error_sums.index_add_(0, ids, errors)
+                counts = torch.tensor(sizes, dtype=torch.float64, device=self.device)
+                errors = (error_sums / counts.unsqueeze(1)).cpu().numpy()
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        for i, (_, future, _) in enumerate(batch):
+            future.set_result(errors[i])
+        if self.metrics is not None:
+            self.metrics.record_batch(len(batch), rows)
+
+
+########################################################################
+
+
+########################################################################
+# scoring service
+########################################################################
+class ScoringService(object):
+    """
+    Models of every machine type, loaded once, with one MicroBatcher each.
+
+    param : dict
+        baseline.yaml data
+    device : torch.device
+    cache : FeatureCache ( default = None )
+        on-disk log mel cache for wav requests
+    """
+    def __init__(self, param, device, cache=None):
+        self.param = param
+        self.device = device
+        self.cache = cache
+        self.metrics = Metrics(history=int(param["server"]["latency_history"]))
+        self.batchers = {}
+        self.lock = threading.Lock()
+
+    def model_paths(self, machine_type):
+        model_dir = self.param["model_directory"]["idcae"]
+        return ("{}/encoder_{}.pt".format(model_dir, machine_type),
+                "{}/decoder_{}.pt".format(model_dir, machine_type))
+
+    def available(self):
+        """
+        return : list [ str ]
+            machine types with a trained encoder and decoder
+        """
+        model_dir = self.param["model_directory"]["idcae"]
+        machine_types = []
+        for path in sorted(glob.glob("{}/encoder_*.pt".format(model_dir))):
+            machine_type = os.path.basename(path)[len("encoder_"):-len(".pt")]
+            if os.path.exists(self.model_paths(machine_type)[1]):
+                machine_types.append(machine_type)
+        return machine_types
+
+    def batcher(self, machine_type):
+        """
+        the MicroBatcher of machine_type, its models are loaded on first use.
+        """
+        with self.lock:
+            if machine_type not in self.batchers:
+                encoder_path, decoder_path = self.model_paths(machine_type)
+                if not (os.path.exists(encoder_path) and os.path.exists(decoder_path)):
+                    raise KeyError("no trained models for machine type {}".format(machine_type))
+                feature = self.param["feature"]["idcae"]
+                encoder, decoder = load_models(encoder_path,
+                                               decoder_path,
+                                               paramF=feature["frames"],
+                                               paramM=feature["n_mels"],
+                                               device=self.device)
+                self.batchers[machine_type] = MicroBatcher(encoder,
+                                                           decoder,
+                                                           self.device,
+                                                           batch_rows=self.param["server"]["batch_rows"],
+                                                           max_latency=self.param["server"]["max_latency_ms"] / 1000.0,
+                                                           metrics=self.metrics)
+                com.logger.info("models loaded : {}".format(machine_type))
+            return self.batchers[machine_type]
+
+    def features(self, wav=None, features=None):
+        """
+        vectors of a request, from a wav path or a raw vector array.
+
+        return : numpy.array( float32 )
+            standardized vectors, shape = (frames, dims)
+        """
+        feature = self.param["feature"]["idcae"]
+        if wav is not None:
+            if not os.path.exists(wav):
+                raise ValueError("wav not found : {}".format(wav))
+            vector_array = com.file_to_vector_array(wav,
+                                                    n_mels=feature["n_mels"],
+                                                    frames=feature["frames"],
+                                                    n_fft=feature["n_fft"],
+                                                    hop_length=feature["hop_length"],
+                                                    power=feature["power"],
+                                                    cache=self.cache)
+        elif features is not None:
+            vector_array = np.asarray(features, dtype=np.float32)
+        else:
+            raise ValueError("either wav or features is required")
+        dims = feature["n_mels"] * feature["frames"]
+        if vector_array.ndim != 2 or vector_array.shape[1] != dims or len(vector_array) == 0:
+            raise ValueError("features must have shape (frames, {}), got {}".format(dims, vector_array.shape))
+        return standardize(vector_array).astype(np.float32, copy=False)
+
+    def score(self, machine_type, wav=None, features=None):
+        """
+        score one request, blocking until its batch is done.
+
+        return : dict
+            anomaly score and reconstruction error per machine ID
+        """
+        start = time.perf_counter()
+        n_frames = 0
+        try:
+            batcher = self.batcher(machine_type)
+            vectors = self.features(wav=wav, features=features)
+            n_frames = len(vectors)
+            errors = batcher.submit(vectors).result()
+        except Exception:
+            self.metrics.record_request(time.perf_counter() - start, n_frames, ok=False)
+            raise
+        self.metrics.record_request(time.perf_counter() - start, n_frames)
+        return {"machine_type": machine_type,
+                "score": float(np.min(errors)),
+                "errors": errors.tolist(),
+                "frames": n_frames}
+
+    def snapshot(self):
+        with self.lock:
+            depths = {machine_type: batcher.queue_depth() for machine_type, batcher in self.batchers.items()}
+        return self.metrics.snapshot(depths)
+
+
+########################################################################
+
+
+########################################################################
+# HTTP interface
+########################################################################
+class ScoringHandler(http.server.BaseHTTPRequestHandler):
+    """
+    GET  /health   loaded and available machine types
+    GET  /metrics  throughput, queue depth and latency percentiles
+    POST /score    {"machine_type": "fan", "wav": "<path>"} or {"machine_type": "fan", "features": [[...], ...]}
+    POST /score?machine_type=fan   with a .npy body (Content-Type: application/x-npy) of shape (frames, dims),
+                   much cheaper to decode than JSON for raw feature arrays
+    """
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == "/health":
+            self._reply(200, {"status": "ok",
+                              "loaded": sorted(service.batchers.keys()),
+                              "available": service.available()})
+        elif self.path == "/metrics":
+            self._reply(200, service.snapshot())
+        else:
+            self._reply(404, {"error": "unknown path {}".format(self.path)})
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != "/score":
+            self._reply(404, {"error": "unknown path {}".format(self.path)})
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.headers.get("Content-Type") == "application/x-npy":
+                request = {key: values[0] for key, values in urllib.parse.parse_qs(url.query).items()}
+                request["features"] = np.load(io.BytesIO(body), allow_pickle=False)
+            else:
+                request = json.loads(body.decode("utf-8"))
+            if not isinstance(request, dict) or "machine_type" not in request:
+                raise ValueError("machine_type is required")
+            result = self.server.service.score(request["machine_type"],
+                                               wav=request.get("wav"),
+                                               features=request.get("features"))
+        except KeyError as e:
+            self._reply(404, {"error": e.args[0]})
+        except (ValueError, TypeError) as e:
+            self._reply(400, {"error": str(e)})
+        except Exception as e:
+            com.logger.exception("scoring failed")
+            self._reply(500, {"error": str(e)})
+        else:
+            self._reply(200, result)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        com.logger.debug("{} - {}".format(self.address_string(), format % args))
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    # listen backlog, the default of 5 resets connections under concurrent clients
+    request_queue_size = 128
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def make_server(service, host="127.0.0.1", port=8765, socket_path=None):
+    """
+    service : ScoringService
+    host, port : str, int
+        localhost address, used when socket_path is empty
+    socket_path : str ( default = None )
+        path of a Unix socket to listen on instead
+
+    return : socketserver.BaseServer
+        call serve_forever() on it
+    """
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, ScoringHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), ScoringHandler)
+    server.service = service
+    return server
+
+
+########################################################################
+
+
+########################################################################
+# main server.py
+########################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="serve the trained models over HTTP on localhost or a Unix socket")
+    parser.add_argument("--host", type=str, default=None, help="listen address (default: server.host)")
+    parser.add_argument("--port", type=int, default=None, help="listen port (default: server.port)")
+    parser.add_argument("--socket", type=str, default=None, help="Unix socket path, replaces host and port")
+    parser.add_argument("--machines", type=str, default=None, help="machine types to load at start: all or a comma separated list")
+    parser.add_argument("--batch_rows", type=int, default=None, help="frames after which a batch is scored")
+    parser.add_argument("--max_latency_ms", type=float, default=None, help="time a request waits for others to join its batch")
+    parser.add_argument("--device", type=str, default=None, help="torch device: auto, cpu, cuda or cuda:<n>")
+    args = parser.parse_args()
+
+    param = com.yaml_load()
+    server_param = param["server"]
+    for key in ("host", "port", "socket", "machines", "batch_rows", "max_latency_ms"):
+        if getattr(args, key) is not None:
+            server_param[key] = getattr(args, key)
+    if args.device is not None:
+        param["runtime"]["device"] = args.device
+    device = com.setup_runtime(param)
+
+    from feature_cache import open_feature_cache
+    service = ScoringService(param, device, cache=open_feature_cache(param))
+    machines = server_param["machines"]
+    if machines:
+        available = service.available()
+        for machine_type in (available if machines == "all" else [m.strip() for m in machines.split(",")]):
+            service.batcher(machine_type)
+
+    server = make_server(service,
+                         host=server_param["host"],
+                         port=int(server_param["port"]),
+                         socket_path=server_param["socket"])
+    com.logger.info("scoring server listening on {}".format(
+        server_param["socket"] or "http://{}:{}".format(server_param["host"], server_param["port"])))
+    # stop on SIGTERM as on Ctrl-C, so that the socket file is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if server_param["socket"] and os.path.exists(server_param["socket"]):
+            os.remove(server_param["socket"])
@@ -0,0 +1,252 @@
+"""
+ @file   streaming.py
+ @brief  Streaming anomaly scoring of live audio fed in PCM chunks
+"""
+
+########################################################################
+# import python-library
+########################################################################
+# default
+import argparse
+import collections
+import sys
+import time
+
+# additional
+import numpy as np
+import scipy.signal
+import librosa
+import torch
+
+# original lib
+import common as com
+from scoring import load_models, frame_errors
+########################################################################
+
+
+########################################################################
+# streaming scorer
+########################################################################
+class StreamingScorer(object):
+    """
+    Score an audio stream chunk by chunk with a trained encoder / decoder pair.
+
+    The log mel spectrogram is computed incrementally: the samples that do not fill a
+    whole STFT frame yet are carried over to the next chunk, so every frame is computed
+    exactly once whatever the chunk size is. Frames are standardized one by one as in
+    com.file_to_vector_array() and kept in a rolling buffer of `frames` frames, which
+    yields one multiframe vector per hop as soon as the buffer is full.
+
+    Every vector is reconstructed with the conditioning of every machine ID. The score of
+    a hop is the mean reconstruction error over the last `score_window` vectors, minimized
+    over the machine IDs, the same definition as the file score of 01_test.py with the
+    window in place of the whole file.
+
+    Unlike librosa (center=True) the stream is not padded, the frames start at the first
+    sample. As every frame is standardized on its own, the per file standardization of
+    01_test.py is (up to rounding) an identity and is skipped.
+
+    encoder, decoder : Encoder, Decoder
+        trained models, they are switched to eval mode
+    device : torch.device
+    sr : int
+        sampling rate of the stream
+    n_mels, frames, n_fft, hop_length, power :
+        feature parameters, see com.file_to_vector_array()
+    score_window : int ( default = 1 )
+        number of hops averaged into one score, 1 scores every hop on its own
+    latency_history : int ( default = 1000 )
+        number of per chunk latencies kept for latency_stats()
+    """
+    def __init__(self,
+                 encoder,
+                 decoder,
+                 device,
+                 sr,
+                 n_mels=64,
+                 frames=5,
+                 n_fft=1024,
+                 hop_length=512,
+                 power=2.0,
+                 score_window=1,
+                 latency_history=1000):
+        self.encoder = encoder.eval()
+        self.decoder = decoder.eval()
+        self.device = device
+        self.sr = sr
+        self.n_mels = n_mels
+        self.frames = frames
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.power = power
+        self.score_window = max(int(score_window), 1)
+
+        # periodic hann window and mel filterbank, as used by librosa.feature.melspectrogram
+        self.window = scipy.signal.get_window("hann", n_fft).astype(np.float32)
+        self.mel_basis = librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels).astype(np.float32).T
+        self.latencies = collections.deque(maxlen=latency_history)
+        self.reset()
+
+    def reset(self):
+        """
+        forget the stream, the next chunk starts a new one.
+        """
+        # samples received but not consumed by a whole STFT frame yet
+        self.samples = np.zeros(0, dtype=np.float32)
+        # the last frames-1 standardized log mel frames, shape = (<= frames-1, n_mels)
+        self.context = np.zeros((0, self.n_mels), dtype=np.float32)
+        # per class reconstruction errors of the last score_window vectors
+        self.errors = collections.deque(maxlen=self.score_window)
+        # number of log mel frames computed since the start of the stream
+        self.n_frames = 0
+        self.latencies.clear()
+
+    def _log_mel_frames(self, chunk):
+        """
+        append chunk to the carried over samples and compute every complete frame.
+
+        return : numpy.array( float32 )
+            standardized log mel frames, shape = (n_new_frames, n_mels)
+        """
+        samples = np.concatenate((self.samples, chunk))
+        n_new = (len(samples) - self.n_fft) // self.hop_length + 1 if len(samples) >= self.n_fft else 0
+        # the next frame starts n_new hops further, the samples before it are not needed any more
+        self.samples = samples[n_new * self.hop_length:]
+        if n_new == 0:
+            return np.zeros((0, self.n_mels), dtype=np.float32)
+
+        item_size = samples.itemsize
+        framed = np.lib.stride_tricks.as_strided(samples,
+                                                 shape=(n_new, self.n_fft),
+                                                 strides=(self.hop_length * item_size, item_size),
+                                                 writeable=False)
+        spectrum = np.abs(np.fft.rfft(framed * self.window, axis=1)) ** self.power
+        log_mel = 20.0 / self.power * np.log10(np.dot(spectrum, self.mel_basis) + sys.float_info.epsilon)
+        log_mel = log_mel.astype(np.float32)
+
+        # standardization of each frame (step 06-07 of com.file_to_vector_array)
+        mean = np.mean(log_mel, dtype=np.float32, axis=1, keepdims=True)
+        std = np.std(log_mel, dtype=np.float32, axis=1, keepdims=True)
+        return (log_mel - mean) / std
+
+    def feed(self, chunk):
+        """
+        score a chunk of the stream.
+
+        chunk : numpy.array
+            PCM samples at self.sr, float in [-1, 1] or int16, mono or shape = (n_samples, channels)
+
+        return : list [ (float, float) ]
+            (time in seconds of the end of the newest frame, anomaly score) for every hop
+            completed by this chunk, possibly empty
+        """
+        start = time.perf_counter()
+        chunk = np.asarray(chunk)
+        if chunk.ndim > 1:
+            chunk = chunk.mean(axis=1)
+        if chunk.dtype == np.int16:
+            chunk = chunk.astype(np.float32) / 32768.0
+        chunk = chunk.astype(np.float32, copy=False)
+
+        # rolling frames-wide context: the vectors are sliding windows over context + new frames
+        new_frames = self._log_mel_frames(chunk)
+        first_frame = self.n_frames - len(self.context)
+        self.n_frames += len(new_frames)
+        log_mel = np.concatenate((self.context, new_frames))
+        n_vectors = len(log_mel) - self.frames + 1
+        self.context = log_mel[max(len(log_mel) - (self.frames - 1), 0):]
+
+        results = []
+        if n_vectors > 0:
+            item_size = log_mel.itemsize
+            vectors = np.lib.stride_tricks.as_strided(log_mel,
+                                                      shape=(n_vectors, self.n_mels * self.frames),
+                                                      strides=(self.n_mels * item_size, item_size),
+                                                      writeable=False)
+            features = torch.from_numpy(np.array(vectors)).to(self.device, dtype=torch.float32)
+            with torch.no_grad():
+                errors = frame_errors(self.encoder, self.decoder, features).t().cpu().numpy()
+
+            for i, error in enumerate(errors):
+                self.errors.append(error)
+                score = float(np.min(np.mean(self.errors, axis=0)))
+                # the vector of hop i ends with frame first_frame + i + frames - 1
+                end_sample = (first_frame + i + self.frames - 1) * self.hop_length + self.n_fft
+                results.append((end_sample / self.sr, score))
+
+        self.latencies.append(time.perf_counter() - start)
+        return results
+
+    def latency_stats(self):
+        """
+        return : dict
+            number of chunks, mean, p50, p95, p99 and max processing time per chunk in milliseconds
+        """
+        if not self.latencies:
+            return {"chunks": 0}
+        latencies = np.asarray(self.latencies) * 1000.0
+        return {"chunks": len(latencies),
+                "mean_ms": float(np.mean(latencies)),
+                "p50_ms": float(np.percentile(latencies, 50)),
+                "p95_ms": float(np.percentile(latencies, 95)),
+                "p99_ms": float(np.percentile(latencies, 99)),
+                "max_ms": float(np.max(latencies))}
+
+
+########################################################################
+
+
+########################################################################
+# main streaming.py
+########################################################################
+if __name__ == "__main__":
+    # replay a local wav file as a live stream
+    parser = argparse.ArgumentParser(description="stream a wav file through the anomaly scorer in PCM chunks")
+    parser.add_argument("wav", type=str, help="wav file to stream")
+    parser.add_argument("machine_type", type=str, help="machine type of the trained models, e.g. fan")
+    parser.add_argument("--chunk_ms", type=float, default=None, help="chunk length in milliseconds")
+    parser.add_argument("--score_window", type=int, default=None, help="number of hops averaged into one score")
+    parser.add_argument("--device", type=str, default=None, help="torch device: auto, cpu, cuda or cuda:<n>")
+    parser.add_argument("--realtime", action="store_true", help="feed the chunks at the pace of the audio")
+    args = parser.parse_args()
+
+    param = com.yaml_load()
+    if args.device is not None:
+        param["runtime"]["device"] = args.device
+    device = com.setup_runtime(param)
+    feature = param["feature"]["idcae"]
+    chunk_ms = args.chunk_ms if args.chunk_ms is not None else param["streaming"]["chunk_ms"]
+    score_window = args.score_window if args.score_window is not None else param["streaming"]["score_window"]
+
+    model_dir = param["model_directory"]["idcae"]
+    encoder, decoder = load_models("{}/encoder_{}.pt".format(model_dir, args.machine_type),
+                                   "{}/decoder_{}.pt".format(model_dir, args.machine_type),
+                                   paramF=feature["frames"],
+                                   paramM=feature["n_mels"],
+                                   device=device)
+
+    y, sr = com.file_load(args.wav, mono=True)
+    scorer = StreamingScorer(encoder,
+                             decoder,
+                             device,
+                             sr,
+                             n_mels=feature["n_mels"],
+                             frames=feature["frames"],
+                             n_fft=feature["n_fft"],
+                             hop_length=feature["hop_length"],
+                             power=feature["power"],
+                             score_window=score_window)
+
+    chunk_size = max(int(sr * chunk_ms / 1000.0), 1)
+    print("streaming {} : {:.1f} s, {} samples per chunk, score window {} hops".format(
+        args.wav, len(y) / sr, chunk_size, score_window))
+    for start in range(0, len(y), chunk_size):
+        for t, score in scorer.feed(y[start:start + chunk_size]):
+            print("{:10.3f} s  {:.6f}".format(t, score))
+        if args.realtime:
+            time.sleep(chunk_size / sr)
+
+    stats = scorer.latency_stats()
+    print("latency per chunk ({chunks} chunks, {ms:.1f} ms of audio each): "
+          "mean {mean_ms:.2f} ms, p50 {p50_ms:.2f} ms, p95 {p95_ms:.2f} ms, p99 {p99_ms:.2f} ms, max {max_ms:.2f} ms".format(
+              ms=chunk_size * 1000.0 / sr, **stats))